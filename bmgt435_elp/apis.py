@@ -1,16 +1,25 @@
-from django.http import HttpRequest, HttpResponse
-from django.views.decorators.http import require_POST, require_GET, require_http_methods
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from django.contrib.auth.hashers import make_password, check_password
-from django.db import IntegrityError, transaction
+from django.db import DatabaseError, IntegrityError, OperationalError, transaction
 from django.db.models import Max
-from django.conf import settings
 
 from .simulation import FoodDelivery, SimulationException
 from .bmgtModels import *
-from .utils.apiUtils import request_error_handler, password_valid, generic_paginated_query, pager_params_from_request, create_pager_params, AppResponse
+from .utils.authUtils import SESSION_COOKIE, sign_session_token, session_user, asession_user
+from .utils.leaderboardUtils import leaderboard_page, group_leaderboard_entry, deferred_ranking
+from .utils.quotaUtils import submission_available, claim_submission, fail_case_records
+from .utils.databaseUtils import retry_on_locked
+from .utils.versionUtils import conditional_on, leaderboard_resource, CASE_RESOURCE, CASE_CONFIG_RESOURCE, SEMESTER_RESOURCE, SYSTEM_RESOURCE
+from .utils.apiUtils import request_error_handler, require_GET, require_POST, require_http_methods, password_valid, generic_paginated_query, ageneric_paginated_query, pager_params_from_request, fields_from_request, iterate_serialized, AppResponse, AppStreamingResponse
+from .simulationJobs import CASE_RECORD_PATH, CHECKPOINT_SUFFIX, SCENARIO_BANK_PATH, RESULT_CACHE, scenario_bank_tag, canonical_food_delivery_params, result_cache_key, complete_case_record, dispatch_case_record, case_record_state, case_record_events, admit_case_record, refund_case_record_admission, simulation_load, fail_stale_case_records
+
+from asgiref.sync import sync_to_async
+from http import HTTPStatus
+from typing import Union
 
 import pandas as pd
 import json
+import math
 import io
 import os
 
@@ -18,7 +27,6 @@ import os
 All requests have been verified to have valid user id except for those of the Auth.
 """
 
-_CASE_RECORD_PATH = settings.MEDIA_ROOT  + "bmgt435/case-records/"
 _MAX_GROUP_SIZE = 4
 _FOOD_DELIVERY_CASE_ID = 1
 _CALL_CENTER_CASE_ID = 2
@@ -26,15 +34,28 @@ _CALL_CENTER_CASE_ID = 2
 
 def _get_session_user(request: HttpRequest) -> BMGTUser:
     """
-    raise key error if cookie not found
-    raise does not exist error if user not found
+    raise does not exist error if the session has no valid user
     """
 
     try:
         user: BMGTUser = request.app_user
     except: # fallback
-        id = request.COOKIES.get('id', None)
-        user = BMGTUser.objects.get(id=id, activated=True,)
+        user = session_user(request)
+        if user is None:
+            raise BMGTUser.DoesNotExist("User not found!")
+    return user
+
+async def _aget_session_user(request: HttpRequest) -> BMGTUser:
+    """
+    async version of _get_session_user. the group and semester of the user are loaded along with it
+    """
+
+    try:
+        user: BMGTUser = request.app_user
+    except: # fallback
+        user = await asession_user(request)
+        if user is None:
+            raise BMGTUser.DoesNotExist("User not found!")
     return user
 
 def _resolvePaginatedData(data: dict, resp: AppResponse = None) -> AppResponse:
@@ -43,20 +64,62 @@ def _resolvePaginatedData(data: dict, resp: AppResponse = None) -> AppResponse:
     return resp
 
 
+def _leaderboard_resources(request: HttpRequest) -> Union[list[str], None]:
+    user = session_user(request)
+    try:
+        case_id = int(request.GET['case_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return None if user is None else [leaderboard_resource(case_id, user.semester_id)]
+
+
+@retry_on_locked
+def _record_submission(user: BMGTUser, case: BMGTCase, group: BMGTGroup) -> tuple[Union[BMGTCaseRecord, None], float]:
+    """
+    admits and records a running submission of the case. returns the record, or None with the seconds to wait
+    before retrying if the group is not admitted, or None with 0 if the group has no submission left.\n
+    the group is admitted with its row locked and its submission reserved in the transaction that records it,
+    so concurrent submits can overrun neither its concurrency limit nor its submission limit.
+    the admission is refunded unless the submission is recorded
+    """
+    admitted = recorded = False
+    try:
+        with transaction.atomic():
+            BMGTGroup.objects.select_for_update().filter(id=group.id).exists()
+            retry_after = admit_case_record(group)
+            if retry_after > 0:
+                return None, retry_after
+            admitted = True
+            case_record = None
+            if claim_submission(case, group):
+                case_record = BMGTCaseRecord(
+                    user=user, semester_id=user.semester_id,
+                    case=case, group=group, state=BMGTCaseRecord.State.RUNNING,
+                    file_name=BMGTCaseRecord.get_file_name(group, user, case),
+                )
+                case_record.save()
+        recorded = case_record is not None
+        return case_record, 0.0
+    finally:
+        if admitted and not recorded:
+            refund_case_record_admission(group)
+
+
 class AuthApi:
 
     __MAX_AGE_REMEMBER = 60 * 60 * 24 * 7 # 7 days
 
     @staticmethod
     def __set_auth_cookie(response: HttpResponse, user: BMGTUser, remember: bool) -> None:
+        token = sign_session_token(user)
         if remember:
-            response.set_cookie('id', str(user.id), samesite='strict', secure=True, httponly=True, max_age=AuthApi.__MAX_AGE_REMEMBER)
+            response.set_cookie(SESSION_COOKIE, token, samesite='strict', secure=True, httponly=True, max_age=AuthApi.__MAX_AGE_REMEMBER)
         else:
-            response.set_cookie('id', str(user.id), samesite='strict', secure=True, httponly=True)
+            response.set_cookie(SESSION_COOKIE, token, samesite='strict', secure=True, httponly=True)
 
     @staticmethod
     def __clear_auth_cookie(response: HttpResponse) -> None:
-        response.delete_cookie('id', samesite='strict')
+        response.delete_cookie(SESSION_COOKIE, samesite='strict')
 
     @request_error_handler
     @require_POST
@@ -97,7 +160,8 @@ class AuthApi:
                 if password_valid(password):
                     user.password = make_password(password)
                     user.activated = True
-                    user.save()
+                    user.auth_version += 1
+                    retry_on_locked(user.save)()
                     resp.resolve("Sign up success!")
                 else:
                     resp.reject("Sign up failed! Password should contain at least 8 and up to 20 alphanumeric characters!")
@@ -122,8 +186,7 @@ class AuthApi:
     def sign_out(request: HttpRequest) -> HttpResponse:
         try:
             resp = AppResponse()
-            id = request.COOKIES.get('id', None)
-            user = BMGTUser.objects.get(id=id, activated=True)
+            _get_session_user(request)
             resp.resolve("Sign out success!")
             AuthApi.__clear_auth_cookie(resp)
         except Exception as e:
@@ -136,10 +199,10 @@ class UserApi:
     @request_error_handler
     @require_GET
     @staticmethod
-    def me(request: HttpRequest,) -> HttpResponse:
+    async def me(request: HttpRequest,) -> HttpResponse:
         try:
             resp = AppResponse()
-            user = _get_session_user(request)
+            user = await _aget_session_user(request)
             resp.resolve(user)
         except BMGTUser.DoesNotExist:
             resp.reject("User not found!")
@@ -154,12 +217,12 @@ class GroupApi:
     @request_error_handler
     @require_GET
     @staticmethod
-    def me(request: HttpRequest,) -> HttpResponse:
+    async def me(request: HttpRequest,) -> HttpResponse:
         try:
             resp = AppResponse()
-            user = _get_session_user(request)
+            user = await _aget_session_user(request)
             if user.group != None:
-                resp.resolve(user.group)
+                resp.resolve(await BMGTGroup.serialization_queryset().aget(id=user.group_id))
             else:
                 resp.resolve(None)
         except BMGTUser.DoesNotExist:
@@ -172,11 +235,11 @@ class GroupApi:
     @request_error_handler
     @require_GET
     @staticmethod
-    def get_group(request: HttpRequest) -> AppResponse:
+    async def get_group(request: HttpRequest) -> AppResponse:
         try:
             resp = AppResponse()
             group_id = int(request.GET.get('id'))
-            group = BMGTGroup.objects.get(id=group_id)
+            group = await BMGTGroup.serialization_queryset().aget(id=group_id)
             resp.resolve(group)
         except BMGTGroup.DoesNotExist:
             resp.reject("Group not found!")
@@ -188,38 +251,38 @@ class GroupApi:
     @request_error_handler
     @require_GET
     @staticmethod
-    def groups_paginated(request: HttpRequest,) -> HttpResponse:
-        user: BMGTUser = _get_session_user(request)
+    async def groups_paginated(request: HttpRequest,) -> HttpResponse:
+        user: BMGTUser = await _aget_session_user(request)
         params = pager_params_from_request(request)
         if user.role == BMGTUser.BMGTUserRole.USER: # normal user only see groups in the same semester
-            data = generic_paginated_query(BMGTGroup, params, semester_id=user.semester.id)
+            data = await ageneric_paginated_query(BMGTGroup, params, semester_id=user.semester.id)
         else:
-            data = generic_paginated_query(BMGTGroup, params)
+            data = await ageneric_paginated_query(BMGTGroup, params)
         return _resolvePaginatedData(data)
     
 
     @request_error_handler
     @require_POST
     @staticmethod
-    def join_group(request: HttpRequest) -> HttpResponse:
+    async def join_group(request: HttpRequest) -> HttpResponse:
         try:
             resp = AppResponse()
-            user: BMGTUser = _get_session_user(request)
+            user: BMGTUser = await _aget_session_user(request)
             data = json.loads(request.body)
             group_id = data['group_id']
             if user.group == None:
-                group = BMGTGroup.objects.get(id=group_id)
+                group = await BMGTGroup.objects.select_related('semester').aget(id=group_id)
                 if user.role == BMGTUser.BMGTUserRole.USER and user.semester_id != group.semester_id:
                     resp.reject("You cannot join a group in another semester!")
                 else:
-                    if group.users.count() >= _MAX_GROUP_SIZE:
+                    if await group.users.acount() >= _MAX_GROUP_SIZE:
                         resp.reject("Group already full!")
                     elif group.is_frozen:
                         resp.reject("Cannot join the group at this time!")
                     else:
                         user.group = group
-                        user.save()
-                        resp.resolve(group)
+                        await sync_to_async(retry_on_locked(user.save))()
+                        resp.resolve(await BMGTGroup.serialization_queryset().aget(id=group.id))   # with the new member
             else:
                 resp.reject("Cannot join another group while you are alreay in a group!")
         except BMGTGroup.DoesNotExist:
@@ -232,16 +295,16 @@ class GroupApi:
     @request_error_handler
     @require_POST
     @staticmethod
-    def leave_group(request: HttpRequest) -> HttpResponse:
+    async def leave_group(request: HttpRequest) -> HttpResponse:
         try:
             resp = AppResponse()
-            user: BMGTUser = _get_session_user(request)
+            user: BMGTUser = await _aget_session_user(request)
             if user.group != None:
                 if user.group.is_frozen:
                     resp.reject("Cannot leave the group at this time!")
                 else:
                     user.group = None
-                    user.save()
+                    await sync_to_async(retry_on_locked(user.save))()
                     resp.resolve("Group left!")
             else:
                 resp.reject("You are not in a group!")
@@ -252,22 +315,15 @@ class GroupApi:
 
 
 class CaseApi:
-    @staticmethod
-    def __case_submittable(case:BMGTCase, group:BMGTGroup) -> bool:
-        count_submission = BMGTCaseRecord.objects.filter(
-                case=case, group=group,
-                state__in=[BMGTCaseRecord.State.RUNNING, BMGTCaseRecord.State.SUCCESS]
-            ).count()
-        return case.max_submission == -1 or count_submission < case.max_submission
-
     @request_error_handler
     @require_GET
+    @conditional_on((CASE_RESOURCE,), cache=True)
     @staticmethod
-    def get(request: HttpRequest) -> HttpResponse:
+    async def get(request: HttpRequest) -> HttpResponse:
         try:
             resp = AppResponse()
             case_id = request.GET.get('case_id', None)
-            case = BMGTCase.objects.get( id=case_id, visible=True)
+            case = await BMGTCase.objects.aget( id=case_id, visible=True)
             resp.resolve(case)
         except BMGTCase.DoesNotExist:
             resp.reject("Case not found!")
@@ -278,9 +334,10 @@ class CaseApi:
 
     @request_error_handler
     @require_GET
+    @conditional_on((CASE_RESOURCE,), cache=True)
     @staticmethod
-    def cases_paginated(request: HttpRequest) -> HttpResponse:
-        data = generic_paginated_query(BMGTCase, pager_params_from_request(request), visible = True)
+    async def cases_paginated(request: HttpRequest) -> HttpResponse:
+        data = await ageneric_paginated_query(BMGTCase, pager_params_from_request(request), visible = True)
         return _resolvePaginatedData(data)
 
 
@@ -297,42 +354,64 @@ class CaseApi:
             case_instance = BMGTCase.objects.get(id=case_id)
             if user.group != None:
                 group = user.group
-                if CaseApi.__case_submittable(case_instance, group):                    
+                if submission_available(case_instance, group):                    
                     # id to simulation case mapping
                     if case_id == 1:     # food center
-                        params = data['case_params']
+                        params = canonical_food_delivery_params(data['case_params'])
+                        config_version = None
                         configQuery = BMGTCaseConfig.objects.filter(case_id=case_id,)
                         if configQuery.exists():
-                            config = json.loads(configQuery.get().config_json)
-                            params['config'] = config
-                        simulation_instance = FoodDelivery(**params)
+                            case_config = configQuery.get()
+                            params['config'] = json.loads(case_config.config_json)
+                            config_version = case_config.edited_time.isoformat()
+                        # every group of a semester is graded against the same precomputed scenarios
+                        bank_tag = scenario_bank_tag(group.semester)
+                        bank = FoodDelivery.scenario_bank(SCENARIO_BANK_PATH, bank_tag)
+                        cache_key = result_cache_key(case_id, params, config_version, bank.name)
+                        FoodDelivery(**params)  # validates the parameters before anything is recorded
                     else:
-                        resp.reject("Case not found!")
-
-                    # create case record first. simulation eligibility is calculated based on valid case records
-                    with transaction.atomic():
-                        case_record = BMGTCaseRecord(
-                            user=user,
-                            case=case_instance, group=group, state=BMGTCaseRecord.State.RUNNING,
-                            file_name = BMGTCaseRecord.get_file_name(group, user, case_instance),
+                        raise BMGTCase.DoesNotExist
+
+                    # shed new work the simulation tier cannot finish in time, rather than queueing it
+                    load = simulation_load()
+                    if load['saturated']:
+                        resp = AppResponse(
+                            status=HTTPStatus.SERVICE_UNAVAILABLE,
+                            reject="The simulation server is busy. Please retry later.",
+                        )
+                        resp['Retry-After'] = str(math.ceil(load['retry_after']))
+                        return resp
+
+                    # identical inputs under the same config and scenarios always produce the same result
+                    cached = RESULT_CACHE.get(cache_key)
+
+                    # create case record first. simulation eligibility is calculated based on valid case records.
+                    # cached results count against the admission limits of the group too, so they cannot bypass them
+                    case_record, retry_after = _record_submission(user, case_instance, group)
+                    if retry_after > 0:
+                        retry_after = math.ceil(retry_after)
+                        resp = AppResponse(
+                            status=HTTPStatus.TOO_MANY_REQUESTS,
+                            reject=f"Your group has too many simulations in progress. Please retry in {retry_after} seconds.",
                         )
-                        case_record.save()
-
-                    # run simulation
-                    res = simulation_instance.run()
-                    caseRecordStream = res.asFileStream()
-                    caseSummary = res.asDict()
-                    case_record.summary_dict = caseSummary
-                    with open(_CASE_RECORD_PATH + case_record.file_name, "wb") as file:
-                        file.write(caseRecordStream.getvalue())
-                    case_record.state = BMGTCaseRecord.State.SUCCESS
-                    case_record.score = res.score
-                    case_record.performance_metric = res.performance_metric
-                    case_record.save()
+                        resp['Retry-After'] = str(retry_after)
+                        return resp
+                    if case_record is None:
+                        return AppResponse(reject="You have reached the maximum submission for this case!")
+
+                    if cached is not None:
+                        complete_case_record(case_record, cached)
+                    else:
+                        # the simulation runs in the background. clients follow the record through case-records/get
+                        dispatch_case_record(case_record, params, bank_tag, cache_key)
+                        case_record.refresh_from_db()
+
                     resp.resolve({
                         "case_record_id": case_record.id,
-                        "summary": case_record.summary_dict,
+                        "state": BMGTCaseRecord.State(case_record.state).label,
+                        "summary": case_record.summary,
                         "file_name": case_record.file_name,
+                        "cached": cached is not None,
                         })
                 else:
                     resp.reject("You have reached the maximum submission for this case!")
@@ -342,27 +421,22 @@ class CaseApi:
         except BMGTUser.DoesNotExist:
             resp.reject("Invalid credential!")
             if case_record:
-                case_record.state = BMGTCaseRecord.State.FAILED
-                case_record.save()
+                fail_case_records(BMGTCaseRecord.objects.filter(id=case_record.id))
         except BMGTCase.DoesNotExist:
             resp.reject("Case not found!")
             if case_record:
-                case_record.state = BMGTCaseRecord.State.FAILED
-                case_record.save()
+                fail_case_records(BMGTCaseRecord.objects.filter(id=case_record.id))
         except KeyError:
             resp.reject("Invalid data format!")
             if case_record:
-                case_record.state = BMGTCaseRecord.State.FAILED
-                case_record.save()
+                fail_case_records(BMGTCaseRecord.objects.filter(id=case_record.id))
         except SimulationException as e:
             resp.reject(f"{e.args[0]}")
             if case_record:
-                case_record.state = BMGTCaseRecord.State.FAILED
-                case_record.save()
+                fail_case_records(BMGTCaseRecord.objects.filter(id=case_record.id))
         except Exception:
             if case_record:
-                case_record.state = BMGTCaseRecord.State.FAILED
-                case_record.save()
+                fail_case_records(BMGTCaseRecord.objects.filter(id=case_record.id))
             
             raise
             
@@ -377,7 +451,7 @@ class CaseRecordApi:
             resp = AppResponse()
             case_record_id = request.GET.get('id', None)
             case_record = BMGTCaseRecord.objects.get(id=case_record_id, )
-            resp.resolve(case_record)
+            resp.resolve(case_record_state(case_record))    # the summary is None until the simulation completes
         except BMGTCaseRecord.DoesNotExist:
             resp.reject("Case record not found!")
         except KeyError:
@@ -385,50 +459,74 @@ class CaseRecordApi:
 
         return resp
 
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    async def progress_stream(request: HttpRequest) -> HttpResponse:
+        """
+        server-sent events of a running case record, to be followed instead of polling case-records/get
+        """
+        try:
+            case_record_id = int(request.GET['id'])
+            await BMGTCaseRecord.objects.aget(id=case_record_id)
+            resp = StreamingHttpResponse(case_record_events(case_record_id), content_type='text/event-stream')
+            resp['Cache-Control'] = 'no-cache'
+            resp['X-Accel-Buffering'] = 'no'    # keeps reverse proxies from buffering the events
+            return resp
+        except BMGTCaseRecord.DoesNotExist:
+            return AppResponse(reject="Case record not found!")
+        except KeyError:
+            return AppResponse(reject="Invalid data format!")
+
     @request_error_handler
     @require_GET
     @staticmethod
     def download_case_record(request: HttpRequest, file_name:str) -> HttpResponse:
-        full_path = _CASE_RECORD_PATH + file_name
-        if os.path.exists(full_path):
+        full_path = CASE_RECORD_PATH + file_name
+        if file_name.endswith(CHECKPOINT_SUFFIX):
+            # checkpoints sit next to the records they resume from, but are internal to the simulation
+            return AppResponse(reject="File not found!")
+        elif os.path.exists(full_path):
             with open(full_path, 'rb') as file:
                 response = HttpResponse(file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',)
                 return response
         else:
-            return AppResponse().reject("File not found!")
+            return AppResponse(reject="File not found!")
         
 
     @request_error_handler
     @require_GET
     @staticmethod
-    def case_records_paginated(request: HttpRequest) -> HttpResponse:
+    async def case_records_paginated(request: HttpRequest) -> HttpResponse:
         resp = AppResponse()
-        user: BMGTUser = _get_session_user(request)
+        user: BMGTUser = await _aget_session_user(request)
         if not user.group:
             resp.reject("You must join a group to view case records!")
         else:
             pagerParams = pager_params_from_request(request)
-            data = generic_paginated_query(BMGTCaseRecord, pagerParams, state=BMGTCaseRecord.State.SUCCESS, group_id=user.group.id)
+            data = await ageneric_paginated_query(BMGTCaseRecord, pagerParams, state=BMGTCaseRecord.State.SUCCESS, group_id=user.group.id)
             _resolvePaginatedData(data, resp=resp)
         return resp
 
     @request_error_handler
     @require_GET
-    def leader_board_paginated(request: HttpRequest) -> HttpResponse:
+    @conditional_on(_leaderboard_resources, cache=True)
+    async def leader_board_paginated(request: HttpRequest) -> HttpResponse:
+        """
+        ranked successful records of the user's semester. per_group=1 lists only the best record of each group,
+        fields=rank,group_name,... lists only the given keys of each record
+        """
         try:
             resp = AppResponse()
             case_id = int(request.GET.get('case_id'))
-            user = _get_session_user(request)
+            user = await _aget_session_user(request)
             if case_id == 1:
                 page = int(request.GET.get('page', None))
                 size = int(request.GET.get('size', None))
-                query_params = create_pager_params(page, size, ['-performance_metric', '-score'])
-                data = generic_paginated_query(
-                    BMGTCaseRecord, query_params,
-                    user__semester=user.semester,
-                    state=BMGTCaseRecord.State.SUCCESS,
-                    case_id=case_id,
-                    )
+                if not size > 0:
+                    raise ValueError("invalid page size")
+                per_group = request.GET.get('per_group', '0') in ('1', 'true')
+                data = await sync_to_async(leaderboard_page)(case_id, user.semester_id, page, size, per_group=per_group, fields=fields_from_request(request))
                 resp.resolve(data)
             else:
                 raise BMGTCase.DoesNotExist
@@ -439,6 +537,23 @@ class CaseRecordApi:
 
         return resp
 
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    async def leader_board_rank(request: HttpRequest) -> HttpResponse:
+        """
+        best ranked record of the user's group, with null ranks if the group has none
+        """
+        resp = AppResponse()
+        case_id = int(request.GET['case_id'])
+        user = await _aget_session_user(request)
+        if not user.group_id:
+            resp.reject("You must join a group to view your rank!")
+        else:
+            entry = await sync_to_async(group_leaderboard_entry)(case_id, user.semester_id, user.group_id)
+            resp.resolve(entry.as_dictionary() if entry else {'rank': None, 'group_rank': None})
+        return resp
+
 
 class ManageApi:
 
@@ -460,7 +575,7 @@ class ManageApi:
                     obj_set = [BMGTUser(semester = semester, **row)
                                 for row in user_csv.to_dict('records')]
 
-                    created_set = BMGTUser.objects.bulk_create(obj_set)
+                    created_set = retry_on_locked(BMGTUser.objects.bulk_create)(obj_set)
                     resp.resolve(f"Imported {len(created_set)} users!")
                 else:
                     resp.reject("Import failed! Please upload a CSV file that contains the following columns: user_first_name, user_last_name, directory_id")
@@ -494,7 +609,7 @@ class ManageApi:
                 if FoodDelivery.is_config_valid(configObj):
                     config.config_json = json.dumps(configObj)
                     config.edited_time = timezone.now()
-                    config.save()
+                    retry_on_locked(config.save)()
                     resp.resolve("New map applied!")
                 else:
                     resp.reject("Invalid case configuration!")
@@ -513,6 +628,7 @@ class ManageApi:
 
     @request_error_handler
     @require_GET
+    @conditional_on((CASE_CONFIG_RESOURCE, CASE_RESOURCE), cache=True)
     @staticmethod
     def  view_case_config(request: HttpRequest) -> HttpResponse:
         pager_params = pager_params_from_request(request)
@@ -528,7 +644,7 @@ class ManageApi:
         visible = bool(data['visible'])
         caseObj = BMGTCase.objects.get(id=case_id)
         caseObj.visible = visible
-        caseObj.save()
+        retry_on_locked(caseObj.save)()
         resp = AppResponse()
         resp.resolve(f"Case visibility set to {visible}!")
         return resp
@@ -558,6 +674,25 @@ class ManageApi:
     def view_users(request: HttpRequest) -> HttpResponse:
         data = generic_paginated_query(BMGTUser, pager_params_from_request(request))
         return _resolvePaginatedData(data)
+
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    def export_users(request: HttpRequest) -> HttpResponse:
+        """
+        every user, streamed as one json document
+        """
+        return AppStreamingResponse(request, iterate_serialized(BMGTUser, BMGTUser.objects.order_by('id'), fields_from_request(request)), filename='users.json')
+
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    def export_transactions(request: HttpRequest) -> HttpResponse:
+        """
+        the transaction log, streamed as one json document
+        """
+        transactions = BMGTTransaction.objects.order_by('id')
+        return AppStreamingResponse(request, iterate_serialized(BMGTTransaction, transactions, fields_from_request(request)), filename='transactions.json')
     
     @request_error_handler
     @require_POST
@@ -571,8 +706,7 @@ class ManageApi:
             if users.filter(role = BMGTUser.BMGTUserRole.ADMIN).exists():
                 resp.reject("Cannot delete admin users!") 
             else:
-                with transaction.atomic():
-                    users.delete()
+                retry_on_locked(users.delete)()
                 resp.resolve("Users deleted!")
         except BMGTUser.DoesNotExist:
             resp.reject("User not found!")
@@ -583,6 +717,7 @@ class ManageApi:
 
     @request_error_handler
     @require_GET
+    @conditional_on((SYSTEM_RESOURCE,), cache=True)
     @staticmethod
     def view_system_state(request: HttpRequest) -> HttpResponse:
         try:
@@ -604,7 +739,7 @@ class ManageApi:
             system = BMGTSystemStatus.objects.get(id=1)
             for key, value in data.items():
                 system.__setattr__(key, value)
-            system.save()
+            retry_on_locked(system.save)()
             resp.resolve("System updated!")
         except BMGTSystemStatus.DoesNotExist:
             resp.reject("System not found!")
@@ -623,7 +758,7 @@ class ManageApi:
             max_submission = int(data['max_submission'])
             case = BMGTCase.objects.get(id=case_id)
             case.max_submission = max_submission
-            case.save()
+            retry_on_locked(case.save)()
             resp.resolve(f"Case submission set to {max_submission}!")
         except BMGTCase.DoesNotExist:
             resp.reject("Case not found!")
@@ -672,6 +807,18 @@ class ManageApi:
             resp.reject("Invalid data format!")
 
         return resp
+
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    def export_case_submissions(request: HttpRequest) -> HttpResponse:
+        """
+        every submission, or those of the case given by case_id, streamed as one json document
+        """
+        records = BMGTCaseRecord.objects.order_by('id')
+        if request.GET.get('case_id'):
+            records = records.filter(case_id=int(request.GET['case_id']))
+        return AppStreamingResponse(request, iterate_serialized(BMGTCaseRecord, records, fields_from_request(request)), filename='case-submissions.json')
     
 
     @request_error_handler
@@ -687,7 +834,7 @@ class ManageApi:
                 resp.reject("Failed to create semester. Semester already exists!")
             else:
                 semester = BMGTSemester(year=year, season=season)
-                semester.save()
+                retry_on_locked(semester.save)()
                 resp.resolve("Semester created successfully!")
         except IntegrityError:
             resp.reject("Failed to create semester. Invalid semester arguments!")
@@ -706,7 +853,9 @@ class ManageApi:
             data = json.loads(request.body)
             arr_semester_id = data['arr_semester_id']
             semester = BMGTSemester.objects.filter(id__in=arr_semester_id)
-            semester.delete()
+            # the leaderboards of the semesters are deleted with them
+            with deferred_ranking():
+                retry_on_locked(semester.delete)()
             resp.resolve("Semester deleted!")
         except BMGTSemester.DoesNotExist:
             resp.reject("Semester not found!")
@@ -719,6 +868,7 @@ class ManageApi:
     
     @request_error_handler
     @require_GET
+    @conditional_on((SEMESTER_RESOURCE,), cache=True)
     @staticmethod
     def get_semesters(request: HttpRequest) -> HttpResponse:
         try:
@@ -742,7 +892,7 @@ class ManageApi:
             size = int(data['size'])
             semester = BMGTSemester.objects.get(id=semester_id)
             max_group_num = BMGTGroup.objects.filter(semester_id = semester_id).aggregate(max_value=Max('number'))['max_value'] or 0
-            BMGTGroup.objects.bulk_create(
+            retry_on_locked(BMGTGroup.objects.bulk_create)(
                 [BMGTGroup(number=max_group_num + i + 1, semester=semester) for i in range(size)]
             )
             resp.resolve("Groups created!")
@@ -769,9 +919,8 @@ class ManageApi:
             resp = AppResponse()
             data = json.loads(request.body)
             arr_group_id = data.get('arr_group_id', None)
-            with transaction.atomic():
-                groups = BMGTGroup.objects.filter(id__in=arr_group_id)
-                groups.delete()
+            groups = BMGTGroup.objects.filter(id__in=arr_group_id)
+            retry_on_locked(groups.delete)()
             resp.resolve("Group deleted!")
         except BMGTGroup.DoesNotExist:
             resp.reject("Group not found!")
@@ -780,15 +929,40 @@ class ManageApi:
         return resp
     
 
+class HealthApi:
+
+    @request_error_handler
+    @require_GET
+    @staticmethod
+    def ready(request: HttpRequest) -> HttpResponse:
+        """
+        readiness probe of load balancers. not ready while the simulation queue is saturated or the database is unreachable
+        """
+        try:
+            load = simulation_load()
+        except OperationalError as e:
+            return AppResponse(status=HTTPStatus.SERVICE_UNAVAILABLE, reject=e.args[0])
+        resp = AppResponse(status=HTTPStatus.SERVICE_UNAVAILABLE if load['saturated'] else HTTPStatus.OK)
+        resp.resolve(load)
+        if load['saturated']:
+            resp['Retry-After'] = str(math.ceil(load['retry_after']))
+        return resp
+
+
 def apiStartUp():
     # handle previous case records that do not have performance metric
     records = BMGTCaseRecord.objects.filter(performance_metric__isnull=True, state = BMGTCaseRecord.State.SUCCESS)
     if records.exists():
         for r in records:
-            summary = json.loads(r.summary_dict.replace("\'", "\""))
-            r.performance_metric = summary['perf_metric']
+            r.performance_metric = r.summary['perf_metric']
             r.save()
 
+    # records left running by a process that stopped before finishing them
+    try:
+        fail_stale_case_records()
+    except DatabaseError:   # the tables and columns these use do not exist until migrations are applied
+        pass
+
     # create default case objects if not exist
     try:
         BMGTCase.objects.get(id=_FOOD_DELIVERY_CASE_ID)
@@ -3,7 +3,10 @@ from django.db.models import QuerySet
 from django.conf import settings
 from django.utils import timezone
 from .apps import BmgtPlatformConfig
+from typing import Callable, Iterable, Union
+import ast
 import datetime
+import json
 
 
 """
@@ -14,6 +17,23 @@ import datetime
 
 APP_LABEL = BmgtPlatformConfig.name
 
+# a key of as_dictionary read from one column, or computed by a function of several columns
+ValueProjection = Union[str, tuple[tuple[str, ...], Callable]]
+
+
+def format_time(value: datetime.datetime) -> str:
+    return timezone.make_naive(value).isoformat(sep=' ', timespec='seconds')
+
+
+def prefixed_projection(projection: dict[str, ValueProjection], prefix: str) -> dict[str, ValueProjection]:
+    """
+    projection of a model read through a relation, e.g. 'case_record__'
+    """
+    return {
+        key: prefix + value if isinstance(value, str) else (tuple(prefix + column for column in value[0]), value[1])
+        for key, value in projection.items()
+    }
+
 
 class BMGTModelBase(models.Model):
     class Meta:
@@ -24,6 +44,83 @@ class BMGTModelBase(models.Model):
     id = models.AutoField(auto_created=True, primary_key=True, null=False)
     create_time = models.DateTimeField(auto_created=True, default=timezone.now, null=False)
 
+    # relations read by as_dictionary. queries that serialize their rows load them along with the rows
+    serialized_select_related: tuple[str, ...] = ()
+    serialized_prefetch_related: tuple[Union[str, models.Prefetch], ...] = ()
+    # as_dictionary projected onto columns, so that lists are serialized from values() rows without building models
+    serialized_values: dict[str, ValueProjection] = {}
+
+    @classmethod
+    def serialization_queryset(cls, queryset: QuerySet = None) -> QuerySet:
+        """
+        queryset of the model, or the given one, that serializes its rows without further queries
+        """
+        queryset = cls.objects.all() if queryset is None else queryset
+        return queryset.select_related(*cls.serialized_select_related).prefetch_related(*cls.serialized_prefetch_related)
+
+    @staticmethod
+    def restrict_fields(rows: list[dict], fields: list[str] = None) -> list[dict]:
+        """
+        serialized rows restricted to the given keys, for models serialized through as_dictionary
+        """
+        if fields is None or not rows:
+            return rows
+        unknown = [field for field in fields if field not in rows[0]]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        return [{field: row[field] for field in fields} for row in rows]
+
+    @classmethod
+    def serialized_projection(cls, fields: list[str] = None) -> dict[str, ValueProjection]:
+        """
+        serialized_values restricted to the given keys of as_dictionary, all of them if fields is None
+        """
+        if fields is None:
+            return cls.serialized_values
+        unknown = [field for field in fields if field not in cls.serialized_values]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        return {field: cls.serialized_values[field] for field in fields}
+
+    @classmethod
+    def serialized_columns(cls, fields: list[str] = None) -> list[str]:
+        """
+        columns read by serialized_values, or by the given keys of it
+        """
+        columns = []
+        for projection in cls.serialized_projection(fields).values():
+            for column in (projection,) if isinstance(projection, str) else projection[0]:
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
+    @classmethod
+    def serialize_row(cls, row: dict, fields: list[str] = None) -> dict:
+        """
+        as_dictionary of a row read with the serialized columns, restricted to the given keys
+        """
+        return {
+            key: row[projection] if isinstance(projection, str) else projection[1](*[row[column] for column in projection[0]])
+            for key, projection in cls.serialized_projection(fields).items()
+        }
+
+    @classmethod
+    def serialize_rows(cls, rows: Iterable[dict], fields: list[str] = None) -> list[dict]:
+        """
+        as_dictionary of values() rows read with the serialized columns, restricted to the given keys
+        """
+        return [cls.serialize_row(row, fields) for row in rows]
+
+    @classmethod
+    def serialize_queryset(cls, queryset: QuerySet, fields: list[str] = None) -> list[dict]:
+        """
+        as_dictionary of every row of the queryset, restricted to the given keys.
+        models declaring serialized_values are read with values(), joining only the relations the keys need
+        """
+        if not cls.serialized_values:
+            return cls.restrict_fields([obj.as_dictionary() for obj in cls.serialization_queryset(queryset)], fields)
+        return cls.serialize_rows(queryset.values(*cls.serialized_columns(fields)), fields)
+
     def as_dictionary(self) -> dict:
         """
         global interface for json serialization
@@ -34,7 +131,7 @@ class BMGTModelBase(models.Model):
 
     @property
     def formatted_create_time(self):
-        return timezone.make_naive(self.create_time).isoformat(sep=' ', timespec='seconds')
+        return format_time(self.create_time)
     
 
 class BMGTJsonField(models.TextField):
@@ -61,9 +158,20 @@ class BMGTSemester(BMGTModelBase):
         ("spring", "spring"), ("summer", "summer"), ("fall", "fall"),
     ])
 
+    serialized_values = {
+        'id': 'id',
+        'year': 'year',
+        'season': 'season',
+        'name': (('year', 'season'), lambda year, season: BMGTSemester.format_name(year, season)),
+    }
+
+    @staticmethod
+    def format_name(year: int, season: str) -> str:
+        return f"{year}-{season}"
+
     @property
     def name(self) -> str:
-        return f"{self.year}-{self.season}"
+        return self.format_name(self.year, self.season)
 
     def as_dictionary(self) -> dict:
         return {
@@ -76,17 +184,62 @@ class BMGTSemester(BMGTModelBase):
 
 class BMGTGroup(BMGTModelBase):
 
+    serialized_select_related = ('semester',)
+
     is_frozen = models.BooleanField(default=False, null=False)  # if true, no user can join this group
     number = models.IntegerField(null=False, unique=False)  # group number
     semester = models.ForeignKey(BMGTSemester, on_delete=models.RESTRICT, null=False)
 
     @property
     def users(self) -> QuerySet:
-        return BMGTUser.objects.filter(group_id=self.id)
+        """
+        members of the group, served from the prefetched roster if there is one
+        """
+        return self.bmgtuser_set.all()
+
+    @classmethod
+    def serialization_queryset(cls, queryset: QuerySet = None) -> QuerySet:
+        # one query loads the rosters of all the groups. the group of each member is set from the prefetch
+        return super().serialization_queryset(queryset).prefetch_related(
+            models.Prefetch('bmgtuser_set', queryset=BMGTUser.objects.select_related('semester')),
+        )
     
+    serialized_values = {
+        'id': 'id',
+        'name': (('number',), lambda number: BMGTGroup.format_name(number)),
+        'is_frozen': 'is_frozen',
+        'semester_id': 'semester_id',
+        'semester_name': (('semester__year', 'semester__season'), lambda year, season: BMGTSemester.format_name(year, season)),
+    }
+
+    @classmethod
+    def serialized_columns(cls, fields: list[str] = None) -> list[str]:
+        if fields is None or 'users' not in fields:
+            return super().serialized_columns(fields)
+        # rosters are matched to the groups by id
+        return list(dict.fromkeys(['id', *super().serialized_columns([field for field in fields if field != 'users'])]))
+
+    @classmethod
+    def serialize_rows(cls, rows: Iterable[dict], fields: list[str] = None) -> list[dict]:
+        # one query reads the rosters of all the groups, unless the users are left out
+        if fields is not None and 'users' not in fields:
+            return super().serialize_rows(rows, fields)
+        rows = list(rows)
+        groups = super().serialize_rows(rows, None if fields is None else [field for field in fields if field != 'users'])
+        rosters = {row['id']: [] for row in rows}
+        for user in BMGTUser.serialize_queryset(BMGTUser.objects.filter(group_id__in=rosters.keys()).order_by('id')):
+            rosters[user['group_id']].append(user)
+        for row, group in zip(rows, groups):
+            group['users'] = rosters[row['id']]
+        return groups
+
+    @staticmethod
+    def format_name(number: int) -> str:
+        return f"Group {number}"
+
     @property
     def name(self) -> str:
-        return f"Group {self.number}"
+        return self.format_name(self.number)
 
     def as_dictionary(self) -> dict:
         return {
@@ -101,6 +254,8 @@ class BMGTGroup(BMGTModelBase):
 
 class BMGTUser(BMGTModelBase):
 
+    serialized_select_related = ('group', 'semester')
+
     class BMGTUserRole(models.TextChoices):
         ADMIN = 'admin'
         USER = 'user'
@@ -113,19 +268,38 @@ class BMGTUser(BMGTModelBase):
     role = models.CharField(choices=BMGTUserRole.choices, default=BMGTUserRole.USER, null=False, max_length=5)
     group = models.ForeignKey(BMGTGroup, on_delete=models.SET_NULL, null=True)
     semester = models.ForeignKey(BMGTSemester, on_delete=models.RESTRICT, null=True)  # allow null for admin
-
-    @property
-    def name(self):
-        if self.first_name and self.last_name:
-            name = self.first_name + " " + self.last_name
-        elif self.first_name:
-            name = self.first_name
-        elif self.last_name:
-            name = self.last_name
+    auth_version = models.IntegerField(default=0, null=False)  # bumped to revoke the session tokens issued so far
+
+    serialized_values = {
+        'id': 'id',
+        'create_time': (('create_time',), format_time),
+        'did': 'did',
+        'activated': 'activated',
+        'first_name': 'first_name',
+        'last_name': 'last_name',
+        'role': 'role',
+        'group_id': 'group_id',
+        'group_name': (('group__number',), lambda number: None if number is None else BMGTGroup.format_name(number)),
+        'semester_id': 'semester_id',
+        'semester_name': (('semester__year', 'semester__season'), lambda year, season: None if year is None else BMGTSemester.format_name(year, season)),
+    }
+
+    @staticmethod
+    def format_name(first_name: str, last_name: str) -> str:
+        if first_name and last_name:
+            name = first_name + " " + last_name
+        elif first_name:
+            name = first_name
+        elif last_name:
+            name = last_name
         else:
             name = "Anonymous"
         return name
 
+    @property
+    def name(self):
+        return self.format_name(self.first_name, self.last_name)
+
     def as_dictionary(self) -> dict:
         return dict(
             id=self.id,
@@ -150,6 +324,12 @@ class BMGTCase(BMGTModelBase):
     visible = models.BooleanField(default=True, null=False)
     max_submission = models.IntegerField(default=5, null=False, unique=False)
 
+    serialized_values = {
+        'id': 'id',
+        'create_time': (('create_time',), format_time),
+        'name': 'name',
+    }
+
     def as_dictionary(self,) -> dict:
         return dict(
             id=self.id,
@@ -165,6 +345,16 @@ class BMGTCaseConfig(BMGTModelBase):
         constraints = [
             models.UniqueConstraint(fields=('case_id',), name='unique_case_config'),
         ]
+
+    serialized_select_related = ('case',)
+    serialized_values = {
+        'id': 'id',
+        'create_time': (('create_time',), format_time),
+        'edited_time': (('edited_time',), format_time),
+        'case_id': 'case_id',
+        'case_name': 'case__name',
+        'config_json': 'config_json',
+    }
     
     case = models.ForeignKey(BMGTCase, on_delete=models.CASCADE, null=False)
     config_json = BMGTJsonField(null=False, default="", unique=False)  # editable configuration regarding a case
@@ -174,7 +364,7 @@ class BMGTCaseConfig(BMGTModelBase):
         return dict(
             id=self.id,
             create_time=self.formatted_create_time,
-            edited_time=timezone.make_naive(self.edited_time).isoformat(sep=' ', timespec='seconds'),
+            edited_time=format_time(self.edited_time),
             case_id=self.case.id if self.case else None,
             case_name=self.case.name if self.case else None,
             config_json=self.config_json,
@@ -183,6 +373,29 @@ class BMGTCaseConfig(BMGTModelBase):
 
 class BMGTCaseRecord(BMGTModelBase):
 
+    serialized_select_related = ('group', 'user', 'case')
+    serialized_values = {
+        'id': 'id',
+        'create_time': (('create_time',), format_time),
+        'group_id': 'group_id',
+        'user_id': 'user_id',
+        'user_name': (('user_id', 'user__first_name', 'user__last_name'), lambda user_id, first_name, last_name: 'Unknown user' if user_id is None else BMGTUser.format_name(first_name, last_name)),
+        'group_name': (('group__number',), lambda number: 'Unknown group' if number is None else BMGTGroup.format_name(number)),
+        'case_id': 'case_id',
+        'case_name': (('case_id', 'case__name'), lambda case_id, name: 'Unknown case' if case_id is None else name),
+        'state': (('state',), lambda state: BMGTCaseRecord.State.choices[state][1]),
+        'score': 'score',
+        'performance_metric': 'performance_metric',
+        'file_name': 'file_name',
+    }
+
+    class Meta:
+        app_label = APP_LABEL
+        indexes = [
+            models.Index(fields=('case', 'group', 'state'), name='case_record_submission_index'),
+            models.Index(fields=('group', 'state'), name='case_record_group_index'),
+        ]
+
     class State(models.IntegerChoices):
         RUNNING = 0
         SUCCESS = 1
@@ -202,13 +415,28 @@ class BMGTCaseRecord(BMGTModelBase):
         BMGTUser, on_delete=models.SET_NULL, null=True,)
     case = models.ForeignKey(
         BMGTCase, on_delete=models.CASCADE, null=True,)
+    semester = models.ForeignKey(
+        BMGTSemester, on_delete=models.SET_NULL, null=True,)  # semester of the submitting user, so records are filtered by semester without joining users
     score = models.FloatField(null=True, default=None)
     performance_metric = models.FloatField(null=True, default=None)
     state = models.IntegerField(
         State.choices, default=State.RUNNING, null=False)
     summary_dict = models.TextField(null=False, default="")
+    progress_json = BMGTJsonField(null=False, default="")   # latest progress event of a running simulation, read by the progress streams of every process
     file_name = models.CharField(max_length=30, null=False, auto_created=False, editable=False, unique=True)
 
+    @property
+    def summary(self) -> Union[dict, None]:
+        """
+        summary of a successful simulation, None otherwise
+        """
+        if self.state != self.State.SUCCESS or not self.summary_dict:
+            return None
+        try:
+            return json.loads(self.summary_dict)
+        except json.JSONDecodeError:
+            return ast.literal_eval(self.summary_dict)  # summaries of older records are stored as python literals
+
     def as_dictionary(self) -> dict:
 
         return dict(
@@ -227,8 +455,123 @@ class BMGTCaseRecord(BMGTModelBase):
         )
 
 
+class BMGTSubmissionQuota(BMGTModelBase):
+    """
+    submissions of a group counted against the submission limit of a case, i.e. its running and successful records
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+        constraints = [
+            models.UniqueConstraint(fields=('group', 'case'), name='unique_submission_quota'),
+        ]
+
+    group = models.ForeignKey(BMGTGroup, on_delete=models.CASCADE, null=False)
+    case = models.ForeignKey(BMGTCase, on_delete=models.CASCADE, null=False)
+    used = models.IntegerField(default=0, null=False)
+
+    def as_dictionary(self) -> dict:
+        return dict(
+            id=self.id,
+            create_time=self.formatted_create_time,
+            group_id=self.group_id,
+            case_id=self.case_id,
+            used=self.used,
+        )
+
+
+class BMGTSimulationJob(BMGTModelBase):
+    """
+    queued simulation of a case record. workers on any host claim jobs under a lease that they renew by heartbeat
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+        indexes = [
+            models.Index(fields=('state', 'id'), name='simulation_job_claim_index'),
+            models.Index(fields=('state', 'lease_expire_time'), name='simulation_job_lease_index'),
+        ]
+
+    class State(models.IntegerChoices):
+        QUEUED = 0
+        CLAIMED = 1
+        DONE = 2
+        DEAD = 3
+
+    case_record = models.OneToOneField(BMGTCaseRecord, on_delete=models.CASCADE, null=False)
+    job_args = BMGTJsonField(null=False, default="{}")  # arguments of the simulation job
+    state = models.IntegerField(State.choices, default=State.QUEUED, null=False)
+    attempts = models.IntegerField(default=0, null=False)   # number of times the job has been claimed
+    max_attempts = models.IntegerField(default=3, null=False)
+    lease_owner = models.CharField(max_length=100, null=False, default="")
+    lease_expire_time = models.DateTimeField(null=True, default=None)
+    last_error = models.TextField(null=False, default="")
+
+    def as_dictionary(self) -> dict:
+        return dict(
+            id=self.id,
+            create_time=self.formatted_create_time,
+            case_record_id=self.case_record_id,
+            state=self.State(self.state).label,
+            attempts=self.attempts,
+            max_attempts=self.max_attempts,
+            lease_owner=self.lease_owner,
+            last_error=self.last_error,
+        )
+
+
+class BMGTLeaderboardEntry(BMGTModelBase):
+    """
+    successful case record ranked on the leaderboard of its case and semester.
+    ranks are precomputed when a record succeeds so that leaderboard pages are read by rank
+    """
+
+    serialized_select_related = ('case_record', 'case_record__group', 'case_record__user', 'case_record__case')
+    serialized_values = {
+        **prefixed_projection(BMGTCaseRecord.serialized_values, 'case_record__'),
+        'rank': 'rank',
+        'group_rank': 'group_rank',
+    }
+
+    class Meta:
+        app_label = APP_LABEL
+        indexes = [
+            models.Index(fields=('case', 'semester', 'rank'), name='leaderboard_rank_index'),
+            models.Index(fields=('case', 'semester', 'group_rank'), name='leaderboard_group_rank_index'),
+        ]
+
+    case_record = models.OneToOneField(BMGTCaseRecord, on_delete=models.CASCADE, null=False)
+    case = models.ForeignKey(BMGTCase, on_delete=models.CASCADE, null=False)
+    semester = models.ForeignKey(BMGTSemester, on_delete=models.CASCADE, null=False)
+    group = models.ForeignKey(BMGTGroup, on_delete=models.SET_NULL, null=True)
+    performance_metric = models.FloatField(null=False)
+    score = models.FloatField(null=True, default=None)
+    rank = models.IntegerField(null=False, default=0)   # position among all records of the case and semester, from 1
+    group_rank = models.IntegerField(null=True, default=None)   # position among the best record of each group, None unless the group's best
+
+    def as_dictionary(self) -> dict:
+        return dict(
+            **self.case_record.as_dictionary(),
+            rank=self.rank,
+            group_rank=self.group_rank,
+        )
+
+
 class BMGTTransaction(BMGTModelBase):
 
+    serialized_select_related = ('user',)
+    serialized_values = {
+        'id': 'id',
+        'create_time': (('create_time',), format_time),
+        'user_id': 'user_id',
+        'user_name': (('user_id', 'user__first_name', 'user__last_name'), lambda user_id, first_name, last_name: None if user_id is None else BMGTUser.format_name(first_name, last_name)),
+        'method': 'method',
+        'path': 'path',
+        'status_code': 'status_code',
+        'ip': 'ip',
+        'device': 'device',
+    }
+
     DEVICE_MAX_LENGTH = 20
     IP_MAX_LENGTH = 20
     
@@ -260,6 +603,22 @@ class BMGTTransaction(BMGTModelBase):
         )
     
 
+class BMGTResourceVersion(BMGTModelBase):
+    """
+    counter bumped whenever a cached resource changes, from which the ETags of its responses are derived
+    """
+
+    name = models.CharField(max_length=100, null=False, unique=True)
+    version = models.IntegerField(default=0, null=False)
+
+    def as_dictionary(self) -> dict:
+        return dict(
+            id=self.id,
+            name=self.name,
+            version=self.version,
+        )
+
+
 class BMGTSystemStatus(BMGTModelBase):
 
     allow_join_group = models.BooleanField(default=True, null=False)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from bmgt435_elp.utils.leaderboardUtils import backfill_case_record_semesters, rebuild_leaderboards
+
+
+class Command(BaseCommand):
+    help = "Fills in the semester of case records saved before records kept their own, then ranks the successful records " \
+        "that are not on a leaderboard yet. run once after migrating, running it again only finds nothing left to do"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="case records updated per statement")
+
+    def handle(self, *args, **options):
+        filled = backfill_case_record_semesters(batch_size=options['batch_size'])
+        self.stdout.write(f"backfilled the semester of {filled} case records")
+        ranked = rebuild_leaderboards()
+        self.stdout.write(f"ranked {ranked} case records")
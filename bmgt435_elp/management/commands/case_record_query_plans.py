@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from bmgt435_elp.utils.leaderboardUtils import backfill_case_record_semesters
+from bmgt435_elp.bmgtModels import BMGTCase, BMGTCaseRecord, BMGTGroup, BMGTSemester, BMGTUser
+
+import random
+import time
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Prints the query plans and timings of the hot case record queries on a synthetic multi-semester dataset, " \
+        "without and with the case record indexes. the dataset is rolled back afterwards"
+
+    __SEASONS = ('spring', 'summer', 'fall')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semesters', type=int, default=6)
+        parser.add_argument('--groups', type=int, default=30, help="groups per semester")
+        parser.add_argument('--records', type=int, default=40, help="case records per group")
+        parser.add_argument('--repeat', type=int, default=20, help="runs of each query to average")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                group = self.__populate(options['semesters'], options['groups'], options['records'])
+                started = time.perf_counter()
+                filled = backfill_case_record_semesters()
+                self.stdout.write(f"backfilled the semester of {filled} case records in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+                if connection.features.can_rollback_ddl:
+                    self.__execute_index_sql('remove_sql')
+                    self.__report("without indexes", group, options['repeat'])
+                    self.__execute_index_sql('create_sql')
+                else:
+                    self.stdout.write(f"{connection.vendor} cannot roll back schema changes, skipping the plans without indexes")
+                self.__report("with indexes", group, options['repeat'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def __execute_index_sql(self, statement: str) -> None:
+        # the statements are run directly since a schema editor cannot be opened inside the transaction on every backend
+        editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for index in BMGTCaseRecord._meta.indexes:
+                cursor.execute(str(getattr(index, statement)(BMGTCaseRecord, editor)))
+
+    def __populate(self, num_semesters: int, num_groups: int, num_records: int) -> BMGTGroup:
+        rng = random.Random(0)
+        case, _ = BMGTCase.objects.get_or_create(id=1, defaults=dict(name="Food Delivery", max_submission=-1, visible=False))
+        # far future years keep the synthetic semesters clear of real ones
+        BMGTSemester.objects.bulk_create([
+            BMGTSemester(year=2900 + i // len(self.__SEASONS), season=self.__SEASONS[i % len(self.__SEASONS)]) for i in range(num_semesters)
+        ])
+        semesters = list(BMGTSemester.objects.filter(year__gte=2900).order_by('id'))
+        BMGTGroup.objects.bulk_create([BMGTGroup(number=n + 1, semester=semester) for semester in semesters for n in range(num_groups)])
+        groups = list(BMGTGroup.objects.filter(semester__in=semesters).order_by('id'))
+        BMGTUser.objects.bulk_create([
+            BMGTUser(first_name='bench', last_name=str(n), did=f'bench-{group.id}-{n}', group=group, semester_id=group.semester_id, activated=True)
+            for group in groups for n in range(4)
+        ])
+        users = {}
+        for user in BMGTUser.objects.filter(group__in=groups):
+            users.setdefault(user.group_id, []).append(user)
+        states = [BMGTCaseRecord.State.SUCCESS] * 8 + [BMGTCaseRecord.State.FAILED, BMGTCaseRecord.State.RUNNING]
+        records = []
+        for group in groups:
+            for n in range(num_records):
+                state = rng.choice(states)
+                succeeded = state == BMGTCaseRecord.State.SUCCESS
+                records.append(BMGTCaseRecord(
+                    case=case, group=group, user=rng.choice(users[group.id]), state=state, file_name=f'bench{group.id}_{n}',
+                    performance_metric=rng.uniform(0, 100) if succeeded else None, score=rng.uniform(0, 100) if succeeded else None,
+                ))
+        BMGTCaseRecord.objects.bulk_create(records, batch_size=1000)
+        self.stdout.write(f"generated {len(semesters)} semesters, {len(groups)} groups and {len(records)} case records")
+        return groups[len(groups) // 2]
+
+    def __report(self, title: str, group: BMGTGroup, repeat: int) -> None:
+        queries = {
+            "submission count (case, group, state)": BMGTCaseRecord.objects.filter(
+                case_id=1, group=group, state__in=[BMGTCaseRecord.State.RUNNING, BMGTCaseRecord.State.SUCCESS]).values('id'),
+            "group records (group, state)": BMGTCaseRecord.objects.filter(
+                group=group, state=BMGTCaseRecord.State.SUCCESS).order_by('-id')[:10],
+        }
+        self.stdout.write(f"\n=== {title} ===")
+        for name, queryset in queries.items():
+            started = time.perf_counter()
+            for _ in range(repeat):
+                list(queryset.all())
+            elapsed = (time.perf_counter() - started) * 1000 / repeat
+            self.stdout.write(f"\n{name}: {elapsed:.2f} ms")
+            self.stdout.write(queryset.explain())
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bmgt435_elp.bmgtModels import BMGTSimulationJob
+from bmgt435_elp.simulationJobs import simulate_case_record
+from bmgt435_elp.utils.jobUtils import DatabaseJobQueue
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = "Runs a simulation worker that claims queued simulation jobs from the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lease', type=int, default=None, help="lease of a claimed job in seconds")
+        parser.add_argument('--poll', type=float, default=1.0, help="seconds to wait when the queue is empty")
+        parser.add_argument('--max-jobs', type=int, default=None, help="exit after running this many jobs")
+        parser.add_argument('--exit-when-empty', action='store_true', help="exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        job_queue = DatabaseJobQueue(lease_seconds=options['lease'])
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stdout.write(f"simulation worker {owner} started")
+
+        num_jobs = 0
+        while options['max_jobs'] is None or num_jobs < options['max_jobs']:
+            job = job_queue.claim(owner)
+            if job is None:
+                if options['exit_when_empty']:
+                    break
+                time.sleep(options['poll'])
+                continue
+            self.__run(job_queue, job, owner)
+            num_jobs += 1
+
+        self.stdout.write(f"simulation worker {owner} stopped after {num_jobs} jobs")
+
+    def __run(self, job_queue: DatabaseJobQueue, job: BMGTSimulationJob, owner: str) -> None:
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=self.__heartbeat, args=(job_queue, job, owner, stopped), daemon=True)
+        heartbeat.start()
+        try:
+            simulate_case_record(job.case_record_id, **json.loads(job.job_args))
+        except Exception as e:
+            job_queue.fail(job, owner, repr(e))
+            self.stderr.write(f"simulation job {job.id} failed: {e!r}")
+        else:
+            job_queue.complete(job, owner)
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+    @staticmethod
+    def __heartbeat(job_queue: DatabaseJobQueue, job: BMGTSimulationJob, owner: str, stopped: threading.Event) -> None:
+        try:
+            while not stopped.wait(job_queue.lease_seconds / 3):
+                if not job_queue.heartbeat(job, owner):
+                    break
+        finally:
+            connections.close_all()
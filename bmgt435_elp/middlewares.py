@@ -1,9 +1,15 @@
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+import asyncio
 import os
 from .bmgtModels import BMGTUser
 from .utils.apiUtils import AppResponse
+from .utils.authUtils import session_user, asession_user
+from .utils.databaseUtils import RequestRouting, begin_request_routing, end_request_routing
 
 
+@sync_and_async_middleware
 def CORSMiddleware(get_response):
 
     origin = os.environ.get("APP_FRONTEND_HOST",)
@@ -11,18 +17,31 @@ def CORSMiddleware(get_response):
     def config_cors_response(resp: HttpResponse):
         resp["Access-Control-Allow-Origin"] = origin
         resp["Access-Control-Allow-Credentials"] = "true"
-        resp['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, x-xsrf-token'
+        resp['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, x-xsrf-token, If-None-Match'
         resp['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        resp['Access-Control-Expose-Headers'] = 'cookie, set-cookie, x-xsrf-token'
+        resp['Access-Control-Expose-Headers'] = 'cookie, set-cookie, x-xsrf-token, retry-after, etag'
         resp['UseHttpOnly'] = '1'
 
-    def middleware(request: HttpRequest):
+    def preflight_response() -> HttpResponse:
+        resp = HttpResponse()
+        config_cors_response(resp)
+        resp.status_code = 200
+        return resp
 
-        if request.method == 'OPTIONS':
-            resp = HttpResponse()
+    if asyncio.iscoroutinefunction(get_response):
+        async def async_middleware(request: HttpRequest):
+            if request.method == 'OPTIONS':
+                return preflight_response()
+            resp = await get_response(request)
             config_cors_response(resp)
-            resp.status_code = 200
             return resp
+
+        return async_middleware
+
+    def middleware(request: HttpRequest):
+
+        if request.method == 'OPTIONS':
+            return preflight_response()
         else:
             resp = get_response(request)
             config_cors_response(resp)
@@ -31,42 +50,99 @@ def CORSMiddleware(get_response):
     return middleware
 
 
+@sync_and_async_middleware
+def DatabaseRoutingMiddleware(get_response):
+    """
+    lets the reads of safe requests go to the database replicas.
+    requests that may write, and the requests of a client for settings.DATABASE_REPLICA_LAG_SECONDS after it wrote,
+    read from the primary, so clients always see their own writes. a short-lived cookie remembers the last write
+    """
+
+    PRIMARY_COOKIE = 'primary'
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def begin(request: HttpRequest):
+        return begin_request_routing(pinned=request.method not in SAFE_METHODS or PRIMARY_COOKIE in request.COOKIES)
+
+    def finish(resp: HttpResponse, routing: RequestRouting) -> HttpResponse:
+        if routing.wrote:
+            resp.set_cookie(PRIMARY_COOKIE, '1', max_age=getattr(settings, 'DATABASE_REPLICA_LAG_SECONDS', 5), samesite='strict', secure=True, httponly=True)
+        return resp
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def async_middleware(request: HttpRequest) -> HttpResponse:
+            if not getattr(settings, 'DATABASE_REPLICAS', []):
+                return await get_response(request)
+            routing, token = begin(request)
+            try:
+                return finish(await get_response(request), routing)
+            finally:
+                end_request_routing(token)
+
+        return async_middleware
+
+    def middleware(request: HttpRequest) -> HttpResponse:
+        if not getattr(settings, 'DATABASE_REPLICAS', []):
+            return get_response(request)
+        routing, token = begin(request)
+        try:
+            return finish(get_response(request), routing)
+        finally:
+            end_request_routing(token)
+
+    return middleware
+
+
+@sync_and_async_middleware
 def AuthenticationMiddleware(get_response):
+    """
+    assert the validity of cookies
+    apart from registration and password retrieval operations, all other operations require cookies
+    requests without valid cookies will be rejected
+
+    authentication rules:
+    1. authentication api's are always allowed
+    2. user utility api's are allowed if there is a valid session cookie
+    3. manage api's are allowed if there is a valid session cookie, and if the user is an admin
+    sessions are mostly checked against the per-process user cache rather than the database
+    """
+
+    ADMIN = "admin"
+    failedPrompt = "Failed to verify authentication!"
+
+    def require_no_auth(request: HttpRequest) -> bool:
+        return request.path.startswith("/bmgt435-service/api/auth/") or request.path.startswith("/bmgt435-service/admin") or request.path.startswith("/bmgt435-service/static") or request.path.startswith("/bmgt435-service/api/health/")
+
+    def authorized(request: HttpRequest, user: BMGTUser) -> bool:
+        request.app_user = user
+        require_admin = request.path.startswith("/bmgt435-service/api/manage/")
+        return not require_admin or user.role == ADMIN
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def async_middleware(request: HttpRequest) -> HttpResponse:
+            if require_no_auth(request):
+                return await get_response(request)
+
+            # the session user is loaded with the relations the views read, which keeps async views free of lazy queries
+            user = await asession_user(request)
+            if user is None:
+                return AppResponse(reject=failedPrompt)
+            if authorized(request, user):
+                return await get_response(request)
+            return AppResponse(reject=failedPrompt)
+
+        return async_middleware
 
     def middleware(request: HttpRequest) -> HttpResponse:
-        """
-        assert the validity of cookies
-        apart from registration and password retrieval operations, all other operations require cookies
-        requests without valid cookies will be rejected
-
-        authentication rules:
-        1. authentication api's are always allowed
-        2. user utility api's are allowed if there is a user id cookie
-        3. manage api's are allowed if there is a user id cookie, and if the user is an admin (validated by a database query)
-        """
-        ADMIN = "admin"
-        failedPrompt = "Failed to verify authentication!"
-
-        require_no_auth = request.path.startswith("/bmgt435-service/api/auth/") or request.path.startswith("/bmgt435-service/admin") or request.path.startswith("/bmgt435-service/static")
-        if require_no_auth:
+        if require_no_auth(request):
             return get_response(request)
 
-        user_id = request.COOKIES.get('id', None)
-        if user_id is None:
+        user = session_user(request)
+        if user is None:
             return AppResponse(reject=failedPrompt)
-        
-        require_admin = request.path.startswith("/bmgt435-service/api/manage/")
-        try:
-            user = BMGTUser.objects.get(id=user_id, activated=True)
-            request.app_user = user
-            if require_admin:
-                if user.role == ADMIN:
-                    return get_response(request)
-                else:
-                    return AppResponse(reject=failedPrompt)
-            else:   
-                return get_response(request)
-        except BMGTUser.DoesNotExist:
+        if authorized(request, user):
+            return get_response(request)
+        else:
             return AppResponse(reject=failedPrompt)
 
-    return middleware
\ No newline at end of file
+    return middleware
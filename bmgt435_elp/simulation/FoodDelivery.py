@@ -1,25 +1,38 @@
 import openpyxl
 import copy
 import io
+import os
+import re
+import threading
+import zlib
 import numpy as np
 import pandas as pd
+import scipy.signal
 import scipy.stats
 from .Core import SimulationCase, SimulationException, SimulationResult
-from typing import Union
+from typing import Callable, Union
 
 
 class FoodDeliveryResult(SimulationResult):
 
-    def __init__(self, centers, policies, score: float, perfMetric: float, summaryData, iterationData) -> None:
+    def __init__(self, centers, policies, score: float, perfMetric: float, summaryData, iterationData, checkpoint=None) -> None:
         super().__init__(score, summaryData, iterationData)
         self.__centers = centers
         self.__policies = policies
         self.__perfMetric = perfMetric
+        self.__checkpoint = checkpoint
 
     @property
     def performance_metric(self) -> float:
         return self.__perfMetric
 
+    @property
+    def checkpoint(self):
+        """
+        per-week state of the run, which a later run against the same scenario can resume from. None if the run was not reproducible
+        """
+        return self.__checkpoint
+
     def asFileStream(self) -> io.BytesIO:
         wb = openpyxl.Workbook(write_only=True)
         main_sheet = wb.create_sheet('main')
@@ -47,6 +60,134 @@ class FoodDeliveryResult(SimulationResult):
         return self.summaryData.loc[0,].to_dict()
 
 
+class FoodDeliveryScenarioBank(object):
+    """
+    precomputed weekly demand and checkout price streams that FoodDelivery can be evaluated against instead of sampling.\n
+    the arrays are memory-mapped read-only from .npy files, so all the worker processes share the same pages
+    """
+
+    def __init__(self, name: str, center_names: list[str], demand: np.ndarray, price_cumsum: np.ndarray) -> None:
+        """
+        name: identifies the bank together with its version\n
+        demand: weekly demand of every center, shape (scenarios, weeks, centers)\n
+        price_cumsum: prefix sums of the checkout price stream of every center, shape (scenarios, centers, orders + 1).
+        the orders of a week follow those of the previous weeks in the stream
+        """
+        self.__name = name
+        self.__center_index = {c: i for i, c in enumerate(center_names)}
+        self.__demand = demand
+        self.__price_cumsum = price_cumsum
+        self.__week_offset = np.cumsum(demand, axis=1, dtype=np.int64) - demand
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def num_scenarios(self) -> int:
+        return self.__demand.shape[0]
+
+    def demand(self, scenario: int, week: int) -> dict:
+        """
+        returns the demand of all the centers in a week, stored in a dict where keys are center ids
+        """
+        return {name: int(self.__demand[scenario, week, i]) for name, i in self.__center_index.items()}
+
+    def order_prices(self, scenario: int, center_name: str, week: int, demand: int, supply: int) -> tuple[float, float]:
+        """
+        returns the total checkout price of the orders covered and of the orders lost in a week
+        """
+        i = self.__center_index[center_name]
+        cumsum = self.__price_cumsum[scenario, i]
+        start = self.__week_offset[scenario, week, i]
+        covered = cumsum[start + supply] - cumsum[start]
+        lost = cumsum[start + demand] - cumsum[start + supply]
+        return round(float(covered), 2), round(float(lost), 2)
+
+
+class FoodDeliveryCheckpoint(object):
+    """
+    per-week state of a FoodDelivery run against a scenario bank.\n
+    the trajectory of a run only depends on the restock decisions, so a run with different policies can reuse
+    every week before the first one in which its hubs would restock differently
+    """
+
+    def __init__(self, bank_name: str, scenario: int, hubs: list[str], policies, pre_order_inventory: np.ndarray, history: dict) -> None:
+        """
+        pre_order_inventory: inventory of every hub at the start of every week, shape (weeks, hubs)\n
+        history: detailed per-week output of every hub, keyed by hub then by output column
+        """
+        self.__bank_name = bank_name
+        self.__scenario = scenario
+        self.__hubs = [str(h) for h in hubs]
+        self.__policies = np.array(policies, dtype=np.int64).reshape(-1, 2)
+        self.__pre_order_inventory = np.array(pre_order_inventory, dtype=np.int64).reshape(-1, len(self.__hubs))
+        self.__history = history
+
+    def matches(self, bank_name: str, scenario: int, hubs: list[str]) -> bool:
+        """
+        tells if the checkpoint was recorded against the same scenario with the same hubs in the same order
+        """
+        return self.__bank_name == bank_name and self.__scenario == scenario and self.__hubs == [str(h) for h in hubs]
+
+    def first_divergent_week(self, policies) -> int:
+        """
+        returns the first week in which the policies would restock differently from the recorded ones,
+        or the number of recorded weeks if they never do
+        """
+        inventory = self.__pre_order_inventory
+        policies = np.array(policies, dtype=np.int64).reshape(-1, 2)
+        recorded_order = np.where(inventory <= self.__policies[:, 0], self.__policies[:, 1] - inventory, 0)
+        new_order = np.where(inventory <= policies[:, 0], policies[:, 1] - inventory, 0)
+        diverged = np.any(recorded_order != new_order, axis=1)
+        return int(np.argmax(diverged)) if diverged.any() else len(inventory)
+
+    def pre_order_inventory(self, week: int) -> list[int]:
+        return self.__pre_order_inventory[week].tolist()
+
+    def history_prefix(self, week: int) -> dict:
+        """
+        returns the detailed output of the weeks before the specified week
+        """
+        return {
+            hub: {key: values[:week] for key, values in columns.items()} for hub, columns in self.__history.items()
+        }
+
+    def save(self, file) -> None:
+        """
+        file: path ending with .npz, or a binary file object
+        """
+        arrays = {
+            f"history_{i}_{key}": np.array(values) for i, hub in enumerate(self.__hubs) for key, values in self.__history[hub].items()
+        }
+        np.savez_compressed(
+            file,
+            bank_name=np.array(self.__bank_name),
+            scenario=np.array(self.__scenario),
+            hubs=np.array(self.__hubs),
+            policies=self.__policies,
+            pre_order_inventory=self.__pre_order_inventory,
+            **arrays,
+        )
+
+    @staticmethod
+    def load(file) -> 'FoodDeliveryCheckpoint':
+        """
+        file: path or binary file object
+        """
+        with np.load(file, allow_pickle=False) as data:
+            hubs = data['hubs'].tolist()
+            history = {hub: {} for hub in hubs}
+            for entry in data.files:
+                if entry.startswith('history_'):
+                    index, key = entry[len('history_'):].split('_', 1)
+                    history[hubs[int(index)]][key] = data[entry].tolist()
+            return FoodDeliveryCheckpoint(
+                str(data['bank_name']), int(data['scenario']), hubs,
+                data['policies'], data['pre_order_inventory'], history,
+            )
+
+
 class FoodDelivery(SimulationCase):
 
     class DeliveryHub(object):
@@ -106,8 +247,16 @@ class FoodDelivery(SimulationCase):
     __initial_inventory: int = 1000
     __max_weekly_restock: int = 7000
     __num_iterations: int = 1
+    __checkout_price_low: float = 6.7
+    __checkout_price_mode: float = 29
+    __checkout_price_high: float = 76.6
+    __demand_pmf_sigmas: float = 8      # demand mass further than this many standard deviations from the mean is lumped into the end points
+    __cap_binding_tolerance: float = 1e-4   # above this weekly probability of hitting the restock cap the analytical evaluation is abandoned
     perf_lower_bound: float = -1600000
     perf_upper_bound: float = 1600000
+    scenario_bank_version: int = 1      # bump whenever the demand or price model changes so that stale banks are not reused
+    __scenario_banks: dict = {}     # banks opened by this process, keyed by file path
+    __scenario_banks_lock = threading.Lock()
 
     @staticmethod
     def __sim_center_demand():
@@ -125,7 +274,8 @@ class FoodDelivery(SimulationCase):
 
     @staticmethod
     def __sim_checkout_price(size: int = 1):
-        price = np.random.triangular(6.7, 29, 76.6, size)
+        price = np.random.triangular(
+            FoodDelivery.__checkout_price_low, FoodDelivery.__checkout_price_mode, FoodDelivery.__checkout_price_high, size)
         price = np.round(price, decimals=2)
         return price
     
@@ -139,18 +289,81 @@ class FoodDelivery(SimulationCase):
             return input_mapper_valid
         return False
 
+    @staticmethod
+    def __build_scenario_bank(demand_path: str, price_path: str, seed: int) -> None:
+        """
+        samples the demand and price streams of all the centers for every iteration and saves them as .npy files
+        """
+        rng = np.random.default_rng(seed)
+        arr_demand = rng.multivariate_normal(
+            mean=FoodDelivery.__demand_mu_vector, cov=FoodDelivery.__demand_cov_matrix,
+            size=(FoodDelivery.__num_iterations, FoodDelivery.__num_weeks))
+        arr_demand = np.clip(np.round(arr_demand), FoodDelivery.__min_week_demand, FoodDelivery.__max_week_demand).astype(np.int32)
+
+        total_orders = arr_demand.sum(axis=1)   # shape (scenarios, centers)
+        price_cumsum = np.zeros(total_orders.shape + (total_orders.max() + 1,))
+        for scenario in range(total_orders.shape[0]):
+            for center in range(total_orders.shape[1]):
+                count = total_orders[scenario, center]
+                price = rng.triangular(
+                    FoodDelivery.__checkout_price_low, FoodDelivery.__checkout_price_mode, FoodDelivery.__checkout_price_high, count)
+                price_cumsum[scenario, center, 1:count + 1] = np.cumsum(np.round(price, decimals=2))
+
+        # written under temporary names first so that concurrent readers never see a partial file
+        for path, arr in [(demand_path, arr_demand), (price_path, price_cumsum)]:
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                np.save(file, arr)
+            os.replace(temp_path, path)
+
+    @staticmethod
+    def scenario_bank(directory: str, tag: str) -> FoodDeliveryScenarioBank:
+        """
+        returns the scenario bank identified by tag (e.g. a semester id), memory-mapped from directory.\n
+        the bank is generated from a seed derived from the tag and the bank version if it does not exist yet,
+        so every process ends up with identical scenarios for the same tag.
+        the tag names the files of the bank, so it may only contain letters, digits, '_' and '-'
+        """
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', tag):
+            raise ValueError(f"invalid scenario bank tag {tag!r}")
+        name = f"fd-{tag}-v{FoodDelivery.scenario_bank_version}"
+        demand_path = os.path.join(directory, name + "-demand.npy")
+        price_path = os.path.join(directory, name + "-price.npy")
+        with FoodDelivery.__scenario_banks_lock:
+            bank = FoodDelivery.__scenario_banks.get(demand_path)
+            if bank is None:
+                if not (os.path.exists(demand_path) and os.path.exists(price_path)):
+                    os.makedirs(directory, exist_ok=True)
+                    FoodDelivery.__build_scenario_bank(demand_path, price_path, zlib.crc32(name.encode()))
+                bank = FoodDeliveryScenarioBank(
+                    name,
+                    FoodDelivery.__center_names,
+                    np.load(demand_path, mmap_mode='r'),
+                    np.load(price_path, mmap_mode='r'),
+                )
+                FoodDelivery.__scenario_banks[demand_path] = bank
+        return bank
+
 
     def __init__(
         self,
         centers: list[str] = [],
         policies: list[list[int]] = [],
         config: Union[dict, None] = None,
+        scenario_bank: Union[FoodDeliveryScenarioBank, None] = None,
+        checkpoint: Union[FoodDeliveryCheckpoint, None] = None,
+        progress: Union[Callable[[int, int], None], None] = None,
     ):
 
         super().__init__()
         self.__centers = centers
         self.__policies = policies
         self.__config = config  # this is for remapping the centers.
+        self.__scenario_bank = scenario_bank    # if set, demand and prices are read from the bank instead of sampled
+        self.__scenario = 0
+        self.__checkpoint = checkpoint  # if it matches the scenario and hubs, the weeks before the first divergent one are reused
+        self.__last_checkpoint = None
+        self.__progress = progress  # called with (weeks simulated, total weeks) after every simulated week
         self.__assert_params()
 
     def __assert_params(self) -> None:
@@ -185,6 +398,14 @@ class FoodDelivery(SimulationCase):
                 "Simulation failed. s policy must be non-negative and S policy must be greater than s policy")
 
 
+    def __hub_names(self) -> list:
+        """
+        returns the delivery hubs actually operated by the chosen centers, after the remapping in the case config is applied
+        """
+        if self.__config is not None:
+            return [self.__config[c] for c in self.__centers]
+        return list(self.__centers)
+
     def score(self, iterationStats) -> float:
         """
         returns the score of the simulation
@@ -202,7 +423,7 @@ class FoodDelivery(SimulationCase):
         # instantialize centers
         centers = [
             FoodDelivery.DeliveryHub(policy=policy, initial_inventory=FoodDelivery.__initial_inventory, name=center) for \
-            policy, center in zip(self.__policies, self.__centers)
+            policy, center in zip(self.__policies, self.__hub_names())
         ]
         # define the output data:
         #       the output data describes one iteration of the simulation
@@ -239,10 +460,28 @@ class FoodDelivery(SimulationCase):
             'history': history
         }
 
+        # resume from the recorded state of a previous run if the trajectory is identical up to some week
+        hub_names = [center.get_name() for center in centers]
+        start_week = 0
+        arr_pre_order_inventory = []
+        checkpoint = self.__checkpoint
+        if checkpoint is not None and self.__scenario_bank is not None and \
+                checkpoint.matches(self.__scenario_bank.name, self.__scenario, hub_names):
+            start_week = checkpoint.first_divergent_week(self.__policies)
+            prefix = checkpoint.history_prefix(start_week)
+            for c_name in hub_names:
+                history[c_name] = prefix[str(c_name)]
+            arr_pre_order_inventory = [checkpoint.pre_order_inventory(w) for w in range(start_week)]
+            if start_week < FoodDelivery.__num_weeks:
+                for center, inventory in zip(centers, checkpoint.pre_order_inventory(start_week)):
+                    center.set_inventory(inventory)
+
         # main logic
 
         # for every week
-        for every_week in range(FoodDelivery.__num_weeks):
+        for every_week in range(start_week, FoodDelivery.__num_weeks):
+
+            arr_pre_order_inventory.append([center.get_inventory() for center in centers])
 
             # check inventory
             arr_purchase = [center.s_big() - center.get_inventory() if center.get_inventory()
@@ -281,7 +520,10 @@ class FoodDelivery(SimulationCase):
 
             # decide the weekly demand at each center
             #center_demand = np.array([self.__dict_center_demand[center.get_name()]() for center in centers])
-            center_demand = FoodDelivery.__sim_center_demand()
+            if self.__scenario_bank is not None:
+                center_demand = self.__scenario_bank.demand(self.__scenario, every_week)
+            else:
+                center_demand = FoodDelivery.__sim_center_demand()
             center_demand = [center_demand[center.get_name()]
                              for center in centers]
 
@@ -301,13 +543,17 @@ class FoodDelivery(SimulationCase):
                 demand = center_demand[i]
                 supply = center_supply[i]
                 shortage_count = max(0, demand - supply)
-                arr_order_price = FoodDelivery.__sim_checkout_price(size=demand)
-                # orders covered
-                covered_order_price = arr_order_price[:supply]
-                # orders failed to cover
-                lost_order_price = arr_order_price[supply:]
-                order_revenue = round(sum(covered_order_price), 2)
-                shortage_penalty = round(sum(lost_order_price), 2)
+                if self.__scenario_bank is not None:
+                    order_revenue, shortage_penalty = self.__scenario_bank.order_prices(
+                        self.__scenario, c_name, every_week, demand, supply)
+                else:
+                    arr_order_price = FoodDelivery.__sim_checkout_price(size=demand)
+                    # orders covered
+                    covered_order_price = arr_order_price[:supply]
+                    # orders failed to cover
+                    lost_order_price = arr_order_price[supply:]
+                    order_revenue = round(sum(covered_order_price), 2)
+                    shortage_penalty = round(sum(lost_order_price), 2)
 
                 # this records the inventory level after the weekly purchase
                 prior_inv = center.get_inventory()
@@ -334,6 +580,9 @@ class FoodDelivery(SimulationCase):
                 history[c_name]['revenue'].append(order_revenue)
                 history[c_name]['holding_cost'].append(holding_cost)
 
+            if self.__progress is not None:
+                self.__progress(every_week + 1, FoodDelivery.__num_weeks)
+
         # perform aggregation
         output['total_revenue'] = round(sum([
             sum(history[c.get_name()]['revenue']) for c in centers
@@ -354,13 +603,14 @@ class FoodDelivery(SimulationCase):
             output['total_fixed_cost'] - output['total_holding_cost'],
             2
         )
+
+        if self.__scenario_bank is not None:
+            self.__last_checkpoint = FoodDeliveryCheckpoint(
+                self.__scenario_bank.name, self.__scenario, hub_names, self.__policies, arr_pre_order_inventory, history)
         return output
 
     def run(self):
         original_centers = copy.deepcopy(self.__centers)
-        if self.__config is not None:   # remap centers
-            self.__centers = [self.__config[c] for c in self.__centers]
-        
         res = self.simulate()
         score = self.score(res)
         performance_metric = res['perf_metric']
@@ -381,5 +631,137 @@ class FoodDelivery(SimulationCase):
                 {v: k for k, v in self.__config.items()}
             )
 
-        simRes = FoodDeliveryResult(original_centers, self.__policies, score, performance_metric, df_aggregated_statistics, df_per_center_statistics)
+        simRes = FoodDeliveryResult(
+            original_centers, self.__policies, score, performance_metric, df_aggregated_statistics, df_per_center_statistics,
+            checkpoint=self.__last_checkpoint,
+        )
         return simRes
+
+    @staticmethod
+    def __center_demand_pmf(center_name: str) -> tuple[int, np.ndarray]:
+        """
+        returns the smallest attainable weekly demand of a center and the probability mass of every demand level from there on.\n
+        the pmf follows the rounding and truncation applied in __sim_center_demand
+        """
+        index = FoodDelivery.__center_names.index(str(center_name))
+        mu = FoodDelivery.__demand_mu_vector[index]
+        sigma = np.sqrt(FoodDelivery.__demand_cov_matrix[index, index])
+        low = max(FoodDelivery.__min_week_demand, int(np.floor(mu - FoodDelivery.__demand_pmf_sigmas * sigma)))
+        high = min(FoodDelivery.__max_week_demand, int(np.ceil(mu + FoodDelivery.__demand_pmf_sigmas * sigma)))
+        cdf = scipy.stats.norm.cdf(np.arange(low, high + 2) - 0.5, loc=mu, scale=sigma)
+        cdf[0], cdf[-1] = 0, 1  # the truncated tails are lumped into the end points
+        return low, np.diff(cdf)
+
+    @staticmethod
+    def __evaluate_center(center_name: str, policy) -> dict:
+        """
+        propagates the inventory distribution of one delivery hub week by week, assuming the weekly restock cap never binds.\n
+        returns the expected weekly number of orders served, shortage count and post-demand inventory,
+        together with the distribution of the weekly restock amount
+        """
+        s_small, s_big = int(policy[0]), int(policy[1])
+        low, pmf = FoodDelivery.__center_demand_pmf(center_name)
+        high = low + len(pmf) - 1
+        size = max(s_big, FoodDelivery.__initial_inventory) + 1
+        levels = np.arange(size)
+
+        # with j units on hand the expected number of orders served is E[min(j, D)] = sum of P(D > k) over k < j
+        demand_cdf = np.zeros(high + 1)
+        demand_cdf[low:] = np.cumsum(pmf)
+        cdf = np.ones(size)
+        cdf[:min(size, high + 1)] = demand_cdf[:size]
+        expected_served = np.concatenate(([0.0], np.cumsum(1 - cdf)[:-1]))
+        mean_demand = np.dot(np.arange(low, high + 1), pmf)
+
+        dist = np.zeros(size)
+        dist[FoodDelivery.__initial_inventory] = 1
+        served, shortage, post_inventory, restock = [], [], [], []
+        for every_week in range(FoodDelivery.__num_weeks):
+
+            # every inventory level at or below s is raised to S
+            reorder = dist[:s_small + 1].copy()
+            week_restock = np.zeros(s_big + 1)
+            week_restock[s_big - np.arange(s_small + 1)] = reorder
+            week_restock[0] = dist[s_small + 1:].sum()
+            dist[:s_small + 1] = 0
+            dist[s_big] += reorder.sum()
+
+            week_served = np.dot(dist, expected_served)
+            served.append(week_served)
+            shortage.append(mean_demand - week_served)
+            post_inventory.append(np.dot(dist, levels) - week_served)
+            restock.append(week_restock)
+
+            # the inventory after the demand is max(J - D, 0). entry t of the convolution is P(J - D = t - high)
+            conv = scipy.signal.fftconvolve(dist, pmf[::-1]).clip(min=0)
+            dist = np.zeros(size)
+            dist[0] = conv[:high + 1].sum()
+            remaining = conv[high + 1:high + size]
+            dist[1:1 + len(remaining)] = remaining
+            dist /= dist.sum()
+
+        return {
+            'served': np.array(served),
+            'shortage': np.array(shortage),
+            'post_inventory': np.array(post_inventory),
+            'restock': restock,
+        }
+
+    @staticmethod
+    def __cap_binding_probability(policies, evaluations: list[dict]) -> float:
+        """
+        returns the largest weekly probability that the total restock request exceeds the weekly restock cap,
+        treating the hubs as independent
+        """
+        if sum([int(p[1]) for p in policies]) <= FoodDelivery.__max_weekly_restock:
+            return 0.0
+
+        probability = 0.0
+        for every_week in range(FoodDelivery.__num_weeks):
+            total = np.ones(1)
+            for evaluation in evaluations:
+                total = scipy.signal.fftconvolve(total, evaluation['restock'][every_week]).clip(min=0)
+            probability = max(probability, float(total[FoodDelivery.__max_weekly_restock + 1:].sum()))
+        return probability
+
+    def evaluate(self, fallback_iterations: int = 20) -> dict:
+        """
+        returns the expected outcome of the (s,S) policies without sampling.\n
+        the inventory of every hub is propagated as a Markov chain, which is exact as long as the weekly restock cap does not bind.
+        when the cap binds with non-negligible probability, the expectation is estimated by averaging simulation runs instead
+        """
+        evaluations = [
+            FoodDelivery.__evaluate_center(hub, policy) for hub, policy in zip(self.__hub_names(), self.__policies)
+        ]
+        cap_binding_probability = FoodDelivery.__cap_binding_probability(self.__policies, evaluations)
+
+        if cap_binding_probability > FoodDelivery.__cap_binding_tolerance:
+            runs = [self.simulate() for _ in range(fallback_iterations)]
+            output = {
+                key: round(float(np.mean([r[key] for r in runs])), 2) for key in [
+                    'perf_metric', 'total_revenue', 'total_shortage_count', 'total_shortage_amount',
+                    'total_holding_cost', 'total_fixed_cost',
+                ]
+            }
+            output['method'] = 'simulation'
+        else:
+            mean_price = (FoodDelivery.__checkout_price_low + FoodDelivery.__checkout_price_mode + FoodDelivery.__checkout_price_high) / 3
+            total_served = sum([e['served'].sum() for e in evaluations])
+            total_shortage = sum([e['shortage'].sum() for e in evaluations])
+            output = {
+                'perf_metric': float('-inf'),
+                'total_revenue': round(float(mean_price * total_served), 2),
+                'total_shortage_count': round(float(total_shortage), 2),
+                'total_shortage_amount': round(float(mean_price * total_shortage), 2),
+                'total_holding_cost': round(float(sum([e['post_inventory'].sum() for e in evaluations]) * FoodDelivery.__holding_cost), 2),
+                'total_fixed_cost': len(evaluations) * FoodDelivery.__num_weeks * FoodDelivery.__center_weekly_cost,
+                'method': 'markov',
+            }
+            output['perf_metric'] = round(
+                output['total_revenue'] - output['total_shortage_amount'] - \
+                output['total_fixed_cost'] - output['total_holding_cost'],
+                2
+            )
+
+        output['cap_binding_probability'] = round(cap_binding_probability, 6)
+        return output
@@ -1,4 +1,4 @@
-__all__ = ['SimulationException', 'SimulationResult', "FoodDelivery", "CallCenterSimulator" ]
+__all__ = ['SimulationException', 'SimulationResult', "FoodDelivery", "FoodDeliveryScenarioBank", "FoodDeliveryCheckpoint", "CallCenterSimulator" ]
 
 from .Core import SimulationException, SimulationResult
-from .FoodDelivery import FoodDelivery
\ No newline at end of file
+from .FoodDelivery import FoodDelivery, FoodDeliveryScenarioBank, FoodDeliveryCheckpoint
\ No newline at end of file
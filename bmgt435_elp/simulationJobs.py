@@ -0,0 +1,302 @@
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+
+from .simulation import FoodDelivery, FoodDeliveryCheckpoint
+from .bmgtModels import BMGTCase, BMGTGroup, BMGTCaseRecord, BMGTSemester, BMGTSimulationJob
+from .utils.cacheUtils import DiskLRUCache
+from .utils.databaseUtils import retry_on_locked
+from .utils.jobUtils import SimulationPool, DatabaseJobQueue, AdmissionController
+from .utils.eventUtils import ProgressBroker, sse_message
+from .utils.leaderboardUtils import add_leaderboard_entry
+from .utils.quotaUtils import fail_case_records
+from sim_server_django.config import AppConfig
+
+from typing import AsyncIterator, Callable, Union
+import asyncio
+import datetime
+import json
+import io
+import time
+
+"""
+Simulation jobs of submitted cases. Jobs run either on the local thread pool of the web process
+or on dedicated worker processes that claim them from the database queue (see the simulation_worker command).
+"""
+
+CASE_RECORD_PATH = settings.MEDIA_ROOT  + "bmgt435/case-records/"
+SCENARIO_BANK_PATH = settings.MEDIA_ROOT + "bmgt435/scenario-banks/"
+CHECKPOINT_SUFFIX = ".ckpt.npz"
+RESULT_CACHE = DiskLRUCache(lambda: settings.RESULT_CACHE_DIR, AppConfig.APP_RESULT_CACHE_MAX_MB * 1024 * 1024)
+simulation_pool = SimulationPool()
+admission_controller = AdmissionController()    # keyed by group id
+progress_broker = ProgressBroker()  # progress of the case records simulated by this process, keyed by case record id
+
+_PROGRESS_INTERVAL_SECONDS = 1
+_PROGRESS_POLL_SECONDS = 1
+_PROGRESS_KEEP_ALIVE_SECONDS = 15
+_PROGRESS_STREAM_MAX_SECONDS = 600
+
+
+def load_last_checkpoint(case: BMGTCase, group: BMGTGroup) -> FoodDeliveryCheckpoint:
+    """
+    returns the checkpoint of the latest successful submission of the group, or None if there is no usable one
+    """
+    last_record = BMGTCaseRecord.objects.filter(
+        case=case, group=group, state=BMGTCaseRecord.State.SUCCESS,
+    ).order_by('-id').first()
+    if last_record is None:
+        return None
+    try:
+        return FoodDeliveryCheckpoint.load(CASE_RECORD_PATH + last_record.file_name + CHECKPOINT_SUFFIX)
+    except (OSError, ValueError, KeyError):
+        return None
+
+def scenario_bank_tag(semester: BMGTSemester) -> str:
+    """
+    tag of the scenario bank a semester is graded against. it names files, so it is built from the id rather than the name
+    """
+    return f"semester-{semester.id}"
+
+def canonical_food_delivery_params(params: dict) -> dict:
+    """
+    orders the centers and their policies by center so that identical submissions are simulated and cached identically
+    """
+    pairs = sorted(zip(params['centers'], params['policies']), key=lambda pair: str(pair[0]))
+    return {
+        'centers': [str(center) for center, _ in pairs],
+        'policies': [[int(policy[0]), int(policy[1])] for _, policy in pairs],
+    }
+
+def result_cache_key(case_id: int, params: dict, config_version: str, seed: str) -> str:
+    return json.dumps({
+        'case_id': case_id,
+        'params': params,
+        'config_version': config_version,
+        'seed': seed,
+    }, sort_keys=True)
+
+def case_record_state(case_record: BMGTCaseRecord) -> dict:
+    """
+    the record as returned to clients, including the summary once the simulation completes
+    """
+    data = case_record.as_dictionary()
+    data['summary'] = case_record.summary
+    return data
+
+def __publish_final_state(case_record: BMGTCaseRecord) -> None:
+    progress_broker.publish(case_record.id, case_record_state(case_record))
+    progress_broker.discard(case_record.id)
+
+@retry_on_locked
+def __share_progress(case_record_id: int, event: dict) -> None:
+    BMGTCaseRecord.objects.filter(id=case_record_id, state=BMGTCaseRecord.State.RUNNING).update(progress_json=json.dumps(event))
+
+def __progress_publisher(case_record_id: int) -> Callable[[int, int], None]:
+    """
+    returns the progress callback of a simulation, which publishes throttled progress events with an estimated remaining time.
+    events go to the subscribers of this process at once, and to the record for the streams served by other processes
+    """
+    started = None
+    last_published = 0.0
+    def publish(weeks_done: int, weeks_total: int) -> None:
+        nonlocal started, last_published
+        now = time.monotonic()
+        if started is None:     # resumed runs start past week zero
+            started = (now, weeks_done - 1)
+        if now - last_published < _PROGRESS_INTERVAL_SECONDS:
+            return
+        last_published = now
+        rate = (weeks_done - started[1]) / max(now - started[0], 1e-9)
+        event = {
+            'id': case_record_id,
+            'state': BMGTCaseRecord.State.RUNNING.label,
+            'progress': round(weeks_done / weeks_total, 4),
+            'weeks_done': weeks_done,
+            'weeks_total': weeks_total,
+            'eta_seconds': round((weeks_total - weeks_done) / rate, 3),
+        }
+        progress_broker.publish(case_record_id, event)
+        try:
+            __share_progress(case_record_id, event)
+        except DatabaseError:   # progress is informational, the simulation goes on without it
+            pass
+    return publish
+
+def complete_case_record(case_record: BMGTCaseRecord, result: dict) -> None:
+    """
+    writes the detailed result files of a case record, marks it successful and ranks it on the leaderboard
+    """
+    with open(CASE_RECORD_PATH + case_record.file_name, "wb") as file:
+        file.write(result['file'])
+    if result['checkpoint'] is not None:
+        with open(CASE_RECORD_PATH + case_record.file_name + CHECKPOINT_SUFFIX, "wb") as file:
+            file.write(result['checkpoint'])
+    case_record.summary_dict = json.dumps(result['summary'])
+    case_record.progress_json = ""
+    case_record.state = BMGTCaseRecord.State.SUCCESS
+    case_record.score = result['score']
+    case_record.performance_metric = result['performance_metric']
+    __save_completed(case_record)
+    __publish_final_state(case_record)
+
+@retry_on_locked
+def __save_completed(case_record: BMGTCaseRecord) -> None:
+    with transaction.atomic():
+        case_record.save()
+        add_leaderboard_entry(case_record)
+
+def simulate_case_record(case_record_id: int, params: dict, bank_tag: str, cache_key: str) -> None:
+    """
+    simulates a submitted food delivery case and completes its record. failures are raised to the caller
+    """
+    case_record = BMGTCaseRecord.objects.get(id=case_record_id)
+    params = dict(params)
+    params['scenario_bank'] = FoodDelivery.scenario_bank(SCENARIO_BANK_PATH, bank_tag)
+    # resubmissions only re-simulate from the first week the new policies make a different decision
+    params['checkpoint'] = load_last_checkpoint(case_record.case, case_record.group)
+    params['progress'] = __progress_publisher(case_record_id)
+    started = time.monotonic()
+    res = FoodDelivery(**params).run()
+    admission_controller.record_duration(time.monotonic() - started)
+    checkpoint_bytes = None
+    if res.checkpoint is not None:
+        with io.BytesIO() as checkpoint_stream:
+            res.checkpoint.save(checkpoint_stream)
+            checkpoint_bytes = checkpoint_stream.getvalue()
+    result = {
+        'summary': res.asDict(),
+        'score': res.score,
+        'performance_metric': res.performance_metric,
+        'file': res.asFileStream().getvalue(),
+        'checkpoint': checkpoint_bytes,
+    }
+    RESULT_CACHE.set(cache_key, result)
+    complete_case_record(case_record, result)
+
+def run_case_record(case_record_id: int, params: dict, bank_tag: str, cache_key: str) -> None:
+    """
+    local simulation job. a failed run is final, the record is marked as failed
+    """
+    try:
+        simulate_case_record(case_record_id, params, bank_tag, cache_key)
+    except Exception:
+        fail_case_records(BMGTCaseRecord.objects.filter(id=case_record_id))
+        __publish_final_state(BMGTCaseRecord.objects.get(id=case_record_id))
+        raise
+
+def fail_stale_case_records(**filters) -> int:
+    """
+    fails the running records that have outlived settings.SIMULATION_RUNNING_TIMEOUT_SECONDS without a job
+    still waiting on the database queue, e.g. because the process simulating them died. returns the number of failed records
+    """
+    deadline = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'SIMULATION_RUNNING_TIMEOUT_SECONDS', 900))
+    return fail_case_records(BMGTCaseRecord.objects.filter(
+        state=BMGTCaseRecord.State.RUNNING, create_time__lt=deadline, **filters,
+    ).exclude(
+        bmgtsimulationjob__state__in=[BMGTSimulationJob.State.QUEUED, BMGTSimulationJob.State.CLAIMED],
+    ))
+
+def simulation_load() -> dict:
+    """
+    depth and saturation of the simulation queue this process submits to.\n
+    the queue is saturated once settings.SIMULATION_MAX_PENDING jobs are waiting. retry_after estimates the seconds
+    until the backlog drains below that, at the current number of workers and the average simulation duration
+    """
+    if getattr(settings, 'SIMULATION_QUEUE', 'local') == 'database':
+        queue = 'database'
+        pending = BMGTSimulationJob.objects.filter(state=BMGTSimulationJob.State.QUEUED).count()
+        busy = BMGTSimulationJob.objects.filter(state=BMGTSimulationJob.State.CLAIMED).count()
+        workers = busy  # idle workers are not known to the database
+    else:
+        queue = 'local'
+        pending = simulation_pool.pending
+        busy = simulation_pool.busy
+        workers = simulation_pool.num_workers
+
+    max_pending = getattr(settings, 'SIMULATION_MAX_PENDING', 32)
+    saturated = pending >= max_pending
+    retry_after = 0.0
+    if saturated:
+        retry_after = max((pending - max_pending + 1) * admission_controller.expected_duration / max(workers, 1), 1.0)
+    return {
+        'queue': queue,
+        'pending': pending,
+        'busy': busy,
+        'workers': workers,
+        'saturated': saturated,
+        'retry_after': round(retry_after, 3),
+    }
+
+def admit_case_record(group: BMGTGroup) -> float:
+    """
+    admission of a new simulation of the group. returns 0 if admitted, otherwise the seconds to wait before retrying
+    """
+    fail_stale_case_records(group=group)   # records that will never finish would hold the concurrency limit forever
+    now = timezone.now()
+    running_ages = [
+        (now - create_time).total_seconds() for create_time in BMGTCaseRecord.objects.filter(
+            group=group, state=BMGTCaseRecord.State.RUNNING,
+        ).values_list('create_time', flat=True)
+    ]
+    return admission_controller.admit(group.id, running_ages)
+
+def refund_case_record_admission(group: BMGTGroup) -> None:
+    admission_controller.refund(group.id)
+
+def dispatch_case_record(case_record: BMGTCaseRecord, params: dict, bank_tag: str, cache_key: str) -> None:
+    """
+    schedules the simulation of a running case record on the queue selected by settings.SIMULATION_QUEUE
+    """
+    if getattr(settings, 'SIMULATION_QUEUE', 'local') == 'database':
+        DatabaseJobQueue().enqueue(case_record, {
+            'params': params,
+            'bank_tag': bank_tag,
+            'cache_key': cache_key,
+        })
+    else:
+        simulation_pool.submit(run_case_record, case_record.id, params, bank_tag, cache_key, key=case_record.group_id)
+
+def __shared_case_record_state(case_record_id: int) -> tuple[Union[dict, None], Union[dict, None]]:
+    """
+    the final state of a finished record, or the latest progress event shared by the process simulating it
+    """
+    case_record = BMGTCaseRecord.objects.get(id=case_record_id)
+    if case_record.state != BMGTCaseRecord.State.RUNNING:
+        return case_record_state(case_record), None
+    return None, json.loads(case_record.progress_json) if case_record.progress_json else None
+
+async def case_record_events(case_record_id: int) -> AsyncIterator[str]:
+    """
+    server-sent events of a case record: progress events while it runs, then one result event with its final state.\n
+    simulations in this process publish to the stream directly. those run by other processes, including the workers
+    of the database queue, are followed through the progress they share on the record, which is checked every second
+    """
+    queue = progress_broker.subscribe(case_record_id)
+    try:
+        # checked after subscribing, so that a completion is either seen here or published to the queue
+        finished, event = await sync_to_async(__shared_case_record_state)(case_record_id)
+        last_event = None
+        last_sent = time.monotonic()
+        deadline = last_sent + _PROGRESS_STREAM_MAX_SECONDS
+        while finished is None and time.monotonic() < deadline:
+            if event is not None and event['state'] != BMGTCaseRecord.State.RUNNING.label:
+                finished = event
+                break
+            if event is not None and event != last_event:
+                # the same event may arrive both directly and through the record
+                last_event = event
+                last_sent = time.monotonic()
+                yield sse_message('progress', event)
+            elif time.monotonic() - last_sent >= _PROGRESS_KEEP_ALIVE_SECONDS:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=_PROGRESS_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                finished, event = await sync_to_async(__shared_case_record_state)(case_record_id)
+        if finished is not None:
+            yield sse_message('result', finished)
+    finally:
+        progress_broker.unsubscribe(case_record_id, queue)
@@ -1,11 +1,41 @@
-from django.test import  TestCase, RequestFactory, Client
-from django.db import IntegrityError, transaction
+from django.test import  TestCase, SimpleTestCase, RequestFactory, Client, AsyncClient, override_settings
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.utils import timezone
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_started
+from django.db import close_old_connections
+from django.db.models import F
 from .bmgtModels import *
 from .apis import *
+from .simulation import FoodDelivery, FoodDeliveryCheckpoint
+from .utils.jobUtils import SimulationPool, DatabaseJobQueue, AdmissionController
+from .utils.apiUtils import is_async_view, generic_paginated_query, create_pager_params, clear_count_cache, iterate_serialized
+from .utils.eventUtils import ProgressBroker, sse_message
+from .utils.authUtils import session_users, sign_session_token
+from .utils.leaderboardUtils import add_leaderboard_entry, rank_leaderboard
+from .utils.quotaUtils import claim_submission, fail_case_records
+from .utils.versionUtils import resource_versions, leaderboard_resource, response_cache
+from .utils.databaseUtils import InMemoryCache, BMGT435_DB_Router, begin_request_routing, end_request_routing, configure_sqlite, retry_on_locked
+from .middlewares import DatabaseRoutingMiddleware
+from .utils.cacheUtils import DiskLRUCache
+from .simulationJobs import RESULT_CACHE, SCENARIO_BANK_PATH, CASE_RECORD_PATH, CHECKPOINT_SUFFIX, case_record_events, scenario_bank_tag, canonical_food_delivery_params, result_cache_key, admission_controller, fail_stale_case_records
+from asgiref.sync import async_to_sync, sync_to_async
 from typing import Callable
+import asyncio
+import datetime
+import gzip
 import json
+import numpy as np
 import pandas as pd
 import io
+import os
+import tempfile
+import hashlib
+import threading
+import warnings
 from http.cookies  import SimpleCookie
 
 """
@@ -16,6 +46,15 @@ Note:
 
 
 
+def _callView(method:Callable, req:HttpRequest, *args) -> HttpResponse:
+    """
+    calls a sync or async view from the synchronous test thread
+    """
+    if is_async_view(method):
+        return async_to_sync(method)(req, *args)
+    return method(req, *args)
+
+
 def _signUp(did:str, password:str):
     req = RequestFactory().post(
         '/bmgt435-service/api/auth/sign-up',
@@ -36,6 +75,14 @@ def _signIn(did:str, password:str, remember:bool = False):
     return resp
 
 
+async def _readStream(stream) -> list:
+    return [item async for item in stream]
+
+
+def _sessionCookies(user_id: int) -> dict:
+    return {'id': sign_session_token(BMGTUser.objects.get(id=user_id))}
+
+
 def _sendPost(url:str, method:Callable, jsonSerializable, cookies:dict):
     req = RequestFactory().post(
         url,
@@ -44,7 +91,7 @@ def _sendPost(url:str, method:Callable, jsonSerializable, cookies:dict):
     )
     for key in cookies:
         req.COOKIES[key] = cookies[key]
-    resp = method(req)
+    resp = _callView(method, req)
     return resp
 
 
@@ -56,7 +103,7 @@ def _sendGet(url:str, method:Callable, cookies:dict, getParams:dict = None):
         req.GET = getParams
     for key in cookies:
         req.COOKIES[key] = cookies[key]
-    resp = method(req)
+    resp = _callView(method, req)
     return resp
 
 def _makeFoodCenterCaseParams() -> dict:
@@ -81,6 +128,12 @@ def _makeImportUserData() -> pd.DataFrame:
 
 class AppTestCaeBase(TestCase):
 
+    def _pre_setup(self):
+        super()._pre_setup()
+        session_users.clear()   # users cached by a previous test are rolled back without signals
+        clear_count_cache()
+        response_cache.clear()
+
     def _deserialize_resp_data(self, resp:HttpResponse) -> dict:
         return json.loads(resp.content)
 
@@ -162,6 +215,46 @@ class TestAuthApi(AppTestCaeBase):
         self.assertResolved(resp)
 
 
+    def testSignedSessionToken(self):
+        _signUp(self.did, self.password)
+        token = _signIn(self.did, self.password).cookies['id'].value
+        self.assertNotEqual(token, '1')
+
+        c = Client()
+        c.cookies = SimpleCookie({'id': token})
+        self.assertResolved(c.get('/bmgt435-service/api/manage/semesters/all'))
+        # the session user is served from the cache afterwards
+        with self.assertNumQueries(0):
+            self.assertResolved(c.get('/bmgt435-service/api/users/me'))
+
+        c.cookies = SimpleCookie({'id': token[:-1] + ('A' if token[-1] != 'A' else 'B')})
+        self.assertRejected(c.get('/bmgt435-service/api/users/me'))
+
+        # a bare user id is not a session
+        user_id = BMGTUser.objects.get(did=self.did).id
+        c.cookies = SimpleCookie({'id': str(user_id)})
+        self.assertRejected(c.get('/bmgt435-service/api/users/me'))
+
+        # nor is a token signed with another key, such as the development key of the source
+        with override_settings(SECRET_KEY='another-key'):
+            forged = sign_session_token(BMGTUser.objects.get(did=self.did))
+        c.cookies = SimpleCookie({'id': forged})
+        self.assertRejected(c.get('/bmgt435-service/api/users/me'))
+
+
+    def testSessionTokenRevoked(self):
+        _signUp(self.did, self.password)
+        c = Client()
+        c.cookies = SimpleCookie({'id': _signIn(self.did, self.password).cookies['id'].value})
+        self.assertResolved(c.get('/bmgt435-service/api/users/me'))
+
+        # saving the user drops it from the cache, a new auth version revokes its tokens
+        user = BMGTUser.objects.get(did=self.did)
+        user.auth_version += 1
+        user.save()
+        self.assertRejected(c.get('/bmgt435-service/api/users/me'))
+
+
     def testSignInNegative(self):
         did = 'did'
         pwd = 'pa3232.ssword'
@@ -183,7 +276,7 @@ class TestAuthApi(AppTestCaeBase):
         req = RequestFactory().post(
             '/bmgt435-service/api/auth/sign-out',
         )
-        req.COOKIES['id'] = 1
+        req.COOKIES.update(_sessionCookies(1))
         respSignOut = AuthApi.sign_out(req)
         self.assertResolved(respSignOut)
 
@@ -219,9 +312,9 @@ class TestUserApi(AppTestCaeBase):
         req = RequestFactory().get(
             'bmgt435-service/api/users/me',
         )
-        req.COOKIES['id'] = 1
+        req.COOKIES.update(_sessionCookies(1))
 
-        resp = UserApi.me(req)
+        resp = _callView(UserApi.me, req)
         self.assertResolved(resp)
 
 
@@ -244,7 +337,7 @@ class TestGroupApi(AppTestCaeBase):
         BMGTUser.objects.create(first_name='first321', last_name='last232', did='did232', role='user', activated=1, password='Grave11.')
         BMGTSemester.objects.create(year=2022, season='fall')
         BMGTGroup.objects.create(number = 1, semester = BMGTSemester.objects.get(year=2022, season='fall'))
-        self.cookies = {'id':1}
+        self.cookies = _sessionCookies(1)
         self.paginatedParams = {'page':1, 'size':10}
 
     
@@ -296,6 +389,21 @@ class TestGroupApi(AppTestCaeBase):
         self.assertEqual(BMGTUser.objects.get(id=1).group_id, None, 'leave group failed')
 
 
+    async def testGroupSuiteAsyncClient(self):
+        # served through the async middleware chain, as under ASGI
+        c = AsyncClient()
+        c.cookies = SimpleCookie(self.cookies)
+        resp = await c.post('/bmgt435-service/api/groups/join', json.dumps({'group_id':1}), content_type='application/json')
+        self.assertResolved(resp)
+        resp = await c.get('/bmgt435-service/api/groups/me')
+        self.assertResolved(resp)
+        self.assertEqual(self._deserialize_resp_data(resp)['data']['users'][0]['group_id'], 1)
+
+        c.cookies = SimpleCookie({'id':-1})
+        resp = await c.get('/bmgt435-service/api/groups/me')
+        self.assertRejected(resp)
+
+
     def testJoinGroupNeg(self):
         resp = _sendPost('/bmgt435-service/api/groups/join', GroupApi.join_group, {'group_id':-1}, self.cookies)
         self.assertEqual(resp.status_code, 200)
@@ -306,6 +414,7 @@ class TestGroupApi(AppTestCaeBase):
         self.assertRejected(resp)
 
 
+@override_settings(SIMULATION_WORKERS=0)
 class TestCaseAndRecordApi(AppTestCaeBase):
     def setUp(self):
         BMGTUser.objects.create(first_name='f', last_name='l', did='did', role='admin', activated=1, password='Grave11.')
@@ -314,8 +423,9 @@ class TestCaseAndRecordApi(AppTestCaeBase):
         BMGTSemester.objects.create(year=2022, season='fall')
         BMGTGroup.objects.create(number = 1, semester = BMGTSemester.objects.get(year=2022, season='fall'))
         BMGTCase.objects.create(name = 'food center', visible = True, max_submission = -1)
-        self.cookies = {'id':1}
+        self.cookies = _sessionCookies(1)
         self.paginatedParams = {'page':1, 'size':10}
+        admission_controller.clear()
 
         _sendPost('/bmgt435-service/api/groups/join', GroupApi.join_group, {'group_id':1}, self.cookies)
 
@@ -351,6 +461,266 @@ class TestCaseAndRecordApi(AppTestCaeBase):
         self.assertResolved(resp)
 
 
+    def testLeaderboardRanks(self):
+        semester = BMGTSemester.objects.get(year=2022, season='fall')
+        group2 = BMGTGroup.objects.create(number=2, semester=semester)
+        member = BMGTUser.objects.create(first_name='f', last_name='l', did='ranked', activated=True, group=group2, semester=semester)
+        BMGTUser.objects.filter(id=1).update(semester=semester)
+        user = BMGTUser.objects.get(id=1)
+        records = []
+        for i, (submitter, metric) in enumerate([(user, 3.0), (member, 5.0), (user, 4.0), (member, 1.0)]):
+            records.append(BMGTCaseRecord.objects.create(
+                user=submitter, group_id=submitter.group_id, case_id=1, state=BMGTCaseRecord.State.SUCCESS,
+                file_name=f'ranked-{i}', performance_metric=metric, score=metric, semester=semester if i < 3 else None,
+            ))
+        for record in records[:3]:
+            add_leaderboard_entry(record)
+        # the last record predates the semester column and was never ranked
+        out = io.StringIO()
+        call_command('backfill_case_records', '--batch-size', '1', stdout=out)
+        self.assertIn('backfilled the semester of 1 case records', out.getvalue())
+        self.assertIn('ranked 1 case records', out.getvalue())
+
+        resp = _sendGet('/bmgt435-service/api/leader-board/paginated', CaseRecordApi.leader_board_paginated, self.cookies, {'page': 1, 'size': 10, 'case_id': 1})
+        data = self._deserialize_resp_data(resp)['data']
+        self.assertEqual([(r['performance_metric'], r['rank']) for r in data['data']], [(5.0, 1), (4.0, 2), (3.0, 3), (1.0, 4)])
+
+        resp = _sendGet('/bmgt435-service/api/leader-board/paginated', CaseRecordApi.leader_board_paginated, self.cookies, {'page': 2, 'size': 1, 'case_id': 1, 'per_group': '1'})
+        data = self._deserialize_resp_data(resp)['data']
+        self.assertEqual(data['totalPage'], 2)
+        self.assertEqual([(r['group_id'], r['performance_metric']) for r in data['data']], [(1, 4.0)])
+
+        resp = _sendGet('/bmgt435-service/api/leader-board/rank', CaseRecordApi.leader_board_rank, self.cookies, {'case_id': 1})
+        data = self._deserialize_resp_data(resp)['data']
+        self.assertEqual((data['id'], data['rank'], data['group_rank']), (records[2].id, 2, 2))
+
+        # removing a record closes its gap
+        records[1].delete()
+        self.assertEqual(list(BMGTLeaderboardEntry.objects.order_by('rank').values_list('rank', 'group_rank')), [(1, 1), (2, None), (3, 2)])
+
+        # a failed record leaves the leaderboard with its submission
+        fail_case_records(BMGTCaseRecord.objects.filter(id=records[2].id))
+        self.assertEqual(list(BMGTLeaderboardEntry.objects.order_by('rank').values_list('case_record_id', 'rank', 'group_rank')), [(records[0].id, 1, 1), (records[3].id, 2, 2)])
+
+
+    def testLeaderboardFollowsRenames(self):
+        def leaderboard_names():
+            resp = _sendGet('/bmgt435-service/api/leader-board/paginated', CaseRecordApi.leader_board_paginated, self.cookies, {'page': 1, 'size': 10, 'case_id': 1})
+            return [(r['group_name'], r['user_name']) for r in self._deserialize_resp_data(resp)['data']['data']]
+
+        semester = BMGTSemester.objects.get(year=2022, season='fall')
+        BMGTUser.objects.filter(id=1).update(semester=semester)
+        user = BMGTUser.objects.get(id=1)
+        record = BMGTCaseRecord.objects.create(
+            user=user, group_id=user.group_id, case_id=1, semester_id=user.semester_id, state=BMGTCaseRecord.State.SUCCESS,
+            file_name='renamed', performance_metric=1.0,
+        )
+        add_leaderboard_entry(record)
+        self.assertEqual(leaderboard_names(), [(user.group.name, user.name)])
+
+        # the cached page is not served once its group or user is renamed
+        group = user.group
+        group.number = 7
+        group.save()
+        user.first_name = 'Renamed'
+        user.save(update_fields=['first_name'])
+        self.assertEqual(leaderboard_names(), [('Group 7', BMGTUser.format_name('Renamed', user.last_name))])
+
+        version = resource_versions(leaderboard_resource(1, user.semester_id))
+        user.save(update_fields=['password'])
+        self.assertEqual(resource_versions(leaderboard_resource(1, user.semester_id)), version)
+
+
+    def testIncrementalLeaderboardRanks(self):
+        semester = BMGTSemester.objects.get(year=2022, season='fall')
+        groups = [BMGTGroup.objects.get(id=1)] + [BMGTGroup.objects.create(number=n, semester=semester) for n in (2, 3)]
+        records = []
+        for i, (group, metric, score) in enumerate([(0, 3.0, 1.0), (1, 5.0, None), (2, 3.0, 2.0), (0, 6.0, 1.0), (1, 3.0, 1.0), (None, 4.0, 1.0), (2, 5.0, 0.5), (0, 1.0, None)]):
+            record = BMGTCaseRecord.objects.create(
+                user_id=1, group=None if group is None else groups[group], case_id=1, state=BMGTCaseRecord.State.SUCCESS,
+                file_name=f'incremental-{i}', performance_metric=metric, score=score, semester=semester,
+            )
+            add_leaderboard_entry(record)
+            records.append(record)
+
+        def ranks():
+            return list(BMGTLeaderboardEntry.objects.order_by('id').values_list('rank', 'group_rank'))
+
+        # each insert and delete shifts ranks to where a full renumbering puts them
+        def assertRenumbered():
+            incremental = ranks()
+            rank_leaderboard(1, semester.id)
+            self.assertEqual(incremental, ranks())
+
+        assertRenumbered()
+        for record in (records[3], records[1], records[5]):
+            record.delete()
+            assertRenumbered()
+        fail_case_records(BMGTCaseRecord.objects.filter(id__in=[records[0].id, records[6].id]))
+        assertRenumbered()
+        self.assertEqual(BMGTLeaderboardEntry.objects.count(), 3)
+
+
+    def testSubmissionQuota(self):
+        case = BMGTCase.objects.get(id=1)
+        group = BMGTGroup.objects.get(id=1)
+        case.max_submission = 3
+        case.save()
+        BMGTCaseRecord.objects.create(user_id=1, group=group, case=case, state=BMGTCaseRecord.State.SUCCESS, file_name='quota-0')
+        BMGTCaseRecord.objects.create(user_id=1, group=group, case=case, state=BMGTCaseRecord.State.FAILED, file_name='quota-1')
+
+        # the counter starts from the records so far, then each claim is one conditional update
+        self.assertTrue(claim_submission(case, group))
+        with self.assertNumQueries(3):  # the update and its savepoint
+            self.assertTrue(claim_submission(case, group))
+        self.assertFalse(claim_submission(case, group))
+        self.assertEqual(BMGTSubmissionQuota.objects.get(group=group, case=case).used, 3)
+
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertRejected(resp)
+
+        # failing a record returns its submission
+        self.assertEqual(fail_case_records(BMGTCaseRecord.objects.filter(file_name__startswith='quota')), 1)
+        self.assertEqual(BMGTSubmissionQuota.objects.get(group=group, case=case).used, 2)
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertResolved(resp)
+        self.assertEqual(BMGTSubmissionQuota.objects.get(group=group, case=case).used, 3)
+
+
+    def testCaseRecordQueryPlans(self):
+        out = io.StringIO()
+        call_command('case_record_query_plans', '--semesters', '2', '--groups', '2', '--records', '5', '--repeat', '1', stdout=out)
+        self.assertIn('backfilled the semester of 20 case records', out.getvalue())
+        self.assertIn('case_record_submission_index', out.getvalue().split('=== with indexes ===')[1])
+        self.assertFalse(BMGTSemester.objects.filter(year__gte=2900).exists())
+
+
+    def testCaseRecordReportsCompletion(self):
+        params = _makeFoodCenterCaseParams()
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+        self.assertResolved(resp)
+        submitted = self._deserialize_resp_data(resp)['data']
+        self.assertEqual(submitted['state'], 'Success')
+
+        resp = _sendGet('/bmgt435-service/api/case-records/get', CaseRecordApi.get_case_record, self.cookies, {'id': submitted['case_record_id']})
+        self.assertResolved(resp)
+        record = self._deserialize_resp_data(resp)['data']
+        self.assertEqual(record['state'], 'Success')
+        self.assertEqual(record['summary'], submitted['summary'])
+
+
+    def testDownloadCaseRecord(self):
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertResolved(resp)
+        file_name = BMGTCaseRecord.objects.get(id=self._deserialize_resp_data(resp)['data']['case_record_id']).file_name
+        resp = _callView(CaseRecordApi.download_case_record, RequestFactory().get(f'/bmgt435-service/api/case-records/{file_name}'), file_name)
+        self.assertEqual(resp['Content-Type'], 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+        # the checkpoint written next to the record is not served
+        with open(CASE_RECORD_PATH + file_name + CHECKPOINT_SUFFIX, 'wb') as file:
+            file.write(b'checkpoint')
+        self.addCleanup(os.remove, CASE_RECORD_PATH + file_name + CHECKPOINT_SUFFIX)
+        resp = _callView(CaseRecordApi.download_case_record, RequestFactory().get(f'/bmgt435-service/api/case-records/{file_name}{CHECKPOINT_SUFFIX}'), file_name + CHECKPOINT_SUFFIX)
+        self.assertRejected(resp)
+
+
+    def testCaseRecordSummaryLiterals(self):
+        record = BMGTCaseRecord(state=BMGTCaseRecord.State.SUCCESS, summary_dict=json.dumps({'note': "group's best", 'flag': True, 'missing': None}))
+        self.assertEqual(record.summary, {'note': "group's best", 'flag': True, 'missing': None})
+        # summaries of older records are python literals
+        record.summary_dict = str({'note': "group's best", 'flag': True, 'missing': None})
+        self.assertEqual(record.summary, {'note': "group's best", 'flag': True, 'missing': None})
+
+
+    def testSubmitCaseCached(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(RESULT_CACHE_DIR=directory):
+            params = _makeFoodCenterCaseParams()
+            resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+            self.assertResolved(resp)
+
+            # the same centers in another order are the same submission
+            params['case_params']['centers'].reverse()
+            params['case_params']['policies'].reverse()
+            resp2 = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+            self.assertResolved(resp2)
+        first = self._deserialize_resp_data(resp)['data']
+        second = self._deserialize_resp_data(resp2)['data']
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(first['summary'], second['summary'])
+        self.assertEqual(BMGTCaseRecord.objects.filter(state=BMGTCaseRecord.State.SUCCESS).count(), 2)
+
+
+    @override_settings(SIMULATION_GROUP_MAX_CONCURRENT=1)
+    def testSubmitCaseAdmission(self):
+        params = _makeFoodCenterCaseParams()
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+        self.assertResolved(resp)
+        BMGTCaseRecord.objects.create(user_id=1, group_id=1, case_id=1, state=BMGTCaseRecord.State.RUNNING, file_name='running')
+
+        # a cached result does not bypass the limits
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreaterEqual(int(resp['Retry-After']), 1)
+        self.assertRejected(resp)
+        self.assertEqual(BMGTCaseRecord.objects.count(), 2)
+
+        BMGTCaseRecord.objects.filter(file_name='running').update(state=BMGTCaseRecord.State.FAILED)
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+        self.assertResolved(resp)
+
+
+    @override_settings(SIMULATION_GROUP_BURST=1, SIMULATION_GROUP_RATE_PER_MINUTE=0.01)
+    def testSubmitCaseAdmissionRefunded(self):
+        case = BMGTCase.objects.get(id=1)
+        case.max_submission = 0
+        case.save()
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertRejected(resp)
+        self.assertEqual(resp.status_code, 200)
+
+        # the submission over the limit did not spend the only token of the group
+        case.max_submission = -1
+        case.save()
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertResolved(resp)
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertEqual(resp.status_code, 429)
+
+
+    async def testProgressStreamReportsResult(self):
+        c = AsyncClient()
+        c.cookies = SimpleCookie(self.cookies)
+        resp = await c.post('/bmgt435-service/api/cases/submit', json.dumps(_makeFoodCenterCaseParams()), content_type='application/json')
+        self.assertResolved(resp)
+        case_record_id = self._deserialize_resp_data(resp)['data']['case_record_id']
+
+        resp = await c.get('/bmgt435-service/api/case-records/progress', {'id': case_record_id})
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        events = b''.join([chunk async for chunk in resp.streaming_content]).decode().strip().split('\n\n')
+        self.assertEqual(len(events), 1)
+        event, data = events[0].split('\n')
+        self.assertEqual(event, 'event: result')
+        self.assertEqual(json.loads(data.removeprefix('data: '))['state'], 'Success')
+
+        resp = await c.get('/bmgt435-service/api/case-records/progress', {'id': -1})
+        self.assertRejected(resp)
+
+
+    async def testProgressStreamFollowsOtherProcesses(self):
+        # a record simulated by another process is only known through the progress it shares on the record
+        event = {'id': 0, 'state': 'Running', 'progress': 0.5, 'weeks_done': 1, 'weeks_total': 2, 'eta_seconds': 1.0}
+        record = await BMGTCaseRecord.objects.acreate(user_id=1, group_id=1, case_id=1, state=BMGTCaseRecord.State.RUNNING, file_name='elsewhere')
+        event['id'] = record.id
+        await BMGTCaseRecord.objects.filter(id=record.id).aupdate(progress_json=json.dumps(event))
+        stream = case_record_events(record.id)
+        self.assertEqual(await anext(stream), sse_message('progress', event))
+
+        await BMGTCaseRecord.objects.filter(id=record.id).aupdate(state=BMGTCaseRecord.State.FAILED)
+        self.assertTrue((await asyncio.wait_for(anext(stream), 5)).startswith('event: result'))
+        await stream.aclose()
+
+
     def testSubmitCaseNegative(self):
         params = _makeFoodCenterCaseParams()
         negativeCookies = self.cookies.copy()
@@ -383,10 +753,260 @@ class TestManageApi(AppTestCaeBase):
 
         BMGTCase.objects.create(name = 'food center', visible = True, max_submission = -1)
 
-        self.cookies = {'id':1}
+        self.cookies = _sessionCookies(1)
         self.paginatedParams = {'page':1, 'size':10}
 
     
+    def testPaginatedQueryCount(self):
+        group = BMGTGroup.objects.get(number=1)
+        BMGTUser.objects.filter(id=3).update(group=group, semester=group.semester)
+        for i in range(20):
+            BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, state=BMGTCaseRecord.State.SUCCESS, file_name=f'page-{i}')
+        BMGTCaseConfig.objects.create(case_id=1, config_json='{}')
+
+        # one count and one page query, however many rows the page serializes
+        for model in (BMGTCaseRecord, BMGTUser, BMGTCaseConfig):
+            with self.assertNumQueries(2):
+                generic_paginated_query(model, create_pager_params(1, 50, ['-id']))
+
+
+    def testValuesSerializationMatchesModels(self):
+        group = BMGTGroup.objects.get(number=1)
+        BMGTUser.objects.filter(id=3).update(group=group, semester=group.semester)
+        BMGTUser.objects.create(first_name='', last_name='', did='anonymous')
+        record = BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, semester=group.semester, state=BMGTCaseRecord.State.SUCCESS, file_name='values-0', score=1.0, performance_metric=2.0)
+        BMGTCaseRecord.objects.create(case_id=1, state=BMGTCaseRecord.State.FAILED, file_name='values-1')
+        BMGTCaseConfig.objects.create(case_id=1, config_json='{}')
+        BMGTTransaction.objects.create(user_id=1, method='GET', path='/values')
+        add_leaderboard_entry(record)
+
+        for model in (BMGTSemester, BMGTGroup, BMGTUser, BMGTCase, BMGTCaseConfig, BMGTCaseRecord, BMGTLeaderboardEntry, BMGTTransaction):
+            expected = [obj.as_dictionary() for obj in model.objects.order_by('id')]
+            self.assertTrue(expected, model.__name__)
+            self.assertEqual(model.serialize_queryset(model.objects.order_by('id')), expected, model.__name__)
+
+
+    def testSparseFieldsets(self):
+        group = BMGTGroup.objects.get(number=1)
+        BMGTUser.objects.filter(id=3).update(group=group, semester=group.semester)
+        BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, state=BMGTCaseRecord.State.SUCCESS, file_name='sparse-0')
+
+        # only the requested keys, and no joins for columns of the table itself
+        with CaptureQueriesContext(connection) as queries:
+            data = generic_paginated_query(BMGTCaseRecord, create_pager_params(1, 10, ['-id'], fields=['id', 'state']))
+        self.assertEqual(list(data['data'][0].keys()), ['id', 'state'])
+        self.assertFalse(any('JOIN' in query['sql'] for query in queries.captured_queries))
+
+        # rosters are only read when users are requested
+        with self.assertNumQueries(2):
+            data = generic_paginated_query(BMGTGroup, create_pager_params(1, 10, ['id'], fields=['name']))
+        self.assertEqual(data['data'], [{'name': 'Group 1'}, {'name': 'Group 2'}])
+        with self.assertNumQueries(3):
+            data = generic_paginated_query(BMGTGroup, create_pager_params(1, 10, ['id'], fields=['users']))
+        self.assertEqual([[user['id'] for user in group['users']] for group in data['data']], [[3], []])
+        data = generic_paginated_query(BMGTGroup, {'cursor': '', 'size': 10, 'order': ['id']})
+        self.assertEqual(len(data['data'][0]['users']), 1)
+
+        with self.assertRaises(ValueError):
+            generic_paginated_query(BMGTUser, create_pager_params(1, 10, ['-id'], fields=['password']))
+
+        resp = _sendGet('/bmgt435-service/api/manage/user/view', ManageApi.view_users, self.cookies, {'page': '1', 'size': '10', 'fields': 'did,group_name'})
+        users = self._deserialize_resp_data(resp)['data']['data']
+        self.assertIn({'did': 'did232', 'group_name': 'Group 1'}, users)
+        self.assertTrue(all(user.keys() == {'did', 'group_name'} for user in users))
+
+
+    def testStreamingExports(self):
+        for i in range(30):
+            BMGTUser.objects.create(first_name='f', last_name=str(i), did=f'export{i}', group_id=1 + i % 2)
+        BMGTTransaction.objects.create(user_id=1, method='GET', path='/export', status_code=200)
+
+        request = RequestFactory().get('/bmgt435-service/api/manage/users/export', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        request.COOKIES.update(self.cookies)
+        resp = _callView(ManageApi.export_users, request)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        users = json.loads(gzip.decompress(b''.join(async_to_sync(_readStream)(resp))))['data']
+        self.assertEqual(users, [user.as_dictionary() for user in BMGTUser.objects.order_by('id')])
+
+        # rosters are read per chunk
+        groups = async_to_sync(_readStream)(iterate_serialized(BMGTGroup, BMGTGroup.objects.order_by('id'), chunk_size=1))
+        self.assertEqual(groups, [group.as_dictionary() for group in BMGTGroup.objects.order_by('id')])
+
+        resp = _sendGet('/bmgt435-service/api/manage/transactions/export', ManageApi.export_transactions, self.cookies, {'fields': 'path,status_code'})
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(b''.join(async_to_sync(_readStream)(resp)))['data'], [{'path': '/export', 'status_code': 200}])
+
+        resp = _sendGet('/bmgt435-service/api/manage/users/export', ManageApi.export_users, self.cookies, {'fields': 'password'})
+        self.assertRejected(resp)
+
+
+    async def testStreamingExportsThroughAsgi(self):
+        await BMGTUser.objects.abulk_create([BMGTUser(first_name='f', last_name=str(i), did=f'asgi{i}') for i in range(1200)])
+        token = await sync_to_async(sign_session_token)(await BMGTUser.objects.aget(id=1))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/bmgt435-service/api/manage/users/export', 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'cookie', f'id={token}'.encode())],
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        requested = False
+        async def receive():
+            nonlocal requested
+            if requested:
+                await asyncio.Event().wait()
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        messages = []
+        async def send(message):
+            messages.append(message)
+
+        # the test database connection is kept open across the request
+        request_started.disconnect(close_old_connections)
+        try:
+            with warnings.catch_warnings():
+                # a sync iterator would be buffered with a warning
+                warnings.simplefilter('error')
+                await ASGIHandler()(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+        bodies = [message for message in messages if message['type'] == 'http.response.body']
+        # the opening, one message per chunk of rows and the end
+        self.assertGreater(len(bodies), 3)
+        self.assertTrue(all(body['more_body'] for body in bodies[:-1]))
+        users = json.loads(b''.join(body.get('body', b'') for body in bodies))['data']
+        self.assertEqual(len(users), await BMGTUser.objects.acount())
+        self.assertEqual([user['id'] for user in users], sorted(user['id'] for user in users))
+
+
+    def testConditionalRequests(self):
+        def get_semesters(etag=None):
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            request = RequestFactory().get('/bmgt435-service/api/manage/semesters/all', **headers)
+            request.COOKIES.update(self.cookies)
+            return _callView(ManageApi.get_semesters, request)
+
+        resp = get_semesters()
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+
+        # only the version lookup runs for an unchanged resource
+        with self.assertNumQueries(1):
+            resp = get_semesters(etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], etag)
+
+        BMGTSemester.objects.create(year=2023, season='spring')
+        resp = get_semesters(etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(len(self._deserialize_resp_data(resp)['data']), 2)
+
+        # leaderboards are versioned whenever they are reranked
+        group = BMGTGroup.objects.get(number=1)
+        resource = leaderboard_resource(1, group.semester_id)
+        version = resource_versions(resource)[resource]
+        record = BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, semester=group.semester, state=BMGTCaseRecord.State.SUCCESS, file_name='versioned', performance_metric=1.0)
+        add_leaderboard_entry(record)
+        self.assertEqual(resource_versions(resource)[resource], version + 1)
+
+
+    def testResponseCache(self):
+        def get_semesters():
+            request = RequestFactory().get('/bmgt435-service/api/manage/semesters/all')
+            request.COOKIES.update(self.cookies)
+            return _callView(ManageApi.get_semesters, request)
+
+        first = get_semesters()
+        # the cached bytes are served after the version lookup
+        with self.assertNumQueries(1):
+            cached = get_semesters()
+        self.assertEqual(cached.content, first.content)
+        self.assertEqual(cached['ETag'], first['ETag'])
+
+        # saving a semester drops its cached responses and moves the key
+        semester = BMGTSemester.objects.create(year=2023, season='spring')
+        self.assertEqual(len(self._deserialize_resp_data(get_semesters())['data']), 2)
+        semester.delete()
+        self.assertEqual(len(self._deserialize_resp_data(get_semesters())['data']), 1)
+
+
+    def testGroupRosterPrefetched(self):
+        semester = BMGTSemester.objects.get(year=2022, season='fall')
+        BMGTUser.objects.filter(role='user').update(group_id=1, semester=semester)
+        BMGTUser.objects.filter(role='admin').update(group_id=2)
+        for i in range(8):
+            BMGTUser.objects.create(first_name='f', last_name='l', did=f'roster{i}', group_id=1 + i % 2, semester=semester)
+
+        # count, groups, and one roster query for the whole page
+        with self.assertNumQueries(3):
+            data = generic_paginated_query(BMGTGroup, create_pager_params(1, 50, ['id']))
+        self.assertEqual([len(group['users']) for group in data['data']], [5, 6])
+        self.assertTrue(all(user['semester_name'] == '2022-fall' for user in data['data'][0]['users']))
+        self.assertTrue(all(user['group_name'] == 'Group 2' for user in data['data'][1]['users']))
+
+
+    def testCursorPagination(self):
+        group = BMGTGroup.objects.get(number=1)
+        for i in range(25):
+            BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, state=BMGTCaseRecord.State.SUCCESS, file_name=f'cursor-{i}', score=i % 4)
+        expected = list(BMGTCaseRecord.objects.order_by('-score', '-id').values_list('id', flat=True))
+
+        # walk forward, then back, through pages ordered by a non-unique column
+        pages, cursor = [], ''
+        while cursor is not None:
+            data = generic_paginated_query(BMGTCaseRecord, {'cursor': cursor, 'size': 10, 'order': ['-score']})
+            self.assertEqual(data['total'], 25)
+            pages.append(data)
+            cursor = data['next']
+        self.assertEqual([len(page['data']) for page in pages], [10, 10, 5])
+        self.assertEqual([record['id'] for page in pages for record in page['data']], expected)
+        self.assertIsNone(pages[0]['previous'])
+
+        data = generic_paginated_query(BMGTCaseRecord, {'cursor': pages[2]['previous'], 'size': 10, 'order': ['-score']})
+        self.assertEqual(data['data'], pages[1]['data'])
+        data = generic_paginated_query(BMGTCaseRecord, {'cursor': data['previous'], 'size': 10, 'order': ['-score']})
+        self.assertEqual(data['data'], pages[0]['data'])
+        self.assertIsNone(data['previous'])
+
+        # a deep page is one seek query once the total is cached
+        with self.assertNumQueries(1):
+            generic_paginated_query(BMGTCaseRecord, {'cursor': pages[2]['previous'], 'size': 10, 'order': ['-score']})
+
+        with self.assertRaises(ValueError):
+            generic_paginated_query(BMGTCaseRecord, {'cursor': 'not-a-cursor', 'size': 10, 'order': ['-score']})
+
+        resp = _sendGet('/bmgt435-service/api/manage/case-submissions', ManageApi.case_submissions, self.cookies, {'case_id': 1, 'size': 10, 'cursor': pages[0]['next'], 'order': '-score'})
+        self.assertEqual(self._deserialize_resp_data(resp)['data']['data'], pages[1]['data'])
+
+
+    def testCursorPaginationNullOrdering(self):
+        group = BMGTGroup.objects.get(number=1)
+        for i in range(12):
+            BMGTCaseRecord.objects.create(user_id=3, group=group, case_id=1, state=BMGTCaseRecord.State.SUCCESS, file_name=f'null-{i}', score=i % 3 if i % 2 else None)
+
+        for order in [['-score'], ['score']]:
+            name = order[0].lstrip('-')
+            descending = order[0].startswith('-')
+            expected = list(BMGTCaseRecord.objects.order_by(
+                F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_last=True), '-id' if descending else 'id'
+            ).values_list('id', flat=True))
+
+            # the records without a score come last, and each row is listed once walking either way
+            pages, cursor = [], ''
+            while cursor is not None:
+                data = generic_paginated_query(BMGTCaseRecord, {'cursor': cursor, 'size': 5, 'order': order})
+                pages.append(data)
+                cursor = data['next']
+            self.assertEqual([record['id'] for page in pages for record in page['data']], expected, order)
+            self.assertEqual(pages[-1]['data'][-1]['score'], None)
+
+            for i in range(len(pages) - 1, 0, -1):
+                data = generic_paginated_query(BMGTCaseRecord, {'cursor': pages[i]['previous'], 'size': 5, 'order': order})
+                self.assertEqual(data['data'], pages[i - 1]['data'], order)
+
+
     def testImportUsersPositive(self):
         df = _makeImportUserData()
         ioBuffer = io.BytesIO()
@@ -460,7 +1080,7 @@ class TestManageApi(AppTestCaeBase):
         self.assertResolved(resp)
 
         negCookies = self.cookies.copy()
-        negCookies['id'] = 2
+        negCookies.update(_sessionCookies(2))
         resp = _sendGet('/bmgt435-service/api/manage/user/view', ManageApi.view_users, negCookies, params)
         self.assertResolved(resp)
 
@@ -479,7 +1099,7 @@ class TestManageApi(AppTestCaeBase):
     def testCreateSemesterNegative(self):
         c = Client()
         negCookies = self.cookies.copy()
-        negCookies['id'] = 2
+        negCookies.update(_sessionCookies(2))
         c.cookies = SimpleCookie(negCookies)
         resp = c.post('/bmgt435-service/api/manage/semester/create', json.dumps({'year':2022, 'season':'spring'}), content_type='application/json')
         self.assertRejected(resp)
@@ -506,7 +1126,7 @@ class TestManageApi(AppTestCaeBase):
             "case_id":1
         }
         c = Client()
-        c.cookies = SimpleCookie({'id':1})
+        c.cookies = SimpleCookie(_sessionCookies(1))
         resp = c.post('/bmgt435-service/api/manage/case-config/update', json.dumps(config), content_type='application/json')
         self.assertResolved(resp)
 
@@ -524,7 +1144,7 @@ class TestManageApi(AppTestCaeBase):
             "case_id":1
         }
         c = Client()
-        c.cookies = SimpleCookie({'id':2})
+        c.cookies = SimpleCookie(_sessionCookies(2))
         resp = c.post('/bmgt435-service/api/manage/case-config/update', json.dumps(config), content_type='application/json')
         self.assertRejected(resp)
 
@@ -545,7 +1165,7 @@ class TestManageApi(AppTestCaeBase):
             "case_id":1
         }
 
-        c.cookies = SimpleCookie({'id':1})
+        c.cookies = SimpleCookie(_sessionCookies(1))
         resp = c.post('/bmgt435-service/api/manage/case-config/update', json.dumps(badConfig), content_type='application/json')
         self.assertRejected(resp)
 
@@ -575,10 +1195,517 @@ class TestManageApi(AppTestCaeBase):
 
     def testSetCaseSubmissionLimitPositive(self):
         c = Client()
-        c.cookies = SimpleCookie({'id':1})
+        c.cookies = SimpleCookie(_sessionCookies(1))
         resp = c.post('/bmgt435-service/api/manage/case-submissions/limit', json.dumps({'case_id':1, 'max_submission':10}), content_type='application/json')
         self.assertResolved(resp)
 
         resp = c.get('/bmgt435-service/api/manage/case-submissions/limit', {'case_id':1})
         self.assertResolved(resp)
-        self.assertEqual(json.loads(resp.content)['data'], 10)
\ No newline at end of file
+        self.assertEqual(json.loads(resp.content)['data'], 10)
+
+class TestFoodDeliveryEvaluation(TestCase):
+
+    def setUp(self) -> None:
+        self.centers = ['1', '2']
+        self.policies = [(1500, 3000), (2000, 3500)]   # the restock cap can never bind for these policies
+
+
+    def testEvaluateDeterministic(self):
+        first = FoodDelivery(self.centers, self.policies).evaluate()
+        second = FoodDelivery(self.centers, self.policies).evaluate()
+        self.assertEqual(first, second)
+        self.assertEqual(first['method'], 'markov')
+
+
+    def testEvaluateMatchesSimulation(self):
+        case = FoodDelivery(self.centers, self.policies)
+        expected = case.evaluate()
+        # the simulation draws from the global numpy generator, seeded so that the comparison does not fail by chance
+        np.random.seed(435)
+        runs = [case.simulate() for _ in range(30)]
+        for key in ['total_revenue', 'total_holding_cost', 'perf_metric']:
+            simulated = np.mean([r[key] for r in runs])
+            self.assertAlmostEqual(expected[key] / simulated, 1, delta=0.02, msg=key)
+
+
+    def testEvaluateFallsBackWhenCapBinds(self):
+        params = _makeFoodCenterCaseParams()['case_params']
+        res = FoodDelivery(**params).evaluate(fallback_iterations=2)
+        self.assertEqual(res['method'], 'simulation')
+        self.assertGreater(res['cap_binding_probability'], 0)
+
+
+class TestFoodDeliveryScenarioBank(TestCase):
+
+    def setUp(self) -> None:
+        self.bankDir = tempfile.TemporaryDirectory()
+        self.params = _makeFoodCenterCaseParams()['case_params']
+
+
+    def tearDown(self) -> None:
+        self.bankDir.cleanup()
+
+
+    def testScenarioBankDeterministic(self):
+        bank = FoodDelivery.scenario_bank(self.bankDir.name, 'test-bank')
+        first = FoodDelivery(**self.params, scenario_bank=bank).run()
+        second = FoodDelivery(**self.params, scenario_bank=bank).run()
+        self.assertEqual(first.asDict(), second.asDict())
+        self.assertIs(FoodDelivery.scenario_bank(self.bankDir.name, 'test-bank'), bank)
+
+
+    def testScenarioBankPerTag(self):
+        bank = FoodDelivery.scenario_bank(self.bankDir.name, 'test-bank')
+        other = FoodDelivery.scenario_bank(self.bankDir.name, 'other-test-bank')
+        self.assertNotEqual(bank.demand(0, 0), other.demand(0, 0))
+        self.assertEqual(len(os.listdir(self.bankDir.name)), 4)
+
+
+    def testScenarioBankTagIsFileName(self):
+        for tag in ('../escaped', 'a/b', '2022 Fall', ''):
+            with self.assertRaises(ValueError):
+                FoodDelivery.scenario_bank(self.bankDir.name, tag)
+        self.assertEqual(scenario_bank_tag(BMGTSemester(id=7, year=2022, season='fall')), 'semester-7')
+
+
+    def testProgressReported(self):
+        progress = []
+        FoodDelivery(**self.params, progress=lambda done, total: progress.append((done, total))).run()
+        total = progress[0][1]
+        self.assertEqual(progress, [(week, total) for week in range(1, total + 1)])
+
+
+    def testCheckpointResume(self):
+        bank = FoodDelivery.scenario_bank(self.bankDir.name, 'test-bank')
+        first = FoodDelivery(**self.params, scenario_bank=bank).run()
+        path = os.path.join(self.bankDir.name, 'first.ckpt.npz')
+        first.checkpoint.save(path)
+        checkpoint = FoodDeliveryCheckpoint.load(path)
+
+        policies = [list(p) for p in self.params['policies']]
+        policies[-1][0] -= 500
+        self.assertGreater(checkpoint.first_divergent_week(policies), 0)
+        resumed = FoodDelivery(self.params['centers'], policies, scenario_bank=bank, checkpoint=checkpoint).run()
+        full = FoodDelivery(self.params['centers'], policies, scenario_bank=bank).run()
+        self.assertEqual(resumed.asDict(), full.asDict())
+        self.assertTrue(resumed.iterationData.equals(full.iterationData))
+
+        unchanged = FoodDelivery(**self.params, scenario_bank=bank, checkpoint=checkpoint).run()
+        self.assertEqual(checkpoint.first_divergent_week(self.params['policies']), 52)
+        self.assertEqual(unchanged.asDict(), first.asDict())
+
+
+class TestSimulationPool(SimpleTestCase):
+
+    @override_settings(SIMULATION_WORKERS=2)
+    def testSubmitReturnsBeforeJobCompletes(self):
+        pool = SimulationPool()
+        release = threading.Event()
+        finished = []
+        def job(value):
+            release.wait(5)
+            finished.append(value)
+
+        pool.submit(job, 1)
+        pool.submit(job, 2)
+        self.assertEqual(finished, [])
+        release.set()
+        pool.join()
+        self.assertEqual(sorted(finished), [1, 2])
+
+
+    @override_settings(SIMULATION_WORKERS=1)
+    def testFairQueueing(self):
+        pool = SimulationPool()
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+        def block():
+            started.set()
+            release.wait(5)
+
+        pool.submit(block, key='x')
+        started.wait(5)
+        for i in range(3):
+            pool.submit(order.append, f'a{i}', key='a')
+        pool.submit(order.append, 'b0', key='b')
+        release.set()
+        pool.join()
+        # the burst of key a does not hold back key b
+        self.assertEqual(order, ['a0', 'b0', 'a1', 'a2'])
+
+
+    @override_settings(SIMULATION_WORKERS=0)
+    def testInlineWithoutWorkers(self):
+        pool = SimulationPool()
+        finished = []
+        pool.submit(finished.append, 1)
+        self.assertEqual(finished, [1])
+
+
+@override_settings(SIMULATION_QUEUE='database')
+class TestDatabaseJobQueue(AppTestCaeBase):
+    def setUp(self):
+        BMGTUser.objects.create(first_name='f', last_name='l', did='did', role='admin', activated=1, password='Grave11.')
+        BMGTSemester.objects.create(year=2022, season='fall')
+        BMGTGroup.objects.create(number = 1, semester = BMGTSemester.objects.get(year=2022, season='fall'))
+        BMGTCase.objects.create(name = 'food center', visible = True, max_submission = -1)
+        self.cookies = _sessionCookies(1)
+        admission_controller.clear()
+        _sendPost('/bmgt435-service/api/groups/join', GroupApi.join_group, {'group_id':1}, self.cookies)
+
+
+    def _createJobs(self, count: int, max_attempts: int = 3) -> list:
+        queue = DatabaseJobQueue(max_attempts=max_attempts)
+        jobs = []
+        for i in range(count):
+            record = BMGTCaseRecord.objects.create(
+                user_id=1, group_id=1, case_id=1, state=BMGTCaseRecord.State.RUNNING, file_name=f"job-test-{i}",
+            )
+            jobs.append(queue.enqueue(record, {}))
+        return jobs
+
+
+    def testClaimIsExclusive(self):
+        jobs = self._createJobs(2)
+        queue = DatabaseJobQueue()
+        first = queue.claim('worker-1')
+        second = queue.claim('worker-2')
+        self.assertEqual([first.id, second.id], [job.id for job in jobs])
+        self.assertIsNone(queue.claim('worker-3'))
+        self.assertEqual(first.attempts, 1)
+        self.assertTrue(queue.heartbeat(first, 'worker-1'))
+        self.assertFalse(queue.heartbeat(first, 'worker-2'))
+        self.assertTrue(queue.complete(first, 'worker-1'))
+        self.assertEqual(BMGTSimulationJob.objects.get(id=first.id).state, BMGTSimulationJob.State.DONE)
+
+
+    def testExpiredLeaseRequeuedThenDeadLettered(self):
+        job, = self._createJobs(1, max_attempts=2)
+        queue = DatabaseJobQueue()
+        for attempt in range(2):
+            claimed = queue.claim(f'worker-{attempt}')
+            self.assertEqual(claimed.id, job.id)
+            BMGTSimulationJob.objects.filter(id=job.id).update(lease_expire_time=timezone.now() - datetime.timedelta(seconds=1))
+            self.assertEqual(queue.requeue_expired(), 1)
+            # the worker that lost its lease can no longer complete the job
+            self.assertFalse(queue.complete(claimed, f'worker-{attempt}'))
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, BMGTSimulationJob.State.DEAD)
+        self.assertEqual(job.last_error, 'lease expired')
+        self.assertEqual(job.case_record.state, BMGTCaseRecord.State.FAILED)
+        self.assertIsNone(queue.claim('worker-2'))
+
+
+    def testFailedJobRetried(self):
+        job, = self._createJobs(1, max_attempts=2)
+        queue = DatabaseJobQueue()
+        self.assertTrue(queue.fail(queue.claim('worker'), 'worker', 'error'))
+        self.assertEqual(BMGTSimulationJob.objects.get(id=job.id).state, BMGTSimulationJob.State.QUEUED)
+        self.assertTrue(queue.fail(queue.claim('worker'), 'worker', 'error'))
+        self.assertEqual(BMGTSimulationJob.objects.get(id=job.id).state, BMGTSimulationJob.State.DEAD)
+
+
+    @override_settings(SIMULATION_MAX_PENDING=1)
+    def testLoadShedding(self):
+        resp = Client().get('/bmgt435-service/api/health/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(self._deserialize_resp_data(resp)['data']['saturated'])
+
+        self._createJobs(1)
+        resp = Client().get('/bmgt435-service/api/health/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertGreaterEqual(int(resp['Retry-After']), 1)
+
+        bank = FoodDelivery.scenario_bank(SCENARIO_BANK_PATH, scenario_bank_tag(BMGTSemester.objects.get(id=1)))
+        params = _makeFoodCenterCaseParams()
+        RESULT_CACHE.delete(result_cache_key(1, canonical_food_delivery_params(params['case_params']), None, bank.name))
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, params, self.cookies)
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp)
+        self.assertEqual(BMGTCaseRecord.objects.count(), 1)
+
+
+    def testFailStaleCaseRecords(self):
+        queued, = self._createJobs(1)
+        abandoned = BMGTCaseRecord.objects.create(user_id=1, group_id=1, case_id=1, state=BMGTCaseRecord.State.RUNNING, file_name='abandoned')
+        recent = BMGTCaseRecord.objects.create(user_id=1, group_id=1, case_id=1, state=BMGTCaseRecord.State.RUNNING, file_name='recent')
+        BMGTCaseRecord.objects.exclude(id=recent.id).update(create_time=timezone.now() - datetime.timedelta(days=1))
+
+        self.assertEqual(fail_stale_case_records(), 1)
+        self.assertEqual(BMGTCaseRecord.objects.get(id=abandoned.id).state, BMGTCaseRecord.State.FAILED)
+        self.assertEqual(BMGTCaseRecord.objects.get(id=queued.case_record_id).state, BMGTCaseRecord.State.RUNNING)
+        self.assertEqual(BMGTCaseRecord.objects.get(id=recent.id).state, BMGTCaseRecord.State.RUNNING)
+
+
+    def testWorkerCommandRunsSubmission(self):
+        # a cached result would complete the submission without queueing it
+        bank = FoodDelivery.scenario_bank(SCENARIO_BANK_PATH, scenario_bank_tag(BMGTSemester.objects.get(id=1)))
+        params = canonical_food_delivery_params(_makeFoodCenterCaseParams()['case_params'])
+        RESULT_CACHE.delete(result_cache_key(1, params, None, bank.name))
+
+        resp = _sendPost('/bmgt435-service/api/cases/submit', CaseApi.submit, _makeFoodCenterCaseParams(), self.cookies)
+        self.assertResolved(resp)
+        submitted = self._deserialize_resp_data(resp)['data']
+        self.assertEqual(submitted['state'], 'Running')
+        self.assertEqual(BMGTSimulationJob.objects.filter(state=BMGTSimulationJob.State.QUEUED).count(), 1)
+
+        call_command('simulation_worker', '--exit-when-empty', stdout=io.StringIO())
+        record = BMGTCaseRecord.objects.get(id=submitted['case_record_id'])
+        self.assertEqual(record.state, BMGTCaseRecord.State.SUCCESS)
+        self.assertEqual(BMGTSimulationJob.objects.get(case_record=record).state, BMGTSimulationJob.State.DONE)
+
+
+@override_settings(SIMULATION_GROUP_BURST=2, SIMULATION_GROUP_RATE_PER_MINUTE=60, SIMULATION_GROUP_MAX_CONCURRENT=1)
+class TestAdmissionController(SimpleTestCase):
+
+    def testTokenBucket(self):
+        controller = AdmissionController()
+        self.assertEqual(controller.admit('a', [], now=0), 0)
+        self.assertEqual(controller.admit('a', [], now=0), 0)
+        self.assertAlmostEqual(controller.admit('a', [], now=0), 1.0)
+        self.assertAlmostEqual(controller.admit('a', [], now=0.5), 0.5)
+        self.assertEqual(controller.admit('a', [], now=1.0), 0)
+        # buckets are per key
+        self.assertEqual(controller.admit('b', [], now=1.0), 0)
+
+
+    def testConcurrencyLimit(self):
+        controller = AdmissionController()
+        controller.record_duration(10)
+        self.assertAlmostEqual(controller.admit('a', [4.0], now=0), 6.0)
+        self.assertAlmostEqual(controller.admit('a', [12.0], now=0), 1.0)
+        self.assertEqual(controller.admit('a', [], now=0), 0)
+
+
+class TestInMemoryCache(SimpleTestCase):
+
+    def testLeastRecentlyUsedEvicted(self):
+        cache = InMemoryCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+
+    def testExpiryAndTags(self):
+        cache = InMemoryCache(ttl=60)
+        cache.set('expired', 1, ttl=-1)
+        cache.set('case', 2, tags=['case'])
+        cache.set('semester', 3, tags=['semester'])
+        self.assertEqual(cache.get('expired', 'missing'), 'missing')
+        cache.invalidate('case')
+        self.assertEqual(cache.get('case'), None)
+        self.assertEqual(cache.get('semester'), 3)
+
+
+    def testSingleFlight(self):
+        cache = InMemoryCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(cache.get_or_query('key', query)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(cache.get_or_query('key', query))) for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+    def testRacedInvalidationNotStored(self):
+        cache = InMemoryCache()
+        def query():
+            cache.invalidate('case')
+            return 'stale'
+
+        self.assertEqual(cache.get_or_query('key', query, tags=['case']), 'stale')
+        self.assertEqual(cache.get_or_query('key', lambda: 'fresh', tags=['case']), 'fresh')
+
+
+    def testSharedBackend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = InMemoryCache(ttl=60, backend=DiskLRUCache(directory, 1024 * 1024))
+            reader = InMemoryCache(ttl=60, backend=DiskLRUCache(directory, 1024 * 1024))
+            writer.get_or_query('key', lambda: b'shared')
+            self.assertEqual(reader.get_or_query('key', lambda: b'queried'), b'shared')
+            writer.clear()
+            self.assertEqual(InMemoryCache(backend=DiskLRUCache(directory, 1024 * 1024)).get('key'), None)
+
+
+class TestDiskLRUCache(SimpleTestCase):
+
+    def testValuesRoundTrip(self):
+        value = {'summary': {'cost': 1.5, 'weeks': [1, 2]}, 'file': b'\x00xlsx\n', 'checkpoint': None, 'entry': ('key', (200, b'{}', 'application/json'), float('inf'), frozenset(['case']))}
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskLRUCache(directory, 1024 * 1024)
+            cache.set('key', value)
+            self.assertEqual(DiskLRUCache(directory, 1024 * 1024).get('key'), value)
+            with self.assertRaises(TypeError):
+                cache.set('object', object())
+
+
+    def testEntriesAreNotUnpickled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskLRUCache(directory, 1024 * 1024)
+            cache.set('key', b'value')
+            path, = [entry.path for entry in os.scandir(directory)]
+            with open(path, 'wb') as file:
+                file.write(b"cos\nsystem\n(S'exit 1'\ntR.")
+            self.assertIsNone(cache.get('key'))
+
+
+    def testEvictsLeastRecentlyUsed(self):
+        with tempfile.TemporaryDirectory() as parent:
+            directory = os.path.join(parent, 'cache')
+            cache = DiskLRUCache(lambda: directory, 3000)
+            self.assertIsNone(cache.get('missing'))
+            self.assertFalse(os.path.exists(directory))    # created by the first write
+            for i in range(3):
+                cache.set(f'key-{i}', bytes(900))
+                os.utime(os.path.join(directory, hashlib.sha256(f'key-{i}'.encode()).hexdigest() + '.entry'), (i, i))
+            # a hit makes the oldest entry the most recently used
+            cache.get('key-0')
+            cache.set('key-3', bytes(900))
+            self.assertIsNotNone(cache.get('key-0'))
+            self.assertIsNone(cache.get('key-1'))
+            self.assertIsNotNone(cache.get('key-3'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0'])
+class TestDatabaseRouter(SimpleTestCase):
+
+    def testRequestReadsItsWrites(self):
+        router = BMGT435_DB_Router()
+        # reads outside requests stay on the primary
+        self.assertEqual(router.db_for_read(BMGTCase), 'default')
+        routing, token = begin_request_routing(pinned=False)
+        try:
+            self.assertEqual(router.db_for_read(BMGTCase), 'replica_0')
+            self.assertEqual(router.db_for_write(BMGTCase), 'default')
+            self.assertTrue(routing.wrote)
+            self.assertEqual(router.db_for_read(BMGTCase), 'default')
+        finally:
+            end_request_routing(token)
+        self.assertFalse(router.allow_migrate('replica_0', 'bmgt435_elp'))
+
+
+    def testClientPinnedAfterWrite(self):
+        router = BMGT435_DB_Router()
+        reads = []
+        def view(request):
+            reads.append(router.db_for_read(BMGTCase))
+            if request.method == 'POST':
+                router.db_for_write(BMGTCase)
+            return HttpResponse()
+
+        middleware = DatabaseRoutingMiddleware(view)
+        resp = middleware(RequestFactory().get('/'))
+        self.assertNotIn('primary', resp.cookies)
+        resp = middleware(RequestFactory().post('/'))
+        self.assertEqual(resp.cookies['primary']['max-age'], 5)
+        request = RequestFactory().get('/')
+        request.COOKIES['primary'] = '1'
+        middleware(request)
+        self.assertEqual(reads, ['replica_0', 'default', 'default'])
+
+
+@override_settings(DATABASE_WRITE_RETRIES=2, DATABASE_WRITE_RETRY_BACKOFF_SECONDS=0)
+class TestLockedWriteRetry(SimpleTestCase):
+
+    def testRetriedUntilBound(self):
+        attempts = []
+        @retry_on_locked
+        def write(failures):
+            attempts.append(1)
+            if len(attempts) <= failures:
+                raise OperationalError('database is locked')
+            return 'written'
+
+        self.assertEqual(write(2), 'written')
+        self.assertEqual(len(attempts), 3)
+        attempts.clear()
+        with self.assertRaises(OperationalError):
+            write(3)
+        self.assertEqual(len(attempts), 3)
+
+
+    def testOtherErrorsNotRetried(self):
+        attempts = []
+        @retry_on_locked
+        def write():
+            attempts.append(1)
+            raise OperationalError('no such table: bmgt435_elp_bmgtcase')
+
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(attempts), 1)
+
+
+class TestSqliteProfile(TestCase):
+
+    def testPragmasApplied(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        def pragmas():
+            with connection.cursor() as cursor:
+                return {name: cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in ('busy_timeout', 'cache_size')}
+
+        connection.ensure_connection()
+        self.assertEqual(pragmas()['busy_timeout'], settings.SQLITE_PRAGMAS['busy_timeout'])
+        applied = pragmas()
+        with override_settings(SQLITE_PRAGMAS={'busy_timeout': 1234, 'cache_size': -4000}):
+            configure_sqlite(connection)
+        self.assertEqual(pragmas(), {'busy_timeout': 1234, 'cache_size': -4000})
+        with override_settings(SQLITE_PRAGMAS=applied):
+            configure_sqlite(connection)
+
+
+    @override_settings(DATABASE_WRITE_RETRIES=2, DATABASE_WRITE_RETRY_BACKOFF_SECONDS=0)
+    def testNestedTransactionNotRetried(self):
+        attempts = []
+        @retry_on_locked
+        def write():
+            attempts.append(1)
+            raise OperationalError('database is locked')
+
+        # tests run inside a transaction, which a retry could not replay
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(attempts), 1)
+
+
+class TestProgressBroker(SimpleTestCase):
+
+    async def testPublishFromAnotherThread(self):
+        broker = ProgressBroker()
+        queue = broker.subscribe(1)
+        publisher = threading.Thread(target=broker.publish, args=(1, {'progress': 0.5}))
+        publisher.start()
+        self.assertEqual(await asyncio.wait_for(queue.get(), 5), {'progress': 0.5})
+        publisher.join()
+
+        # late subscribers start from the latest event until it is discarded
+        late = broker.subscribe(1)
+        self.assertEqual(late.get_nowait(), {'progress': 0.5})
+        broker.discard(1)
+        self.assertTrue(broker.subscribe(1).empty())
+
+        broker.unsubscribe(1, queue)
+        broker.publish(1, {'progress': 1})
+        self.assertTrue(queue.empty())
+        self.assertEqual(await asyncio.wait_for(late.get(), 5), {'progress': 1})
@@ -27,12 +27,15 @@ urlpatterns = [
 
     path('api/case-records/get', CaseRecordApi.get_case_record, ),
     path('api/case-records/paginated', CaseRecordApi.case_records_paginated,),
+    path('api/case-records/progress', CaseRecordApi.progress_stream,),
     path("api/case-records/<str:file_name>", CaseRecordApi.download_case_record ),
     path("api/leader-board/paginated", CaseRecordApi.leader_board_paginated ),
+    path("api/leader-board/rank", CaseRecordApi.leader_board_rank ),
 
 
     path('api/manage/users/import/semester/<int:semester_id>', ManageApi.import_users,),
     path('api/manage/users/view', ManageApi.view_users,),
+    path('api/manage/users/export', ManageApi.export_users,),
     path('api/manage/users/delete', ManageApi.delete_users,),
 
     path('api/manage/groups/create', ManageApi.create_groups,),
@@ -41,6 +44,8 @@ urlpatterns = [
 
     path('api/manage/case-submissions/limit', ManageApi.case_submission_limit,),
     path('api/manage/case-submissions', ManageApi.case_submissions,),
+    path('api/manage/case-submissions/export', ManageApi.export_case_submissions,),
+    path('api/manage/transactions/export', ManageApi.export_transactions,),
     path("api/manage/case-visibility", ManageApi.case_visibility,),
 
     path('api/manage/case-config/update', ManageApi.set_case_config,),
@@ -52,4 +57,7 @@ urlpatterns = [
 
     path('api/manage/system/view', ManageApi.view_system_state,),
     path('api/manage/system/update', ManageApi.update_system_state,),    
+
+
+    path('api/health/ready', HealthApi.ready,),
 ]
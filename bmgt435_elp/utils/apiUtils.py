@@ -1,19 +1,59 @@
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError, FieldDoesNotExist
 from django.db import IntegrityError, OperationalError
 from django.core.paginator import Paginator
-from django.db.models import Model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Model, Q, QuerySet
+from django.db.models.expressions import OrderBy
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from functools import wraps
+from typing import AsyncIterable, AsyncIterator, Union
 from http import HTTPStatus
 from .jsonUtils import CustomJSONEncoder
+from .databaseUtils import InMemoryCache, retry_on_locked
 from ..simulation.Core import SimulationException
 from ..bmgtModels import BMGTTransaction, BMGTModelBase
 
 import regex as re
+import inspect
+import base64
+import binascii
 import json
+import zlib
 
 
 __DEFAULT_ORDER=['-id']
+__EXPORT_CHUNK_SIZE = 500
+__COUNT_CACHE = InMemoryCache()
+
+
+def __error_response(e: Exception) -> HttpResponse:
+    """
+    converts an exception raised by an API into the response sent to the client
+    """
+    resp = AppResponse()
+    if isinstance(e, KeyError):
+        resp.reject(f'Key missing: {e.args[0]}')
+    elif isinstance(e, (
+        json.JSONDecodeError, ObjectDoesNotExist, MultipleObjectsReturned, IntegrityError, ValidationError,
+        NotImplementedError, SimulationException, ValueError, OperationalError,
+    )):
+        resp.reject(e.args[0])
+    elif settings.DEBUG:
+        raise e
+    else:
+        resp = HttpResponse()
+        resp.status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+        resp.write("Internal server error!")
+    return resp
+
+
+def is_async_view(func) -> bool:
+    """
+    whether a (possibly decorated or static) view is a coroutine function
+    """
+    return inspect.iscoroutinefunction(inspect.unwrap(func))
 
 
 def request_error_handler(func):
@@ -21,63 +61,56 @@ def request_error_handler(func):
     API level exception handling
     """
 
+    if is_async_view(func):
+        @wraps(func)
+        async def async_wrapped(request, *args, **kwargs) -> HttpResponse:
+            try:
+                return await func(request, *args, **kwargs)
+            except Exception as e:
+                return __error_response(e)
+
+        return async_wrapped
+
+    @wraps(func)
     def wrapped(request, *args, **kwargs) -> HttpResponse:
         try:
             return func(request, *args, **kwargs)
-        
-        except json.JSONDecodeError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except ObjectDoesNotExist as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except MultipleObjectsReturned as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except KeyError as e:
-            resp = AppResponse()
-            resp.reject(f'Key missing: {e.args[0]}')
-
-        except IntegrityError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except ValidationError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except NotImplementedError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except SimulationException as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except ValueError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-
-        except OperationalError as e:
-            resp = AppResponse()
-            resp.reject(e.args[0])
-            
         except Exception as e:
-            if settings.DEBUG:
-                raise
-            else:
-                resp = HttpResponse()
-                resp.status_code = HTTPStatus.INTERNAL_SERVER_ERROR
-                resp.write("Internal server error!")
-        
-        return resp
+            return __error_response(e)
 
     return wrapped
 
 
+def require_http_methods(request_method_list: list[str]):
+    """
+    same as django.views.decorators.http.require_http_methods, but keeps async views async
+    """
+
+    def decorator(func):
+        if is_async_view(func):
+            @wraps(func)
+            async def async_inner(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+                if request.method not in request_method_list:
+                    return HttpResponseNotAllowed(request_method_list)
+                return await func(request, *args, **kwargs)
+
+            return async_inner
+
+        @wraps(func)
+        def inner(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+            if request.method not in request_method_list:
+                return HttpResponseNotAllowed(request_method_list)
+            return func(request, *args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+require_GET = require_http_methods(["GET"])
+require_POST = require_http_methods(["POST"])
+
+
 def password_valid(password: str) -> bool:
     """
     password strength validation
@@ -89,7 +122,7 @@ def password_valid(password: str) -> bool:
     return leng_valid and has_char and has_num
 
 
-def create_pager_params(page: int, size: int, order: list[str]) -> dict:
+def create_pager_params(page: int, size: int, order: list[str], fields: list[str] = None) -> dict:
     """
     convert get parameters to pagination parameters for paginated query
     """
@@ -97,15 +130,28 @@ def create_pager_params(page: int, size: int, order: list[str]) -> dict:
     params['page'] = page
     params['size'] = size
     params['order'] = order
+    if fields is not None:
+        params['fields'] = fields
     return params
 
 
+def fields_from_request(request: HttpRequest) -> Union[list[str], None]:
+    """
+    keys of the serialized rows a client asked for with a comma separated fields parameter, None for all of them
+    """
+    fields = request.GET.get('fields', None)
+    if not fields:
+        return None
+    return list(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+
+
 def pager_params_from_request(request: HttpRequest) -> dict:
     """
-    convert get parameters to pagination parameters for paginated query
+    convert get parameters to pagination parameters for paginated query\n
+    passing a cursor parameter (empty for the first page) selects cursor mode, in which page is not needed.
+    a fields parameter restricts the keys of the serialized rows
     """
     
-    page = int(request.GET['page'])
     size = int(request.GET['size'])
     order = request.GET.get('order', None)
     if order:
@@ -114,22 +160,179 @@ def pager_params_from_request(request: HttpRequest) -> dict:
         order = __DEFAULT_ORDER
     if not size > 0:
         raise ValueError("invalid page size")
-    if not page > 0:
-        raise ValueError("invalid page number")
+    if 'cursor' in request.GET:
+        params = {
+            'cursor': request.GET['cursor'],
+            'size': size,
+            'order': order
+        }
+    else:
+        page = int(request.GET['page'])
+        if not page > 0:
+            raise ValueError("invalid page number")
+        params = {
+            'page': page,
+            'size': size,
+            'order': order
+        }
+    fields = fields_from_request(request)
+    if fields is not None:
+        params['fields'] = fields
+    return params
+
+
+def __keyset_order(dbModel: type[BMGTModelBase], order: list[str]) -> list[str]:
+    """
+    the ordering used to walk a table by cursor, made total by breaking ties on the primary key
+    """
+    order = list(order)
+    if not any(field.lstrip('-') in ('id', 'pk', dbModel._meta.pk.name) for field in order):
+        order.append('-id' if order and order[0].startswith('-') else 'id')
+    return order
+
+
+def __keyset_values(row: Union[Model, dict], order: list[str]) -> list:
+    """
+    values of the ordering columns on one row, which a cursor points at. the row is a model or a values() row
+    """
+    if isinstance(row, dict):
+        return [row[field.lstrip('-')] for field in order]
+    values = []
+    for field in order:
+        value = row
+        for attr in field.lstrip('-').split('__'):
+            value = getattr(value, attr)
+        values.append(value.pk if isinstance(value, Model) else value)
+    return values
+
+
+def __keyset_nullable(dbModel: type[BMGTModelBase], field: str) -> bool:
+    model, nullable = dbModel, False
+    for attr in field.lstrip('-').split('__'):
+        if attr == 'pk' or model is None:
+            break
+        try:
+            model_field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return True
+        nullable = nullable or model_field.null
+        model = model_field.related_model
+    return nullable
+
+
+def __keyset_order_by(order: list[str], forward: bool) -> list[OrderBy]:
+    """
+    the ordering of a page. nulls come after every value of their column when walking forward, whichever the backend
+    """
+    order_by = []
+    for field in order:
+        descending = field.startswith('-') == forward
+        expression = F(field.lstrip('-'))
+        order_by.append(expression.desc(nulls_last=forward, nulls_first=not forward) if descending
+                        else expression.asc(nulls_last=forward, nulls_first=not forward))
+    return order_by
+
+
+def __keyset_filter(dbModel: type[BMGTModelBase], order: list[str], values: list, forward: bool) -> Q:
+    """
+    rows strictly after (or before) the row with the given ordering values, as a row-value comparison.
+    nulls sort after every value walking forward, so they follow any value and nothing follows them
+    """
+    condition = Q(pk__in=[])
+    for i, field in enumerate(order):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') == forward else 'gt'
+        if values[i] is None:
+            if forward:
+                continue
+            branch = Q(**{f'{name}__isnull': False})
+        else:
+            branch = Q(**{f'{name}__{lookup}': values[i]})
+            if forward and __keyset_nullable(dbModel, field):
+                branch |= Q(**{f'{name}__isnull': True})
+        for prev_field, prev_value in zip(order[:i], values[:i]):
+            prev_name = prev_field.lstrip('-')
+            branch &= Q(**{f'{prev_name}__isnull': True}) if prev_value is None else Q(**{prev_name: prev_value})
+        condition |= branch
+    return condition
+
+
+def __encode_cursor(values: list, forward: bool) -> str:
+    payload = json.dumps({'k': values, 'f': forward}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def __decode_cursor(cursor: str, order: list[str]) -> tuple[list, bool]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values, forward = payload['k'], payload['f']
+    except (binascii.Error, UnicodeError, json.JSONDecodeError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(order) or not isinstance(forward, bool):
+        raise ValueError("Invalid cursor")
+    return values, forward
+
+
+def __cached_count(dbModel: type[BMGTModelBase], queryset, **kwargs) -> int:
+    """
+    total row count of a filtered table, reused for settings.PAGINATION_COUNT_CACHE_SECONDS so that paging does not count on every request
+    """
+    key = f'{dbModel._meta.label}:{sorted(kwargs.items())}'
+    return __COUNT_CACHE.get_or_query(key, queryset.count, ttl=getattr(settings, 'PAGINATION_COUNT_CACHE_SECONDS', 30))
+
+
+def clear_count_cache():
+    __COUNT_CACHE.clear()
+
+
+def __cursor_paginated_query(dbModel: type[BMGTModelBase], obj_set, pager_params, **kwargs) -> dict:
+    """
+    keyset pagination: seeks past the row a cursor points at instead of counting and offsetting,
+    so every page costs the same however deep it is\n
+    null values of the ordering columns come last
+    """
+    size = pager_params['size']
+    fields = pager_params.get('fields', None)
+    order = __keyset_order(dbModel, pager_params.get('order', __DEFAULT_ORDER))
+    forward, cursor_values = True, None
+    if pager_params['cursor']:
+        cursor_values, forward = __decode_cursor(pager_params['cursor'], order)
+
+    page_set = obj_set.order_by(*__keyset_order_by(order, forward))
+    if cursor_values is not None:
+        page_set = page_set.filter(__keyset_filter(dbModel, order, cursor_values, forward))
+    if dbModel.serialized_values:
+        # the ordering columns are read along with the serialized ones
+        page_set = page_set.values(*dict.fromkeys([*dbModel.serialized_columns(fields), *[field.lstrip('-') for field in order]]))
+    rows = list(page_set[:size + 1])
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+
+    has_next = has_more if forward else cursor_values is not None
+    has_previous = cursor_values is not None if forward else has_more
     return {
-        'page': page,
         'size': size,
-        'order': order
+        'total': __cached_count(dbModel, obj_set, **kwargs),
+        'next': __encode_cursor(__keyset_values(rows[-1], order), True) if rows and has_next else None,
+        'previous': __encode_cursor(__keyset_values(rows[0], order), False) if rows and has_previous else None,
+        'data': dbModel.serialize_rows(rows, fields) if dbModel.serialized_values
+            else dbModel.restrict_fields([row.as_dictionary() for row in rows], fields)
     }
 
 
-def generic_paginated_query(dbModel: Model, pager_params, **kwargs) -> dict:
+def generic_paginated_query(dbModel: type[BMGTModelBase], pager_params, **kwargs) -> dict:
     """
     generic paginated query on one table
     pass in a model class and a request object    
-    kwargs: filter conditions
+    kwargs: filter conditions\n
+    pager params carrying a cursor are served by keyset pagination instead of page numbers.
+    models declaring serialized_values are read as values() rows, without building model instances
     """
-    obj_set = dbModel.objects.filter(**kwargs)
+    obj_set = dbModel.objects.filter(**kwargs) if dbModel.serialized_values else dbModel.serialization_queryset().filter(**kwargs)
+    if 'cursor' in pager_params:
+        return __cursor_paginated_query(dbModel, obj_set, pager_params, **kwargs)
     order = pager_params.get('order', __DEFAULT_ORDER)
     obj_set = obj_set.order_by(*order)
     pager = Paginator(obj_set, pager_params['size'])
@@ -141,11 +344,54 @@ def generic_paginated_query(dbModel: Model, pager_params, **kwargs) -> dict:
         pageData = {
             'page': page,
             'totalPage': pager.num_pages,
-            'data': [model.as_dictionary() for model in pager.page(page)]
+            'data': dbModel.serialize_queryset(pager.page(page).object_list, pager_params.get('fields', None))
         }
         return pageData
 
 
+def iterate_serialized(dbModel: type[BMGTModelBase], queryset: QuerySet, fields: list[str] = None, chunk_size: int = __EXPORT_CHUNK_SIZE) -> AsyncIterator[dict]:
+    """
+    serialized rows of a queryset of any size in id order, read and serialized chunk_size rows at a time off the event loop,
+    each chunk seeking past the last id of the previous one.
+    unknown fields are rejected here rather than once the rows are being sent
+    """
+    if dbModel.serialized_values:
+        dbModel.serialized_columns(fields)
+    return __aserialized_chunks(dbModel, queryset, fields, chunk_size)
+
+
+def __serialized_chunk(dbModel: type[BMGTModelBase], queryset: QuerySet, fields: list[str], after_id: Union[int, None], chunk_size: int) -> tuple[list[dict], Union[int, None]]:
+    """
+    the serialized rows of the next chunk and the id of its last row
+    """
+    queryset = queryset.order_by('id') if after_id is None else queryset.filter(id__gt=after_id).order_by('id')
+    if dbModel.serialized_values:
+        # the id is read for the next seek whether or not it is listed
+        rows = list(queryset.values(*dict.fromkeys(['id', *dbModel.serialized_columns(fields)]))[:chunk_size])
+        return dbModel.serialize_rows(rows, fields), rows[-1]['id'] if rows else None
+    objs = list(dbModel.serialization_queryset(queryset)[:chunk_size])
+    return dbModel.restrict_fields([obj.as_dictionary() for obj in objs], fields), objs[-1].id if objs else None
+
+
+async def __aserialized_chunks(dbModel: type[BMGTModelBase], queryset: QuerySet, fields: list[str], chunk_size: int) -> AsyncIterator[dict]:
+    last_id = None
+    while True:
+        rows, last_id = await sync_to_async(__serialized_chunk)(dbModel, queryset, fields, last_id, chunk_size)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+
+
+async def ageneric_paginated_query(dbModel: type[BMGTModelBase], pager_params, **kwargs) -> dict:
+    """
+    async version of generic_paginated_query\n
+    the page is counted, fetched and serialized off the event loop in one go, since serialization may follow relations
+    """
+    return await sync_to_async(generic_paginated_query)(dbModel, pager_params, **kwargs)
+
+
+@retry_on_locked
 def __log_event(request: HttpRequest, status_code: int):
     try:
         user = request.user or None
@@ -194,4 +440,51 @@ class AppResponse(HttpResponse):
         self.write(json.dumps({
             'data': data
         }, cls=CustomJSONEncoder
-        ))
\ No newline at end of file
+        ))
+
+
+class AppStreamingResponse(StreamingHttpResponse):
+    """
+    resolved response whose data is a list encoded while it is sent, gzip compressed on the fly if the client accepts it,
+    so memory use does not grow with the number of rows.\n
+    the rows are an async iterator, which the ASGI handler streams as it goes rather than buffering a sync one
+    """
+
+    __CHUNK_BYTES = 64 * 1024
+
+    def __init__(self, request: HttpRequest, rows: AsyncIterable, filename: str = None) -> None:
+        compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        content = self.__encode(rows)
+        super().__init__(self.__gzip(content) if compress else content, content_type='application/json')
+        if compress:
+            self['Content-Encoding'] = 'gzip'
+        self['Vary'] = 'Accept-Encoding'
+        if filename:
+            self['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+    @staticmethod
+    async def __encode(rows: AsyncIterable) -> AsyncIterator[bytes]:
+        # the opening is sent before the first row is read
+        yield b'{"data": ['
+        encoder = CustomJSONEncoder()
+        buffer, buffered, first = [], 0, True
+        async for row in rows:
+            if not first:
+                buffer.append(', ')
+            first = False
+            for piece in encoder.iterencode(row):
+                buffer.append(piece)
+                buffered += len(piece)
+            if buffered >= AppStreamingResponse.__CHUNK_BYTES:
+                yield ''.join(buffer).encode()
+                buffer, buffered = [], 0
+        buffer.append(']}')
+        yield ''.join(buffer).encode()
+
+    @staticmethod
+    async def __gzip(content: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        async for chunk in content:
+            # flushed per chunk, so every chunk reaches the client as soon as it is encoded
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
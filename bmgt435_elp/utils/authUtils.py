@@ -0,0 +1,139 @@
+from django.conf import settings
+from django.core import signing
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpRequest
+from asgiref.sync import sync_to_async
+from typing import Union
+from ..bmgtModels import BMGTUser, BMGTGroup, BMGTSemester
+import copy
+import threading
+import time
+
+
+"""
+Session authentication.
+The session cookie holds a signed token of the user id, role and auth version, so a valid cookie cannot be forged.
+Users are served from a short-lived per-process cache, so most requests are authenticated without a query.
+"""
+
+
+SESSION_COOKIE = 'id'
+__TOKEN_SALT = 'bmgt435-session'
+__TOKEN_MAX_AGE = 60 * 60 * 24 * 7  # 7 days, the longest a remembered sign-in lasts
+
+
+class SessionUserCache:
+    """
+    per-process cache of activated users by id, expiring after settings.SESSION_USER_CACHE_TTL_SECONDS.\n
+    users are cached with their group and semester. each get returns a private copy of the cached user
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__users = dict[int, tuple[BMGTUser, float]]()
+
+    @property
+    def ttl(self) -> float:
+        return getattr(settings, 'SESSION_USER_CACHE_TTL_SECONDS', 30)
+
+    def get(self, user_id: int) -> Union[BMGTUser, None]:
+        with self.__lock:
+            entry = self.__users.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.__users[user_id]
+                return None
+        return copy.deepcopy(entry[0])
+
+    def set(self, user: BMGTUser) -> None:
+        if self.ttl <= 0:
+            return
+        user = copy.deepcopy(user)
+        with self.__lock:
+            self.__users[user.id] = (user, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id: int) -> None:
+        with self.__lock:
+            self.__users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__users.clear()
+
+
+session_users = SessionUserCache()
+
+
+@receiver(post_save, sender=BMGTUser)
+@receiver(post_delete, sender=BMGTUser)
+def __invalidate_user(sender, instance: BMGTUser, **kwargs):
+    session_users.invalidate(instance.id)
+
+
+@receiver(post_save, sender=BMGTGroup)
+@receiver(post_delete, sender=BMGTGroup)
+@receiver(post_save, sender=BMGTSemester)
+@receiver(post_delete, sender=BMGTSemester)
+def __invalidate_users(sender, instance, **kwargs):
+    # cached users carry their group and semester
+    session_users.clear()
+
+
+def sign_session_token(user: BMGTUser) -> str:
+    return signing.dumps({'id': user.id, 'role': user.role, 'v': user.auth_version}, salt=__TOKEN_SALT)
+
+
+def __session_claims(request: HttpRequest) -> Union[dict, None]:
+    """
+    claims of the session cookie, None if there is no validly signed one.
+    cookies issued before tokens were signed are rejected, so their users sign in again
+    """
+    cookie = request.COOKIES.get(SESSION_COOKIE, None)
+    if cookie is None:
+        return None
+    try:
+        return signing.loads(str(cookie), salt=__TOKEN_SALT, max_age=__TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def __query_user(user_id: int) -> Union[BMGTUser, None]:
+    try:
+        user = BMGTUser.objects.select_related('group', 'group__semester', 'semester').get(id=user_id, activated=True)
+    except BMGTUser.DoesNotExist:
+        return None
+    session_users.set(user)
+    return user
+
+
+def __matches(user: Union[BMGTUser, None], claims: dict) -> bool:
+    return user is not None and user.role == claims.get('role') and user.auth_version == claims.get('v')
+
+
+def session_user(request: HttpRequest) -> Union[BMGTUser, None]:
+    """
+    the activated user of the session cookie, None if the cookie is missing, invalid or outdated.
+    the user is loaded with its group and semester
+    """
+    claims = __session_claims(request)
+    if claims is None:
+        return None
+    user = session_users.get(claims['id'])
+    if user is None:
+        user = __query_user(claims['id'])
+    return user if __matches(user, claims) else None
+
+
+async def asession_user(request: HttpRequest) -> Union[BMGTUser, None]:
+    """
+    async version of session_user, which only leaves the event loop on a cache miss
+    """
+    claims = __session_claims(request)
+    if claims is None:
+        return None
+    user = session_users.get(claims['id'])
+    if user is None:
+        user = await sync_to_async(__query_user)(claims['id'])
+    return user if __matches(user, claims) else None
@@ -0,0 +1,154 @@
+from typing import Any, Callable, Union
+import hashlib
+import json
+import os
+import threading
+
+
+class DiskLRUCache:
+    """
+    size-bounded LRU cache stored as one file per entry in a local directory, so that all the worker processes on a host share it.\n
+    recency is tracked by the modification time of the entry files, which is refreshed on every hit.\n
+    the directory may be given as a function, such as one reading a setting, and is created by the first write.\n
+    entries are written without pickle, since anyone who can write to the directory could otherwise run code in the readers:
+    a JSON header followed by the raw bytes it refers to. values are built of None, bool, int, float, str, bytes,
+    and lists, tuples, frozensets and dicts of them
+    """
+
+    __SUFFIX = '.entry'
+    __EVICT_TO = 0.9    # share of the budget left after an eviction, so that the next writes do not rescan at once
+
+    def __init__(self, directory: Union[str, Callable[[], str]], max_bytes: int):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__scanned_directory = None
+        self.__size = 0     # bytes in the directory as of the last scan, plus those this process wrote since
+
+    @property
+    def directory(self) -> str:
+        return self.__directory() if callable(self.__directory) else self.__directory
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + self.__SUFFIX)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as file:
+                header = json.loads(file.readline())
+                blobs = [file.read(length) for length in header['blobs']]
+            if [len(blob) for blob in blobs] != header['blobs']:
+                return default
+            value = self.__decode(header['value'], blobs)
+            os.utime(path)
+            return value
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            return default
+
+    def set(self, key: str, value: Any) -> None:
+        blobs = list[bytes]()
+        header = json.dumps({'value': self.__encode(value, blobs), 'blobs': [len(blob) for blob in blobs]}).encode()
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name first so that readers never see a partial entry
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(header + b'\n')
+            for blob in blobs:
+                file.write(blob)
+        written = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.__lock:
+            self.__size += written
+        self.__evict()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self) -> None:
+        for path, _, _ in self.__entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self.__lock:
+            self.__scanned_directory = None
+
+    @staticmethod
+    def __encode(value: Any, blobs: list[bytes]) -> Any:
+        """
+        JSON form of a value: scalars as they are, everything else as a [type, payload] pair, with bytes moved to blobs
+        """
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, bytes):
+            blobs.append(value)
+            return ['bytes', len(blobs) - 1]
+        if isinstance(value, (list, tuple, frozenset)):
+            return [type(value).__name__, [DiskLRUCache.__encode(item, blobs) for item in value]]
+        if isinstance(value, dict):
+            return ['dict', [[DiskLRUCache.__encode(k, blobs), DiskLRUCache.__encode(v, blobs)] for k, v in value.items()]]
+        raise TypeError(f"{type(value).__name__} cannot be stored in a disk cache")
+
+    @staticmethod
+    def __decode(value: Any, blobs: list[bytes]) -> Any:
+        if not isinstance(value, list):
+            return value
+        kind, payload = value
+        if kind == 'bytes':
+            return blobs[payload]
+        if kind == 'dict':
+            return {DiskLRUCache.__decode(k, blobs): DiskLRUCache.__decode(v, blobs) for k, v in payload}
+        items = [DiskLRUCache.__decode(item, blobs) for item in payload]
+        if kind == 'list':
+            return items
+        if kind == 'tuple':
+            return tuple(items)
+        if kind == 'frozenset':
+            return frozenset(items)
+        raise ValueError(f"unknown disk cache value {kind}")
+
+    def __entries(self) -> list[tuple[str, float, int]]:
+        """
+        (path, modification time, size) of each entry in the directory
+        """
+        entries = []
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries
+        for entry in scan:
+            if entry.name.endswith(self.__SUFFIX):
+                try:
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_mtime, stat.st_size))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def __evict(self) -> None:
+        """
+        removes the least recently used entries once the running size exceeds the budget.\n
+        the directory is only scanned then, which also counts the entries written by the other processes since the last scan
+        """
+        with self.__lock:
+            directory = self.directory
+            if self.__scanned_directory == directory and self.__size <= self.__max_bytes:
+                return
+            entries = self.__entries()
+            total = sum([size for _, _, size in entries])
+            if total > self.__max_bytes:
+                for path, _, size in sorted(entries, key=lambda entry: entry[1]):
+                    if total <= self.__max_bytes * self.__EVICT_TO:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            self.__scanned_directory = directory
+            self.__size = total
@@ -1,37 +1,287 @@
-from typing import Callable
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from concurrent.futures import Future
+from contextvars import ContextVar, Token
+from functools import wraps
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Union
+from collections import OrderedDict
+import asyncio
+import itertools
+import random
+import threading
+import time
+
 
 class InMemoryCache:
+    """
+    thread-safe LRU cache of at most max_entries entries, each expiring after a ttl in seconds (None never expires).\n
+    concurrent misses of a key run its query once and share the result, so an expired hot entry does not stampede the database.
+    entries can be tagged, and invalidate drops every entry carrying a tag.\n
+    with a backend, such as cacheUtils.DiskLRUCache, entries are also shared with the other processes of the host.
+    invalidation only reaches the local entries, so keys shared through a backend should carry the versions of what they depend on
+    """
+
+    __MISSING = object()
+
+    def __init__(self, max_entries: int = 1024, ttl: Union[float, None] = None, backend=None):
+        self.__cache = OrderedDict[Hashable, tuple[Any, float, frozenset]]()
+        self.__flights = dict[Hashable, Future]()
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__backend = backend
+        self.__generation = 0   # bumped by every invalidation, so queries that raced one are not stored
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self.__lookup(key)
+        return default if value is self.__MISSING else value
+
+    def set(self, key: Hashable, value: Any, ttl: Union[float, None] = None, tags: Iterable[str] = ()) -> None:
+        self.__store(key, value, ttl, tags)
 
-    def __init__(self):
-        self.__cache = {}
+    def get_or_query(self, key: Hashable, query: Callable[[], Any], ttl: Union[float, None] = None, tags: Iterable[str] = ()) -> Any:
+        value = self.__get_local(key)
+        if value is not self.__MISSING:
+            return value
+        flight, leader = self.__join(key)
+        if not leader:
+            return flight.result()
+        generation = self.__generation
+        try:
+            # another flight may have landed since the miss
+            value = self.__lookup(key)
+            if value is self.__MISSING:
+                value = query()
+                self.__store(key, value, ttl, tags, generation)
+            flight.set_result(value)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            self.__land(key)
+        return value
 
-    def get_or_query(self, key, callable: Callable):
-        if self.__cache.get(key) is None:
-            self.__cache[key] = callable()
-        return self.__cache[key]
+    async def aget_or_query(self, key: Hashable, query: Callable[[], Awaitable[Any]], ttl: Union[float, None] = None, tags: Iterable[str] = ()) -> Any:
+        """
+        get_or_query for a coroutine function. the query runs on the event loop and waiting for another flight does not block it
+        """
+        value = self.__get_local(key)
+        if value is not self.__MISSING:
+            return value
+        flight, leader = self.__join(key)
+        if not leader:
+            return await asyncio.wrap_future(flight)
+        generation = self.__generation
+        try:
+            # another flight may have landed since the miss
+            value = self.__lookup(key)
+            if value is self.__MISSING:
+                value = await query()
+                self.__store(key, value, ttl, tags, generation)
+            flight.set_result(value)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            self.__land(key)
+        return value
 
-    def delete(self, key):
-        self.__cache.pop(key, None)
+    def delete(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__generation += 1
+            self.__cache.pop(key, None)
+        if self.__backend is not None and isinstance(key, str):
+            self.__backend.delete(key)
+
+    def invalidate(self, *tags: str) -> None:
+        """
+        drops the local entries carrying any of the tags
+        """
+        tags = frozenset(tags)
+        with self.__lock:
+            self.__generation += 1
+            for key in [key for key, (_, _, entry_tags) in self.__cache.items() if entry_tags & tags]:
+                del self.__cache[key]
 
     def clear(self):
-        self.__cache.clear()
+        with self.__lock:
+            self.__generation += 1
+            self.__cache.clear()
+        if self.__backend is not None:
+            self.__backend.clear()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__cache)
 
     def __str__(self):
-        return str(self.__cache)
+        with self.__lock:
+            return str({key: value for key, (value, _, _) in self.__cache.items()})
+
+    def __lookup(self, key: Hashable) -> Any:
+        value = self.__get_local(key)
+        return self.__get_shared(key) if value is self.__MISSING else value
+
+    def __get_local(self, key: Hashable) -> Any:
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is None:
+                return self.__MISSING
+            if entry[1] <= time.time():
+                del self.__cache[key]
+                return self.__MISSING
+            self.__cache.move_to_end(key)
+            return entry[0]
+
+    def __get_shared(self, key: Hashable) -> Any:
+        if self.__backend is None or not isinstance(key, str):
+            return self.__MISSING
+        entry = self.__backend.get(key)
+        if entry is None or entry[2] <= time.time():
+            return self.__MISSING
+        # kept locally until the shared entry expires
+        self.__set_local(*entry)
+        return entry[1]
+
+    def __set_local(self, key: Hashable, value: Any, expires: float, tags: frozenset, generation: int = None) -> bool:
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return False
+            self.__cache[key] = (value, expires, tags)
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.__max_entries:
+                self.__cache.popitem(last=False)
+            return True
+
+    def __set_shared(self, key: Hashable, value: Any, expires: float, tags: frozenset) -> None:
+        if self.__backend is not None and isinstance(key, str):
+            self.__backend.set(key, (key, value, expires, tags))
+
+    def __store(self, key: Hashable, value: Any, ttl: Union[float, None], tags: Iterable[str], generation: int = None) -> None:
+        """
+        stores an entry, unless it is the result of a query that an invalidation raced since the given generation
+        """
+        ttl = self.__ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            return
+        expires = float('inf') if ttl is None else time.time() + ttl
+        tags = frozenset(tags)
+        if self.__set_local(key, value, expires, tags, generation):
+            self.__set_shared(key, value, expires, tags)
+
+    def __join(self, key: Hashable) -> tuple[Future, bool]:
+        """
+        the pending query of the key and whether the caller has to run it
+        """
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.__flights[key] = Future()
+            return flight, True
+
+    def __land(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__flights.pop(key, None)
+
+
+def configure_sqlite(connection) -> None:
+    """
+    applies settings.SQLITE_PRAGMAS to a new SQLite connection, e.g. WAL journaling and a busy timeout
+    so that the server processes of a host can write concurrently
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def __configure_connection(sender, connection, **kwargs):
+    configure_sqlite(connection)
+
+
+def retry_on_locked(func):
+    """
+    reruns a write transaction that failed because the database was locked by another writer, up to
+    settings.DATABASE_WRITE_RETRIES times with jittered exponential backoff. only outermost transactions are rerun,
+    since a transaction that failed inside another one cannot be replayed alone
+    """
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        for attempt in itertools.count():
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if 'locked' not in str(e) or transaction.get_connection().in_atomic_block or attempt >= getattr(settings, 'DATABASE_WRITE_RETRIES', 3):
+                    raise
+                time.sleep(random.uniform(0, getattr(settings, 'DATABASE_WRITE_RETRY_BACKOFF_SECONDS', 0.05) * 2 ** attempt))
+
+    return wrapped
+
+
+class RequestRouting:
+    """
+    database routing state of one request
+    """
+
+    def __init__(self, pinned: bool):
+        self.pinned = pinned    # reads go to the primary
+        self.wrote = False
+
+
+__request_routing = ContextVar[Union[RequestRouting, None]]('request_routing', default=None)
+
+
+def begin_request_routing(pinned: bool) -> tuple[RequestRouting, Token]:
+    """
+    lets the reads of the current request go to the replicas until it writes, unless pinned to the primary from the start.
+    pass the token to end_request_routing when the request is done
+    """
+    routing = RequestRouting(pinned)
+    return routing, __request_routing.set(routing)
+
+
+def end_request_routing(token: Token) -> None:
+    __request_routing.reset(token)
+
+
+def request_routing() -> Union[RequestRouting, None]:
+    return __request_routing.get()
+
 
 class BMGT435_DB_Router:
+    """
+    sends writes to the primary and the reads of requests to a random replica of settings.DATABASE_REPLICAS.\n
+    reads stay on the primary inside transactions, outside requests (simulation workers, commands),
+    and for the rest of a request once it wrote, so a request always reads its own writes
+    """
 
     __main_db = 'default'
-    __session_db = 'session_db'
 
     def db_for_read(self, model, **hints):
-        raise   NotImplementedError('db_for_read not implemented')
-    
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        routing = request_routing()
+        if not replicas or routing is None or routing.pinned or connections[self.__main_db].in_atomic_block:
+            return self.__main_db
+        instance = hints.get('instance', None)
+        if instance is not None and instance._state.db is not None:
+            return instance._state.db   # related objects are read from where the instance came from
+        return random.choice(replicas)
+
     def db_for_write(self, model, **hints):
-        raise   NotImplementedError('db_for_read not implemented')
+        routing = request_routing()
+        if routing is not None:
+            routing.pinned = routing.wrote = True
+        return self.__main_db
 
     def allow_relation(self, obj1, obj2, **hints):
         return True
-    
-    def allow_migration(self, db, app_label, model_name=None, **hints):
-        return True    
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas receive the schema from the primary
+        return db not in getattr(settings, 'DATABASE_REPLICAS', [])
@@ -0,0 +1,60 @@
+from typing import Any, Hashable
+import asyncio
+import json
+import threading
+
+
+def sse_message(event: str, data: Any) -> str:
+    """
+    formats one server-sent event. data is sent as json
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ProgressBroker:
+    """
+    in-process publish/subscribe of progress events.\n
+    publishers may run on any thread, subscribers are coroutines waiting on the queue returned by subscribe.
+    the latest event of every key is retained until discarded, so late subscribers start from the current state
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__subscribers = dict[Hashable, list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]]]()
+        self.__latest = dict[Hashable, Any]()
+
+    def subscribe(self, key: Hashable) -> asyncio.Queue:
+        """
+        must be called from the event loop that consumes the queue
+        """
+        queue = asyncio.Queue()
+        with self.__lock:
+            self.__subscribers.setdefault(key, []).append((asyncio.get_running_loop(), queue))
+            if key in self.__latest:
+                queue.put_nowait(self.__latest[key])
+        return queue
+
+    def unsubscribe(self, key: Hashable, queue: asyncio.Queue) -> None:
+        with self.__lock:
+            subscribers = [s for s in self.__subscribers.get(key, []) if s[1] is not queue]
+            if subscribers:
+                self.__subscribers[key] = subscribers
+            else:
+                self.__subscribers.pop(key, None)
+
+    def publish(self, key: Hashable, event: Any) -> None:
+        with self.__lock:
+            self.__latest[key] = event
+            subscribers = list(self.__subscribers.get(key, []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:    # the loop of the subscriber has been closed
+                self.unsubscribe(key, queue)
+
+    def discard(self, key: Hashable) -> None:
+        """
+        forgets the latest event of key, once it is no longer of interest to new subscribers
+        """
+        with self.__lock:
+            self.__latest.pop(key, None)
@@ -0,0 +1,303 @@
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.utils import timezone
+from typing import Callable, Hashable, Union
+from ..bmgtModels import BMGTCaseRecord, BMGTSimulationJob
+from .databaseUtils import retry_on_locked
+from .quotaUtils import fail_case_records
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class SimulationPool:
+    """
+    bounded pool of background threads that run simulation jobs outside of the request cycle.\n
+    the number of threads is read from settings.SIMULATION_WORKERS. with zero workers jobs run inline in the calling thread.\n
+    pending jobs are dispatched by fair queueing over their keys (start-time fair queueing with unit cost),
+    so a burst of jobs under one key only delays that key's own later jobs
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__pending = list[tuple[float, int, Callable, tuple]]()   # heap of (finish tag, sequence, job, args)
+        self.__finish_tags = dict[Hashable, float]()    # finish tag of the last pending job of each key
+        self.__virtual_time = 0.0
+        self.__sequence = itertools.count()
+        self.__unfinished = 0
+        self.__busy = 0
+        self.__threads = list[threading.Thread]()
+
+    @property
+    def num_workers(self) -> int:
+        return getattr(settings, 'SIMULATION_WORKERS', 0)
+
+    @property
+    def pending(self) -> int:
+        """
+        number of jobs waiting for a worker
+        """
+        with self.__condition:
+            return len(self.__pending)
+
+    @property
+    def busy(self) -> int:
+        """
+        number of workers running a job
+        """
+        with self.__condition:
+            return self.__busy
+
+    def submit(self, job: Callable, *args, key: Hashable = None) -> None:
+        """
+        schedules job(*args). exceptions raised by the job are logged, the job is expected to record its own failure.\n
+        jobs of one key run in submission order, and keys with pending jobs are dispatched in turn
+        """
+        if self.num_workers <= 0:
+            self.__execute(job, args)
+            return
+
+        with self.__condition:
+            finish_tag = max(self.__virtual_time, self.__finish_tags.get(key, 0.0)) + 1.0
+            self.__finish_tags[key] = finish_tag
+            heapq.heappush(self.__pending, (finish_tag, next(self.__sequence), job, args))
+            self.__unfinished += 1
+            while len(self.__threads) < self.num_workers:
+                thread = threading.Thread(target=self.__work, name=f"simulation-worker-{len(self.__threads)}", daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+            self.__condition.notify()
+
+    @staticmethod
+    def __execute(job: Callable, args: tuple) -> None:
+        try:
+            job(*args)
+        except Exception:
+            _logger.exception("simulation job %s failed", getattr(job, '__name__', job))
+
+    def __work(self) -> None:
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: len(self.__pending) > 0)
+                finish_tag, _, job, args = heapq.heappop(self.__pending)
+                self.__virtual_time = finish_tag
+                for key in [k for k, tag in self.__finish_tags.items() if tag <= finish_tag]:
+                    del self.__finish_tags[key]
+                self.__busy += 1
+            try:
+                self.__execute(job, args)
+            finally:
+                # every job runs on fresh database connections owned by this thread
+                connections.close_all()
+                with self.__condition:
+                    self.__busy -= 1
+                    self.__unfinished -= 1
+                    self.__condition.notify_all()
+
+    def join(self) -> None:
+        """
+        blocks until every scheduled job has finished
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__unfinished == 0)
+
+
+class AdmissionController:
+    """
+    per-key admission of simulation submissions, read from settings:\n
+    SIMULATION_GROUP_MAX_CONCURRENT running jobs at most, and a token bucket of SIMULATION_GROUP_BURST submissions
+    refilled at SIMULATION_GROUP_RATE_PER_MINUTE.\n
+    rejected submissions are told how long to wait: until the bucket holds a token again, or until the oldest
+    running job is expected to finish, going by a moving average of recent job durations.\n
+    the running jobs are counted by the caller, but the token buckets are kept per process: a key may be admitted
+    at the configured rate by each server process
+    """
+
+    __DEFAULT_DURATION = 5.0    # seconds, until a simulation has been timed
+    __DURATION_SMOOTHING = 0.2
+    __MIN_RETRY_AFTER = 1.0
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__buckets = dict[Hashable, tuple[float, float]]()    # key -> (tokens, time of last refill)
+        self.__expected_duration = None
+
+    @property
+    def max_concurrent(self) -> int:
+        return getattr(settings, 'SIMULATION_GROUP_MAX_CONCURRENT', 2)
+
+    @property
+    def burst(self) -> int:
+        return getattr(settings, 'SIMULATION_GROUP_BURST', 3)
+
+    @property
+    def rate(self) -> float:
+        """
+        tokens per second
+        """
+        return getattr(settings, 'SIMULATION_GROUP_RATE_PER_MINUTE', 6) / 60
+
+    @property
+    def expected_duration(self) -> float:
+        return self.__expected_duration if self.__expected_duration is not None else self.__DEFAULT_DURATION
+
+    def admit(self, key: Hashable, running_ages: list[float], now: float = None) -> float:
+        """
+        admits one submission of key, given how many seconds each of its running jobs has been running.\n
+        returns 0 if admitted, otherwise the number of seconds after which a retry would be admitted
+        """
+        now = time.monotonic() if now is None else now
+        with self.__lock:
+            if len(running_ages) >= self.max_concurrent:
+                oldest = sorted(running_ages, reverse=True)[len(running_ages) - self.max_concurrent]
+                return max(self.expected_duration - oldest, self.__MIN_RETRY_AFTER)
+
+            tokens, refilled = self.__buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - refilled) * self.rate)
+            if tokens < 1:
+                self.__buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self.__buckets[key] = (tokens - 1, now)
+            return 0.0
+
+    def refund(self, key: Hashable) -> None:
+        """
+        returns the token of an admitted submission that was not carried out
+        """
+        with self.__lock:
+            if key in self.__buckets:
+                tokens, refilled = self.__buckets[key]
+                self.__buckets[key] = (min(self.burst, tokens + 1), refilled)
+
+    def record_duration(self, seconds: float) -> None:
+        with self.__lock:
+            if self.__expected_duration is None:
+                self.__expected_duration = seconds
+            else:
+                self.__expected_duration += self.__DURATION_SMOOTHING * (seconds - self.__expected_duration)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__buckets.clear()
+            self.__expected_duration = None
+
+
+class DatabaseJobQueue:
+    """
+    simulation job queue stored in the database and shared by worker processes on any number of hosts.\n
+    a worker claims a job under a lease and keeps it alive by heartbeat. jobs whose lease expires are re-queued
+    until they run out of attempts, after which they are dead-lettered and their case record fails.\n
+    claims use SELECT ... FOR UPDATE SKIP LOCKED where the database supports it. otherwise (SQLite) a job is
+    claimed by a conditional update, which the database serializes so that only one claimer wins at a time
+    """
+
+    def __init__(self, lease_seconds: int = None, max_attempts: int = None):
+        self.__lease_seconds = lease_seconds or getattr(settings, 'SIMULATION_JOB_LEASE_SECONDS', 60)
+        self.__max_attempts = max_attempts or getattr(settings, 'SIMULATION_JOB_MAX_ATTEMPTS', 3)
+
+    @property
+    def lease_seconds(self) -> int:
+        return self.__lease_seconds
+
+    def __lease_expire_time(self) -> datetime.datetime:
+        return timezone.now() + datetime.timedelta(seconds=self.__lease_seconds)
+
+    def enqueue(self, case_record: BMGTCaseRecord, job_args: dict) -> BMGTSimulationJob:
+        return BMGTSimulationJob.objects.create(
+            case_record=case_record,
+            job_args=json.dumps(job_args),
+            max_attempts=self.__max_attempts,
+        )
+
+    @retry_on_locked
+    def claim(self, owner: str) -> Union[BMGTSimulationJob, None]:
+        """
+        claims the oldest queued job for owner, None if the queue is empty
+        """
+        self.requeue_expired()
+        if connections[BMGTSimulationJob.objects.db].features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                job = BMGTSimulationJob.objects.select_for_update(skip_locked=True).filter(
+                    state=BMGTSimulationJob.State.QUEUED,
+                ).order_by('id').first()
+                if job is None:
+                    return None
+                job.state = BMGTSimulationJob.State.CLAIMED
+                job.attempts += 1
+                job.lease_owner = owner
+                job.lease_expire_time = self.__lease_expire_time()
+                job.save(update_fields=['state', 'attempts', 'lease_owner', 'lease_expire_time'])
+                return job
+
+        for job_id in list(BMGTSimulationJob.objects.filter(
+            state=BMGTSimulationJob.State.QUEUED,
+        ).order_by('id').values_list('id', flat=True)[:10]):
+            claimed = BMGTSimulationJob.objects.filter(id=job_id, state=BMGTSimulationJob.State.QUEUED).update(
+                state=BMGTSimulationJob.State.CLAIMED,
+                attempts=models.F('attempts') + 1,
+                lease_owner=owner,
+                lease_expire_time=self.__lease_expire_time(),
+            )
+            if claimed:
+                return BMGTSimulationJob.objects.get(id=job_id)
+        return None
+
+    @retry_on_locked
+    def heartbeat(self, job: BMGTSimulationJob, owner: str) -> bool:
+        """
+        extends the lease of a claimed job. returns False if owner no longer holds the lease
+        """
+        return BMGTSimulationJob.objects.filter(
+            id=job.id, state=BMGTSimulationJob.State.CLAIMED, lease_owner=owner,
+        ).update(lease_expire_time=self.__lease_expire_time()) == 1
+
+    @retry_on_locked
+    def complete(self, job: BMGTSimulationJob, owner: str) -> bool:
+        return BMGTSimulationJob.objects.filter(
+            id=job.id, state=BMGTSimulationJob.State.CLAIMED, lease_owner=owner,
+        ).update(state=BMGTSimulationJob.State.DONE, lease_expire_time=None) == 1
+
+    @retry_on_locked
+    def fail(self, job: BMGTSimulationJob, owner: str, error: str) -> bool:
+        """
+        releases a failed job for another attempt, or dead-letters it once its attempts are used up
+        """
+        with transaction.atomic():
+            released = BMGTSimulationJob.objects.filter(
+                id=job.id, state=BMGTSimulationJob.State.CLAIMED, lease_owner=owner,
+            ).update(lease_owner="", lease_expire_time=None, last_error=error)
+            if released:
+                self.__release(BMGTSimulationJob.objects.filter(id=job.id))
+        return released == 1
+
+    def requeue_expired(self) -> int:
+        """
+        releases every claimed job whose worker stopped renewing its lease. returns the number of released jobs
+        """
+        now = timezone.now()
+        released = 0
+        for job_id in list(BMGTSimulationJob.objects.filter(
+            state=BMGTSimulationJob.State.CLAIMED, lease_expire_time__lt=now,
+        ).values_list('id', flat=True)):
+            with transaction.atomic():
+                # the lease may have been renewed or released since the lookup
+                if BMGTSimulationJob.objects.filter(
+                    id=job_id, state=BMGTSimulationJob.State.CLAIMED, lease_expire_time__lt=now,
+                ).update(lease_owner="", lease_expire_time=None, last_error="lease expired"):
+                    self.__release(BMGTSimulationJob.objects.filter(id=job_id))
+                    released += 1
+        return released
+
+    @staticmethod
+    def __release(jobs) -> None:
+        dead = jobs.filter(attempts__gte=models.F('max_attempts'))
+        fail_case_records(BMGTCaseRecord.objects.filter(id__in=dead.values('case_record_id')))
+        dead.update(state=BMGTSimulationJob.State.DEAD)
+        jobs.filter(attempts__lt=models.F('max_attempts')).update(state=BMGTSimulationJob.State.QUEUED)
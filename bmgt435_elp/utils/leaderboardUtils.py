@@ -0,0 +1,234 @@
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, QuerySet, Subquery
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Union
+from ..bmgtModels import BMGTCaseRecord, BMGTLeaderboardEntry, BMGTSemester, BMGTUser
+from .databaseUtils import retry_on_locked
+from .versionUtils import bump_versions, leaderboard_resource
+import math
+
+
+# best performance first, earlier submissions win ties
+__RANK_ORDER = (F('performance_metric').desc(), F('score').desc(nulls_last=True), 'case_record_id')
+
+# entries deleted inside deferred_ranking, by the leaderboard they left
+__deferred_removals = ContextVar[Union[dict[tuple[int, int], list[BMGTLeaderboardEntry]], None]]('deferred_removals', default=None)
+
+
+def __lock_leaderboards(semester_id: int) -> bool:
+    """
+    serializes the ranking of the leaderboards of a semester on its row. False if the semester is gone
+    """
+    return BMGTSemester.objects.select_for_update().filter(id=semester_id).exists()
+
+
+def __leaderboard(entry: BMGTLeaderboardEntry) -> QuerySet:
+    return BMGTLeaderboardEntry.objects.filter(case_id=entry.case_id, semester_id=entry.semester_id)
+
+
+def __ranked_ahead(entry: BMGTLeaderboardEntry) -> Q:
+    """
+    entries ranked before the given one in __RANK_ORDER
+    """
+    if entry.score is None:
+        better_score, same_score = Q(score__isnull=False), Q(score__isnull=True)
+    else:
+        better_score, same_score = Q(score__gt=entry.score), Q(score=entry.score)
+    return Q(performance_metric__gt=entry.performance_metric) | Q(performance_metric=entry.performance_metric) & (
+        better_score | same_score & Q(case_record_id__lt=entry.case_record_id)
+    )
+
+
+def __insert_rank(entry: BMGTLeaderboardEntry) -> None:
+    """
+    ranks a saved entry, shifting only the entries it ranks ahead of
+    """
+    leaderboard = __leaderboard(entry).exclude(id=entry.id)
+    ahead = leaderboard.filter(__ranked_ahead(entry))
+    entry.rank = ahead.count() + 1
+    entry.group_rank = None
+    leaderboard.filter(rank__gte=entry.rank).update(rank=F('rank') + 1)
+    if entry.group_id is not None and not ahead.filter(group_id=entry.group_id).exists():
+        entry.group_rank = ahead.filter(group_rank__isnull=False).count() + 1
+        behind = leaderboard.filter(group_rank__gte=entry.group_rank)
+        # the previous best record of the group falls behind the new one
+        previous_rank = leaderboard.filter(group_id=entry.group_id, group_rank__isnull=False).values_list('group_rank', flat=True).first()
+        if previous_rank is not None:
+            leaderboard.filter(group_id=entry.group_id).update(group_rank=None)
+            behind = behind.filter(group_rank__lt=previous_rank)
+        behind.update(group_rank=F('group_rank') + 1)
+    entry.save(update_fields=['rank', 'group_rank'])
+
+
+def __remove_rank(entry: BMGTLeaderboardEntry) -> None:
+    """
+    closes the gap left by a deleted entry, shifting only the entries ranked behind it
+    """
+    leaderboard = __leaderboard(entry)
+    leaderboard.filter(rank__gt=entry.rank).update(rank=F('rank') - 1)
+    if entry.group_rank is None:
+        return
+    leaderboard.filter(group_rank__gt=entry.group_rank).update(group_rank=F('group_rank') - 1)
+    # the next best record of the group takes its place
+    successor = leaderboard.filter(group_id=entry.group_id).order_by('rank').only('id', 'rank', 'group_rank').first()
+    if successor is not None:
+        successor.group_rank = leaderboard.filter(group_rank__isnull=False, rank__lt=successor.rank).count() + 1
+        leaderboard.filter(group_rank__gte=successor.group_rank).update(group_rank=F('group_rank') + 1)
+        successor.save(update_fields=['group_rank'])
+
+
+@retry_on_locked
+def rank_leaderboard(case_id: int, semester_id: int) -> None:
+    """
+    renumbers the leaderboard of a case and semester, writing only the entries whose rank moved, and bumps its version
+    """
+    with transaction.atomic():
+        if not __lock_leaderboards(semester_id):
+            return
+        entries = BMGTLeaderboardEntry.objects.filter(case_id=case_id, semester_id=semester_id).order_by(*__RANK_ORDER).only('id', 'group_id', 'rank', 'group_rank')
+        ranked_groups = set()
+        moved = []
+        for rank, entry in enumerate(entries, start=1):
+            group_rank = None
+            if entry.group_id is not None and entry.group_id not in ranked_groups:
+                ranked_groups.add(entry.group_id)
+                group_rank = len(ranked_groups)
+            if entry.rank != rank or entry.group_rank != group_rank:
+                entry.rank = rank
+                entry.group_rank = group_rank
+                moved.append(entry)
+        BMGTLeaderboardEntry.objects.bulk_update(moved, ['rank', 'group_rank'], batch_size=500)
+        bump_versions(leaderboard_resource(case_id, semester_id))
+
+
+@retry_on_locked
+def add_leaderboard_entry(case_record: BMGTCaseRecord) -> Union[BMGTLeaderboardEntry, None]:
+    """
+    puts a successful case record on the leaderboard of its semester.
+    records without a performance metric or a semester are not ranked
+    """
+    semester_id = case_record.semester_id
+    if case_record.state != BMGTCaseRecord.State.SUCCESS or case_record.performance_metric is None or semester_id is None:
+        return None
+    with transaction.atomic():
+        if not __lock_leaderboards(semester_id):
+            return None
+        # a record ranked before is ranked again from its new metric
+        BMGTLeaderboardEntry.objects.filter(case_record=case_record).delete()
+        entry = BMGTLeaderboardEntry.objects.create(
+            case_record=case_record,
+            case_id=case_record.case_id,
+            semester_id=semester_id,
+            group_id=case_record.group_id,
+            performance_metric=case_record.performance_metric,
+            score=case_record.score,
+        )
+        __insert_rank(entry)
+        bump_versions(leaderboard_resource(entry.case_id, entry.semester_id))
+    return entry
+
+
+@retry_on_locked
+def __close_rank_gap(entry: BMGTLeaderboardEntry) -> None:
+    with transaction.atomic():
+        if __lock_leaderboards(entry.semester_id):
+            __remove_rank(entry)
+            bump_versions(leaderboard_resource(entry.case_id, entry.semester_id))
+
+
+@contextmanager
+def deferred_ranking() -> Iterator[None]:
+    """
+    closes the rank gaps left by the leaderboard entries deleted inside once per leaderboard when the block exits,
+    rather than after every deleted entry. nested blocks defer to the outermost one
+    """
+    if __deferred_removals.get() is not None:
+        yield
+        return
+    removals = dict[tuple[int, int], list[BMGTLeaderboardEntry]]()
+    token = __deferred_removals.set(removals)
+    try:
+        yield
+    finally:
+        __deferred_removals.reset(token)
+    for (case_id, semester_id), entries in removals.items():
+        if len(entries) == 1:
+            __close_rank_gap(entries[0])
+        else:
+            rank_leaderboard(case_id, semester_id)
+
+
+def backfill_case_record_semesters(batch_size: int = 500) -> int:
+    """
+    copies the semester of the submitting user onto case records saved before records kept their own, so they can be ranked.
+    one batch per statement so that large tables are not locked at once. returns the number of records filled
+    """
+    filled = 0
+    user_semester = Subquery(BMGTUser.objects.filter(id=OuterRef('user_id')).values('semester_id')[:1])
+    while True:
+        batch = list(BMGTCaseRecord.objects.filter(semester__isnull=True, user__semester__isnull=False).values_list('id', flat=True)[:batch_size])
+        if not batch:
+            return filled
+        filled += BMGTCaseRecord.objects.filter(id__in=batch).update(semester_id=user_semester)
+
+
+def rebuild_leaderboards() -> int:
+    """
+    ranks the successful records that are not on a leaderboard yet, such as those from before leaderboards were kept.
+    returns the number of records ranked
+    """
+    records = BMGTCaseRecord.objects.filter(
+        state=BMGTCaseRecord.State.SUCCESS, performance_metric__isnull=False,
+        semester__isnull=False, bmgtleaderboardentry__isnull=True,
+    )
+    entries = [
+        BMGTLeaderboardEntry(
+            case_record=record, case_id=record.case_id, semester_id=record.semester_id, group_id=record.group_id,
+            performance_metric=record.performance_metric, score=record.score,
+        )
+        for record in records
+    ]
+    BMGTLeaderboardEntry.objects.bulk_create(entries, batch_size=500)
+    for case_id, semester_id in {(entry.case_id, entry.semester_id) for entry in entries}:
+        rank_leaderboard(case_id, semester_id)
+    return len(entries)
+
+
+def leaderboard_page(case_id: int, semester_id: int, page: int, size: int, per_group: bool = False, fields: list[str] = None) -> dict:
+    """
+    one page of a leaderboard, read as a range of precomputed ranks.
+    with per_group only the best record of each group is listed. fields restricts the keys of the listed records
+    """
+    rank_field = 'group_rank' if per_group else 'rank'
+    entries = BMGTLeaderboardEntry.objects.filter(case_id=case_id, semester_id=semester_id)
+    last_rank = entries.filter(**{f'{rank_field}__isnull': False}).order_by(f'-{rank_field}').values_list(rank_field, flat=True).first() or 0
+    total_page = max(1, math.ceil(last_rank / size))
+    if page > total_page or page < 1:
+        raise ValueError("Invalid page number")
+    entries = entries.filter(**{f'{rank_field}__gt': (page - 1) * size, f'{rank_field}__lte': page * size}).order_by(rank_field)
+    return {
+        'page': page,
+        'totalPage': total_page,
+        'data': BMGTLeaderboardEntry.serialize_queryset(entries, fields)
+    }
+
+
+def group_leaderboard_entry(case_id: int, semester_id: int, group_id: int) -> Union[BMGTLeaderboardEntry, None]:
+    """
+    best ranked record of a group, None if the group has no ranked record
+    """
+    return BMGTLeaderboardEntry.serialization_queryset().filter(
+        case_id=case_id, semester_id=semester_id, group_id=group_id, group_rank__isnull=False,
+    ).first()
+
+
+@receiver(post_delete, sender=BMGTLeaderboardEntry)
+def __entry_deleted(sender, instance: BMGTLeaderboardEntry, **kwargs):
+    removals = __deferred_removals.get()
+    if removals is None:
+        __close_rank_gap(instance)
+    else:
+        removals.setdefault((instance.case_id, instance.semester_id), []).append(instance)
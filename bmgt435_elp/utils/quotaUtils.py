@@ -0,0 +1,70 @@
+from django.db import transaction
+from django.db.models import F, QuerySet
+from ..bmgtModels import BMGTCase, BMGTCaseRecord, BMGTGroup, BMGTLeaderboardEntry, BMGTSubmissionQuota
+from .databaseUtils import retry_on_locked
+from .leaderboardUtils import deferred_ranking
+import itertools
+
+
+__COUNTED_STATES = (BMGTCaseRecord.State.RUNNING, BMGTCaseRecord.State.SUCCESS)
+
+
+def __submission_quota(case: BMGTCase, group: BMGTGroup) -> BMGTSubmissionQuota:
+    """
+    quota counter of a group and case. a missing counter starts from the submissions recorded so far
+    """
+    quota = BMGTSubmissionQuota.objects.filter(group=group, case=case).first()
+    if quota is None:
+        quota, _ = BMGTSubmissionQuota.objects.get_or_create(
+            group=group, case=case,
+            defaults=dict(used=BMGTCaseRecord.objects.filter(case=case, group=group, state__in=__COUNTED_STATES).count()),
+        )
+    return quota
+
+
+def submission_available(case: BMGTCase, group: BMGTGroup) -> bool:
+    """
+    whether the group has submissions of the case left. only claim_submission reserves one
+    """
+    return case.max_submission == -1 or __submission_quota(case, group).used < case.max_submission
+
+
+@retry_on_locked
+def claim_submission(case: BMGTCase, group: BMGTGroup) -> bool:
+    """
+    reserves one submission of the case for the group with a conditional update of its counter, so concurrent submits
+    cannot exceed the limit. call it in the transaction that creates the case record. returns False if none is left
+    """
+    with transaction.atomic():
+        quota = BMGTSubmissionQuota.objects.filter(group=group, case=case)
+        if case.max_submission != -1:
+            quota = quota.filter(used__lt=case.max_submission)
+        if quota.update(used=F('used') + 1):
+            return True
+        # either no submission is left or the counter does not exist yet
+        __submission_quota(case, group)
+        return quota.update(used=F('used') + 1) == 1
+
+
+@retry_on_locked
+def fail_case_records(records: QuerySet) -> int:
+    """
+    marks the running or successful records among the given ones as failed, returns their submissions to the quota
+    and takes them off the leaderboards. returns the number of failed records
+    """
+    failed = 0
+    with transaction.atomic():
+        counted = records.filter(state__in=__COUNTED_STATES).order_by('group_id', 'case_id').values_list('group_id', 'case_id', 'id')
+        failed_ids = []
+        for (group_id, case_id), rows in itertools.groupby(counted, key=lambda row: row[:2]):
+            ids = [row[2] for row in rows]
+            # only the records this update moves are returned, however many were looked up
+            num_failed = BMGTCaseRecord.objects.filter(
+                id__in=ids, state__in=__COUNTED_STATES,
+            ).update(state=BMGTCaseRecord.State.FAILED)
+            BMGTSubmissionQuota.objects.filter(group_id=group_id, case_id=case_id, used__gte=num_failed).update(used=F('used') - num_failed)
+            failed += num_failed
+            failed_ids.extend(ids)
+        with deferred_ranking():
+            BMGTLeaderboardEntry.objects.filter(case_record_id__in=failed_ids, case_record__state=BMGTCaseRecord.State.FAILED).delete()
+    return failed
@@ -0,0 +1,184 @@
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from asgiref.sync import sync_to_async
+from functools import wraps
+from http import HTTPStatus
+from typing import Callable, Iterable, Union
+from .apiUtils import is_async_view
+from .cacheUtils import DiskLRUCache
+from .databaseUtils import InMemoryCache, retry_on_locked
+from ..bmgtModels import BMGTCase, BMGTCaseConfig, BMGTSemester, BMGTSystemStatus, BMGTResourceVersion, BMGTGroup, BMGTUser, BMGTLeaderboardEntry
+import hashlib
+
+
+CASE_RESOURCE = 'case'
+CASE_CONFIG_RESOURCE = 'case-config'
+SEMESTER_RESOURCE = 'semester'
+SYSTEM_RESOURCE = 'system'
+
+# names of the resources a response depends on, or a function of the request giving them (None to skip the ETag)
+Resources = Union[Iterable[str], Callable[[HttpRequest], Union[Iterable[str], None]]]
+
+# rendered responses keyed by their ETag, which changes with the versions, so the processes sharing the disk stay coherent
+response_cache = InMemoryCache(
+    max_entries=getattr(settings, 'RESPONSE_CACHE_MAX_ENTRIES', 512),
+    ttl=getattr(settings, 'RESPONSE_CACHE_SECONDS', 300),
+    backend=DiskLRUCache(lambda: settings.RESPONSE_CACHE_DIR, getattr(settings, 'RESPONSE_CACHE_MAX_MB', 64) * 1024 * 1024),
+)
+
+
+def leaderboard_resource(case_id: int, semester_id: int) -> str:
+    return f'leaderboard:{case_id}:{semester_id}'
+
+
+@retry_on_locked
+def bump_versions(*names: str) -> None:
+    response_cache.invalidate(*names)
+    for name in names:
+        if BMGTResourceVersion.objects.filter(name=name).update(version=F('version') + 1):
+            continue
+        _, created = BMGTResourceVersion.objects.get_or_create(name=name, defaults=dict(version=1))
+        if not created:     # created concurrently by another bump
+            BMGTResourceVersion.objects.filter(name=name).update(version=F('version') + 1)
+
+
+def resource_versions(*names: str) -> dict[str, int]:
+    versions = dict.fromkeys(names, 0)
+    versions.update(BMGTResourceVersion.objects.filter(name__in=names).values_list('name', 'version'))
+    return versions
+
+
+def __request_etag(request: HttpRequest, resources: Resources) -> tuple[Union[list[str], None], Union[str, None]]:
+    """
+    names of the resources of the request and the ETag of their versions, both None to skip the ETag
+    """
+    names = resources(request) if callable(resources) else resources
+    if names is None:
+        return None, None
+    names = list(names)
+    versions = sorted(resource_versions(*names).items())
+    # the parameters as the views read them, in any order
+    params = sorted(request.GET.items())
+    return names, quote_etag(hashlib.sha1(f'{request.path}|{params}|{versions}'.encode()).hexdigest())
+
+
+def __rendered(resp: HttpResponse) -> tuple[int, bytes, str]:
+    return resp.status_code, resp.content, resp['Content-Type']
+
+
+def __response(rendered: tuple[int, bytes, str]) -> HttpResponse:
+    status, content, content_type = rendered
+    return HttpResponse(content, content_type=content_type, status=status)
+
+
+def __not_modified(request: HttpRequest, etag: str) -> Union[HttpResponse, None]:
+    if etag is None:
+        return None
+    candidates = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag not in candidates and '*' not in candidates:
+        return None
+    resp = HttpResponseNotModified()
+    resp['ETag'] = etag
+    return resp
+
+
+def __tag(resp: HttpResponse, etag: str) -> HttpResponse:
+    if etag is not None and resp.status_code == HTTPStatus.OK:
+        resp['ETag'] = etag
+        resp['Cache-Control'] = 'no-cache'  # clients revalidate on every use
+    return resp
+
+
+def conditional_on(resources: Resources, cache: bool = False):
+    """
+    answers GET requests whose If-None-Match matches the current versions of the resources with 304 Not Modified,
+    before the view runs. other responses carry the ETag of those versions\n
+    with cache, the rendered response of each ETag is kept in response_cache and served without running the view again.
+    only views whose response is a function of the path and the versions can be cached
+    """
+
+    def decorator(func):
+        if is_async_view(func):
+            @wraps(func)
+            async def async_wrapped(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+                names, etag = await sync_to_async(__request_etag)(request, resources)
+                not_modified = __not_modified(request, etag)
+                if not_modified is not None:
+                    return not_modified
+                if not cache or etag is None:
+                    return __tag(await func(request, *args, **kwargs), etag)
+
+                async def render():
+                    return __rendered(await func(request, *args, **kwargs))
+
+                return __tag(__response(await response_cache.aget_or_query(f'response:{etag}', render, tags=names)), etag)
+
+            return async_wrapped
+
+        @wraps(func)
+        def wrapped(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+            names, etag = __request_etag(request, resources)
+            not_modified = __not_modified(request, etag)
+            if not_modified is not None:
+                return not_modified
+            if not cache or etag is None:
+                return __tag(func(request, *args, **kwargs), etag)
+            rendered = response_cache.get_or_query(f'response:{etag}', lambda: __rendered(func(request, *args, **kwargs)), tags=names)
+            return __tag(__response(rendered), etag)
+
+        return wrapped
+
+    return decorator
+
+
+@receiver(post_save, sender=BMGTCase)
+@receiver(post_delete, sender=BMGTCase)
+def __bump_case(sender, **kwargs):
+    bump_versions(CASE_RESOURCE)
+
+
+@receiver(post_save, sender=BMGTCaseConfig)
+@receiver(post_delete, sender=BMGTCaseConfig)
+def __bump_case_config(sender, **kwargs):
+    bump_versions(CASE_CONFIG_RESOURCE)
+
+
+@receiver(post_save, sender=BMGTSemester)
+@receiver(post_delete, sender=BMGTSemester)
+def __bump_semester(sender, **kwargs):
+    bump_versions(SEMESTER_RESOURCE)
+
+
+@receiver(post_save, sender=BMGTSystemStatus)
+@receiver(post_delete, sender=BMGTSystemStatus)
+def __bump_system(sender, **kwargs):
+    bump_versions(SYSTEM_RESOURCE)
+
+
+def __bump_named_leaderboards(created: bool, update_fields: Union[Iterable[str], None], name_fields: set[str], **record_filter) -> None:
+    """
+    leaderboard pages show the names of the groups and users of their records, so the boards listing a renamed
+    (or deleted) group or user change with it
+    """
+    if created or update_fields is not None and not name_fields.intersection(update_fields):
+        return
+    boards = BMGTLeaderboardEntry.objects.filter(**record_filter).values_list('case_id', 'semester_id').distinct()
+    names = [leaderboard_resource(case_id, semester_id) for case_id, semester_id in boards]
+    if names:
+        bump_versions(*names)
+
+
+@receiver(post_save, sender=BMGTGroup)
+@receiver(pre_delete, sender=BMGTGroup)
+def __bump_group_leaderboards(sender, instance: BMGTGroup, created: bool = False, update_fields=None, **kwargs):
+    __bump_named_leaderboards(created, update_fields, {'number'}, case_record__group_id=instance.id)
+
+
+@receiver(post_save, sender=BMGTUser)
+@receiver(pre_delete, sender=BMGTUser)
+def __bump_user_leaderboards(sender, instance: BMGTUser, created: bool = False, update_fields=None, **kwargs):
+    __bump_named_leaderboards(created, update_fields, {'first_name', 'last_name'}, case_record__user_id=instance.id)
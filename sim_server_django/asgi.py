@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sim_server_django.settings')
+# simulations are CPU bound and would hold the GIL against the event loop of the async views,
+# so under ASGI they run in simulation_worker processes. the local thread pool is left to runserver and tests
+os.environ.setdefault('APP_SIMULATION_QUEUE', 'database')
 
 application = get_asgi_application()
@@ -8,10 +8,31 @@ class AppConfig:
     """
 
     APP_DEBUG = int(os.environ.get("APP_DEBUG", 1)) == 1
+    APP_SECRET_KEY = os.environ.get("APP_SECRET_KEY", "")   # signs session tokens, required in production
     APP_FRONTEND_HOST = os.environ.get("APP_FRONTEND_HOST", "localhost:4173")
     APP_USE_MYSQL = os.environ.get("APP_USE_MYSQL", False)
     APP_MYSQL_HOST = os.environ.get("APP_MYSQL_HOST", "localhost")
     APP_MYSQL_PORT = os.environ.get("APP_MYSQL_PORT", 3306)
     APP_MYSQL_USER = os.environ.get("APP_MYSQL_USER", "root")
     APP_MYSQL_PASSWORD = os.environ.get("APP_MYSQL_PASSWORD", "root")
-    APP_MYSQL_DB = os.environ.get("APP_MYSQL_DB", "app")
\ No newline at end of file
+    APP_MYSQL_DB = os.environ.get("APP_MYSQL_DB", "app")
+    APP_SQLITE_CONCURRENT = int(os.environ.get("APP_SQLITE_CONCURRENT", 0)) == 1   # WAL journaling for several server processes writing to one SQLite file
+    APP_SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("APP_SQLITE_BUSY_TIMEOUT_MS", 5000))   # how long a SQLite writer waits for the lock
+    APP_DB_WRITE_RETRIES = int(os.environ.get("APP_DB_WRITE_RETRIES", 3))  # reruns of a write transaction that found the database locked
+    APP_DB_REPLICAS = os.environ.get("APP_DB_REPLICAS", "")  # comma separated read replicas: host[:port] with MySQL, file paths with SQLite
+    APP_DB_REPLICA_LAG_SECONDS = int(os.environ.get("APP_DB_REPLICA_LAG_SECONDS", 5))   # how long a client reads from the primary after it wrote
+    APP_RESULT_CACHE_MAX_MB = int(os.environ.get("APP_RESULT_CACHE_MAX_MB", 256))   # disk budget of the simulation result cache
+    APP_SIMULATION_WORKERS = int(os.environ.get("APP_SIMULATION_WORKERS", 2))  # background simulation threads per server process
+    APP_SIMULATION_QUEUE = os.environ.get("APP_SIMULATION_QUEUE", "local")   # "local" thread pool or "database" job queue served by simulation_worker, the default under ASGI
+    APP_SIMULATION_JOB_LEASE_SECONDS = int(os.environ.get("APP_SIMULATION_JOB_LEASE_SECONDS", 60))
+    APP_SIMULATION_JOB_MAX_ATTEMPTS = int(os.environ.get("APP_SIMULATION_JOB_MAX_ATTEMPTS", 3))
+    APP_SIMULATION_GROUP_MAX_CONCURRENT = int(os.environ.get("APP_SIMULATION_GROUP_MAX_CONCURRENT", 2))  # running simulations per group
+    APP_SIMULATION_GROUP_RATE_PER_MINUTE = float(os.environ.get("APP_SIMULATION_GROUP_RATE_PER_MINUTE", 6))  # sustained submissions per group and server process
+    APP_SIMULATION_GROUP_BURST = int(os.environ.get("APP_SIMULATION_GROUP_BURST", 3))  # per group and server process
+    APP_SIMULATION_MAX_PENDING = int(os.environ.get("APP_SIMULATION_MAX_PENDING", 32))  # queued simulations before new submissions are shed
+    APP_SIMULATION_RUNNING_TIMEOUT_SECONDS = int(os.environ.get("APP_SIMULATION_RUNNING_TIMEOUT_SECONDS", 900))  # running records older than this are failed
+    APP_SESSION_USER_CACHE_TTL_SECONDS = int(os.environ.get("APP_SESSION_USER_CACHE_TTL_SECONDS", 30))  # how long other processes may serve a changed user
+    APP_PAGINATION_COUNT_CACHE_SECONDS = int(os.environ.get("APP_PAGINATION_COUNT_CACHE_SECONDS", 30))  # how long cursor pages may report a stale total
+    APP_RESPONSE_CACHE_SECONDS = int(os.environ.get("APP_RESPONSE_CACHE_SECONDS", 300))  # lifetime of cached responses of the versioned read endpoints, 0 disables
+    APP_RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("APP_RESPONSE_CACHE_MAX_ENTRIES", 512))   # responses kept in the memory of each process
+    APP_RESPONSE_CACHE_MAX_MB = int(os.environ.get("APP_RESPONSE_CACHE_MAX_MB", 64))  # disk budget of the responses shared by the processes
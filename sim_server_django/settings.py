@@ -1,3 +1,4 @@
+from django.core.exceptions import ImproperlyConfigured
 from pathlib import Path
 from .config import AppConfig
 import os
@@ -6,11 +7,16 @@ import os
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
-# SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure-7+pi0)&orq-c)01-0vt$^=^jhs-m$)t3b7h-sx!i+#)lwbs^u5'
-
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = AppConfig.APP_DEBUG
+
+# SECURITY WARNING: keep the secret key used in production secret!
+# session tokens are signed with it, so the key in the source is only good for development
+SECRET_KEY = AppConfig.APP_SECRET_KEY
+if not SECRET_KEY:
+    if not DEBUG:
+        raise ImproperlyConfigured("APP_SECRET_KEY must be set when APP_DEBUG is off")
+    SECRET_KEY = 'django-insecure-7+pi0)&orq-c)01-0vt$^=^jhs-m$)t3b7h-sx!i+#)lwbs^u5'
 if DEBUG == True:
     print("running in debug mode")
 else:
@@ -38,6 +44,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'bmgt435_elp.middlewares.CORSMiddleware',
+    'bmgt435_elp.middlewares.DatabaseRoutingMiddleware',
     'bmgt435_elp.middlewares.AuthenticationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -73,7 +80,7 @@ ASGI_APPLICATION = 'sim_server_django.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
-# DATABASE_ROUTERS = ['bmgt435_elp.utils.databaseUtils.BMGT435_DB_Router', ]
+DATABASE_ROUTERS = ['bmgt435_elp.utils.databaseUtils.BMGT435_DB_Router', ]
 
 if AppConfig.APP_USE_MYSQL:
     DATABASES = {
@@ -98,8 +105,33 @@ else:
             'NAME': BASE_DIR / 'db.sqlite3',
         }
     }
+    SQLITE_PRAGMAS = {'busy_timeout': AppConfig.APP_SQLITE_BUSY_TIMEOUT_MS}
+    if AppConfig.APP_SQLITE_CONCURRENT:
+        # readers no longer block the writer, and commits only sync the log at checkpoints
+        SQLITE_PRAGMAS.update({
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -32000,   # KiB
+            'temp_store': 'MEMORY',
+        })
     print('Using SQLite database')
 
+# Read replicas of the default database, e.g. MySQL replica hosts or copies of the SQLite file.
+# Tests read the replicas from the test database.
+DATABASE_REPLICAS = []
+for replica in filter(None, map(str.strip, AppConfig.APP_DB_REPLICAS.split(','))):
+    alias = f'replica_{len(DATABASE_REPLICAS)}'
+    DATABASES[alias] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    if AppConfig.APP_USE_MYSQL:
+        host, _, port = replica.partition(':')
+        DATABASES[alias].update(HOST=host, PORT=port or DATABASES['default']['PORT'])
+    else:
+        DATABASES[alias]['NAME'] = replica
+    DATABASE_REPLICAS.append(alias)
+DATABASE_REPLICA_LAG_SECONDS = AppConfig.APP_DB_REPLICA_LAG_SECONDS
+DATABASE_WRITE_RETRIES = AppConfig.APP_DB_WRITE_RETRIES
+DATABASE_WRITE_RETRY_BACKOFF_SECONDS = 0.05
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -157,6 +189,26 @@ case_records_dir = MEDIA_ROOT + 'bmgt435/case-records/'
 if not os.path.exists(case_records_dir):
     os.makedirs(case_records_dir)
 
+# Simulations submitted through the api run on this many background threads per process.
+# 0 runs them inline within the request.
+SIMULATION_WORKERS = AppConfig.APP_SIMULATION_WORKERS
+SIMULATION_QUEUE = AppConfig.APP_SIMULATION_QUEUE
+SIMULATION_JOB_LEASE_SECONDS = AppConfig.APP_SIMULATION_JOB_LEASE_SECONDS
+SIMULATION_JOB_MAX_ATTEMPTS = AppConfig.APP_SIMULATION_JOB_MAX_ATTEMPTS
+SIMULATION_GROUP_MAX_CONCURRENT = AppConfig.APP_SIMULATION_GROUP_MAX_CONCURRENT
+# the submission rate of a group is limited in each server process, so with N processes a group may submit N times as fast
+SIMULATION_GROUP_RATE_PER_MINUTE = AppConfig.APP_SIMULATION_GROUP_RATE_PER_MINUTE
+SIMULATION_GROUP_BURST = AppConfig.APP_SIMULATION_GROUP_BURST
+SIMULATION_MAX_PENDING = AppConfig.APP_SIMULATION_MAX_PENDING
+SIMULATION_RUNNING_TIMEOUT_SECONDS = AppConfig.APP_SIMULATION_RUNNING_TIMEOUT_SECONDS
+SESSION_USER_CACHE_TTL_SECONDS = AppConfig.APP_SESSION_USER_CACHE_TTL_SECONDS
+PAGINATION_COUNT_CACHE_SECONDS = AppConfig.APP_PAGINATION_COUNT_CACHE_SECONDS
+RESPONSE_CACHE_SECONDS = AppConfig.APP_RESPONSE_CACHE_SECONDS
+RESPONSE_CACHE_MAX_ENTRIES = AppConfig.APP_RESPONSE_CACHE_MAX_ENTRIES
+RESPONSE_CACHE_MAX_MB = AppConfig.APP_RESPONSE_CACHE_MAX_MB
+RESPONSE_CACHE_DIR = MEDIA_ROOT + 'bmgt435/response-cache/'
+RESULT_CACHE_DIR = MEDIA_ROOT + 'bmgt435/result-cache/'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 